@@ -0,0 +1,90 @@
+"""
+Measures carrying low-cardinality string columns as pandas categoricals
+and Arrow dictionaries, as transform.encode_categories does, against
+plain strings: memory in pandas and Arrow, and parquet size written
+without dictionary pages, with pyarrow's defaults and once encoded.
+
+    python benchmarks/bench_categories.py --rows 1000000
+"""
+
+import argparse
+from io import BytesIO
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src.transform import encode_categories
+
+
+def make_rows(rows):
+    """
+    Builds a table of the low-cardinality columns transform writes,
+    next to an id and an amount that are left alone
+    """
+    rng = np.random.default_rng(0)
+    countries = [f'country-{i}' for i in range(50)]
+    return pd.DataFrame({
+        'id': np.arange(rows),
+        'currency_code': rng.choice(['GBP', 'USD', 'EUR'], rows),
+        'currency_name': rng.choice(
+            ['British Pound Sterling', 'United States Dollar', 'Euro'], rows),
+        'day_name': rng.choice(
+            ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
+             'Saturday', 'Sunday'], rows),
+        'month_name': rng.choice(
+            ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+             'August', 'September', 'October', 'November', 'December'],
+            rows),
+        'department_name': rng.choice(
+            ['Sales', 'Purchasing', 'Finance', 'Dispatch'], rows),
+        'location': rng.choice(['Leeds', 'Manchester'], rows),
+        'transaction_type': rng.choice(['SALE', 'PURCHASE'], rows),
+        'payment_type_name': rng.choice(
+            ['SALES_RECEIPT', 'SALES_REFUND', 'PURCHASE_PAYMENT',
+             'PURCHASE_REFUND'], rows),
+        'counterparty_legal_country': rng.choice(countries, rows),
+        'amount': rng.random(rows) * 1000
+    })
+
+
+def parquet_size(values, **kwargs):
+    """
+    Returns the bytes of values written as parquet
+    """
+    buffer = BytesIO()
+    if isinstance(values, pa.Table):
+        pq.write_table(values, buffer, **kwargs)
+    else:
+        values.to_parquet(buffer, **kwargs)
+    return buffer.tell()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--ratio', type=float, default=0.5)
+    args = parser.parse_args()
+
+    plain = make_rows(args.rows)
+    encoded = encode_categories(plain, args.ratio)
+    plain_table = pa.Table.from_pandas(plain, preserve_index=False)
+    encoded_table = encode_categories(plain_table, args.ratio)
+    mib = 1024 * 1024
+
+    print(f"rows:                    {args.rows}")
+    print(f"encoded columns:         "
+          f"{(encoded.dtypes == 'category').sum()} of {len(plain.columns)}")
+    print(f"pandas memory plain:     "
+          f"{plain.memory_usage(deep=True).sum() / mib:.1f} MiB")
+    print(f"pandas memory encoded:   "
+          f"{encoded.memory_usage(deep=True).sum() / mib:.1f} MiB")
+    print(f"arrow memory plain:      {plain_table.nbytes / mib:.1f} MiB")
+    print(f"arrow memory encoded:    {encoded_table.nbytes / mib:.1f} MiB")
+    print(f"parquet no dictionaries: "
+          f"{parquet_size(plain, use_dictionary=False) / mib:.1f} MiB")
+    print(f"parquet plain, defaults: {parquet_size(plain) / mib:.1f} MiB")
+    print(f"parquet encoded:         {parquet_size(encoded) / mib:.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
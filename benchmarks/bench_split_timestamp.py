@@ -0,0 +1,57 @@
+"""
+Times splitting a timestamp column into date and time columns,
+as the fact builders did with a Series per row and as
+transform.split_timestamp does with Arrow casts.
+
+    python benchmarks/bench_split_timestamp.py --rows 1000000
+"""
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from src.transform import split_timestamp
+
+
+def make_timestamps(rows):
+    """
+    Builds a column of rows random timestamps with milliseconds
+    """
+    start = pd.Timestamp('2022-11-03 14:20:49.962')
+    offsets = np.random.default_rng(0).integers(
+        0, 365 * 24 * 3600 * 1000, rows)
+    return pd.Series(start + pd.to_timedelta(offsets, unit='ms'))
+
+
+def split_per_row(column):
+    """
+    The fact builders' old split, one pd.Series per row
+    """
+    return column.apply(lambda x: pd.Series(str(x).split(" ")))
+
+
+def time_it(function, column):
+    """
+    Returns the seconds one call of function takes
+    """
+    started = time.perf_counter()
+    function(column)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    column = make_timestamps(args.rows)
+    per_row = time_it(split_per_row, column)
+    vectorised = time_it(split_timestamp, column)
+    print(f"rows:        {args.rows}")
+    print(f"per row:     {per_row:.3f}s")
+    print(f"vectorised:  {vectorised:.3f}s")
+    print(f"speed-up:    {per_row / vectorised:.0f}x")
+
+
+if __name__ == '__main__':
+    main()
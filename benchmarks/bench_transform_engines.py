@@ -0,0 +1,169 @@
+"""
+Times the pandas and Arrow transform engines building every dim and
+fact from synthetic ingested tables, parquet bytes in and parquet
+bytes out, each engine in its own process so its peak RSS is its own.
+
+    python benchmarks/bench_transform_engines.py --rows 1000000
+"""
+
+import argparse
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src.transform import ARROW_BUILDERS, OUTPUT_BUILDERS
+
+
+def make_order_table(rows, rng):
+    """
+    Columns shared by the sales_order, purchase_order and payment tables
+    """
+    start = pd.Timestamp('2022-11-03 14:20:49.962')
+    created = start + pd.to_timedelta(
+        rng.integers(0, 365 * 24 * 3600 * 1000, rows), unit='ms')
+    return {
+        'created_at': created,
+        'last_updated': created + pd.to_timedelta(
+            rng.integers(0, 3600 * 1000, rows), unit='ms'),
+        'staff_id': rng.integers(1, 20, rows),
+        'counterparty_id': rng.integers(1, 20, rows),
+        'currency_id': rng.integers(1, 4, rows),
+        'agreed_payment_date': (created + pd.Timedelta(days=30)).date,
+        'agreed_delivery_date': (created + pd.Timedelta(days=7)).date,
+        'agreed_delivery_location_id': rng.integers(1, 30, rows)
+    }
+
+
+def make_ingested(rows):
+    """
+    Builds the eleven ingested tables as parquet bytes, the three fact
+    sources with rows rows each and the dim sources small
+    """
+    rng = np.random.default_rng(0)
+    small = 30
+    ids = np.arange(1, small + 1)
+    tables = {
+        'address': pd.DataFrame({
+            'address_id': ids,
+            'address_line_1': [f'al1-{i}' for i in ids],
+            'address_line_2': [f'al2-{i}' for i in ids],
+            'district': [f'district-{i}' for i in ids],
+            'city': [f'city-{i}' for i in ids],
+            'postal_code': [f'{i:05}' for i in ids],
+            'country': ['UK', 'France', 'Germany'] * (small // 3),
+            'phone': [f'0000 {i:06}' for i in ids]}),
+        'counterparty': pd.DataFrame({
+            'counterparty_id': ids,
+            'counterparty_legal_name': [f'cp-{i}' for i in ids],
+            'legal_address_id': ids[::-1]}),
+        'currency': pd.DataFrame({
+            'currency_id': [1, 2, 3], 'currency_code': ['GBP', 'USD', 'EUR']}),
+        'department': pd.DataFrame({
+            'department_id': [1, 2, 3],
+            'department_name': ['Sales', 'Purchasing', 'Finance'],
+            'location': ['Leeds', 'Manchester', 'Leeds']}),
+        'design': pd.DataFrame({
+            'design_id': ids,
+            'design_name': [f'design-{i}' for i in ids],
+            'file_location': ['/designs'] * small,
+            'file_name': [f'file-{i}.json' for i in ids]}),
+        'payment_type': pd.DataFrame({
+            'payment_type_id': [1, 2, 3, 4],
+            'payment_type_name': [
+                'SALES_RECEIPT', 'SALES_REFUND', 'PURCHASE_PAYMENT',
+                'PURCHASE_REFUND']}),
+        'staff': pd.DataFrame({
+            'staff_id': ids,
+            'first_name': [f'fn-{i}' for i in ids],
+            'last_name': [f'ln-{i}' for i in ids],
+            'department_id': [1, 2, 3] * (small // 3),
+            'email_address': [f'staff{i}@terrifictotes.com' for i in ids]}),
+        'transaction': pd.DataFrame({
+            'transaction_id': ids,
+            'transaction_type': ['SALE', 'PURCHASE'] * (small // 2),
+            'sales_order_id': ids,
+            'purchase_order_id': ids}),
+        'sales_order': pd.DataFrame({
+            'sales_order_id': np.arange(rows),
+            **make_order_table(rows, rng),
+            'design_id': rng.integers(1, small, rows),
+            'units_sold': rng.integers(1, 100000, rows),
+            'unit_price': rng.random(rows) * 4}),
+        'purchase_order': pd.DataFrame({
+            'purchase_order_id': np.arange(rows),
+            **make_order_table(rows, rng),
+            'item_code': rng.choice(['ZDOI5EA', 'QLZLEXR', '8ZW5XSI'], rows),
+            'item_quantity': rng.integers(1, 1000, rows),
+            'item_unit_price': rng.random(rows) * 1000}),
+        'payment': pd.DataFrame({
+            'payment_id': np.arange(rows),
+            **make_order_table(rows, rng),
+            'transaction_id': rng.integers(1, small, rows),
+            'payment_amount': rng.random(rows) * 100000,
+            'payment_type_id': rng.integers(1, 5, rows),
+            'paid': rng.random(rows) < 0.5,
+            'payment_date': rng.choice(
+                ['2023-01-01', '2023-06-30'], rows)})
+    }
+    ingested = {}
+    for title, data_frame in tables.items():
+        buffer = BytesIO()
+        pq.write_table(pa.Table.from_pandas(data_frame), buffer)
+        ingested[title] = buffer.getvalue()
+    return ingested
+
+
+def run_engine(engine, ingested):
+    """
+    Reads every ingested table, builds every output and writes it as
+    parquet, returning the seconds taken, the bytes written and the
+    process's peak RSS in MiB
+    """
+    started = time.perf_counter()
+    if engine == 'arrow':
+        builders = ARROW_BUILDERS
+        tables = {
+            title: pq.read_table(BytesIO(body))
+            for title, body in ingested.items()}
+    else:
+        builders = OUTPUT_BUILDERS
+        tables = {
+            title: pd.read_parquet(BytesIO(body))
+            for title, body in ingested.items()}
+    written = 0
+    for builder, titles in builders.values():
+        values = builder(*[tables[title] for title in titles])
+        sink = BytesIO()
+        if engine == 'arrow':
+            pq.write_table(values, sink)
+        else:
+            values.to_parquet(sink)
+        written += sink.tell()
+    seconds = time.perf_counter() - started
+    # Linux reports ru_maxrss in KiB
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return seconds, written, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    ingested = make_ingested(args.rows)
+    print(f"rows per fact: {args.rows}")
+    print(f"ingested:      {sum(map(len, ingested.values()))} bytes")
+    for engine in ['pandas', 'arrow']:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            seconds, written, peak = executor.submit(
+                run_engine, engine, ingested).result()
+        print(f"{engine:7}  {seconds:.3f}s  {written} bytes written  "
+              f"peak RSS {peak:.0f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,28 +3,240 @@ the exreact function will get data updates from the data lake
 and push it to the ingested data s3 bucket in parquet format
 """
 
-import bisect
+import io
 import json
 import logging
+import math
+import queue
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from io import BytesIO
 import os
 from pathlib import Path
 from dotenv import load_dotenv
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import boto3
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import pg8000
 import pg8000.native
 
 logger = logging.getLogger('MyLogger')
 logger.setLevel(logging.INFO)
 
+# Manifest in the ingested bucket holding each table's high-water marks
+WATERMARKS_KEY = 'watermarks.json'
+
+# Rows fetched per round trip when streaming a table
+FETCH_SIZE = 10000
+
+# Tables extracted at once, each on its own connection, in parallel mode
+MAX_WORKERS = 4
+
+# Tables read but not yet pushed in pipeline mode, and the threads
+# pushing them
+PIPELINE_DEPTH = 2
+UPLOAD_WORKERS = 2
+
+# Estimated rows per key range when parallel mode splits a table
+ROWS_PER_SPLIT = 500000
+# Seconds a table's last extraction may take before it is split further
+SECONDS_PER_SPLIT = 60
+# Bytes of rows fetched per batch, fetch_size being the most rows
+BATCH_BYTES = 8 * 1024 * 1024
+# The plan of each run is written under this prefix
+PLANS_PREFIX = 'plans'
+# Fields of a table's plan the event may override
+PLAN_OVERRIDES = ('snapshot_method', 'splits', 'fetch_size')
+
+# Rows per page, and so per part, of a keyset backfill
+PAGE_SIZE = 50000
+# Backfill progress is saved under this prefix, one object per table
+CHECKPOINTS_PREFIX = 'checkpoints'
+# Time left for the page in flight and the manifest once a run stops
+DEADLINE_MARGIN = 15
+
+# Logical replication slot and publication read by mode='cdc'
+REPLICATION_SLOT = 'scrumptious_extract'
+PUBLICATION = 'scrumptious_extract'
+# Changes read from the slot before they are pushed
+MAX_CHANGES = 100000
+
+# Ways index() can extract the tables, see its docstring
+MODES = ('batch', 'stream', 'pipeline', 'parallel', 'cdc')
+
+# Settings the extract event can override
+DEFAULT_OPTIONS = {
+    'mode': 'batch',
+    'fetch_size': FETCH_SIZE,
+    'max_workers': MAX_WORKERS,
+    'snapshot_method': 'rows',
+    'page_size': PAGE_SIZE,
+    'max_changes': MAX_CHANGES,
+    'skip_unchanged': True,
+    'rows_per_split': ROWS_PER_SPLIT,
+    'plan': {},
+    'upload_workers': UPLOAD_WORKERS
+}
+
+# S3 rejects multipart parts under 5 MiB, apart from the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+UPLOAD_PART_SIZE = 8 * 1024 * 1024
+UPLOAD_CONCURRENCY = 4
+
+# Arrow types for the Postgres type OIDs found in cursor descriptions.
+# Anything not listed is read as a string
+NUMERIC_TYPE = pa.decimal128(38, 10)
+PG_ARROW_TYPES = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    25: pa.string(),
+    700: pa.float32(),
+    701: pa.float64(),
+    1042: pa.string(),
+    1043: pa.string(),
+    1082: pa.date32(),
+    1114: pa.timestamp('us'),
+    1700: NUMERIC_TYPE
+}
+# Text columns holding dates, which are read as date32 instead
+DATE_COLUMNS = ('agreed_delivery_date', 'agreed_payment_date')
+
+
+# Clients, bucket names and secrets kept between warm invocations
+# of the Lambda, with how many seconds each kind stays fresh
+CACHE_TTLS = {'client': 3600, 'bucket_name': 3600, 'secret': 900}
+cache = {}
+cache_lock = threading.RLock()
+# Held while a value is made, one per kind and key
+key_locks = {}
+cache_stats = {kind: {'hits': 0, 'misses': 0} for kind in CACHE_TTLS}
+
+
+def make_s3_config():
+    """
+    Only checksums S3 requests that require it. From botocore 1.36
+    upload_part is otherwise sent as aws-chunked with a trailing
+    checksum, which moto stores undecoded
+    """
+    try:
+        return Config(
+            request_checksum_calculation='when_required',
+            response_checksum_validation='when_required')
+    except TypeError:
+        # Older botocore only checksums when required already
+        return Config()
+
+
+# Settings for the clients of each service that needs any
+CLIENT_CONFIGS = {'s3': make_s3_config()}
+
+
+def get_cached_entry(kind, key):
+    """
+    Returns the fresh cached value of one kind for key, counting the
+    hit, or None. Only call it holding cache_lock
+    """
+    entry = cache.get((kind, key))
+    if entry is not None and \
+            time.monotonic() - entry[1] < CACHE_TTLS[kind]:
+        cache_stats[kind]['hits'] += 1
+        return entry[0]
+    return None
+
+
+def get_cached(kind, key, make):
+    """
+    Returns the cached value of one kind for key, calling make() to
+    fill it in when it is missing or older than CACHE_TTLS[kind].
+    None is never cached, so a missing bucket is looked for again.
+
+    make() runs under a lock of its own key only, so threads filling
+    other keys or reading fresh ones never wait on it, and threads
+    after the same key wait for its value rather than making it again
+    """
+    with cache_lock:
+        value = get_cached_entry(kind, key)
+        if value is not None:
+            return value
+        key_lock = key_locks.setdefault((kind, key), threading.RLock())
+    with key_lock:
+        with cache_lock:
+            # Filled while this thread waited for the key
+            value = get_cached_entry(kind, key)
+            if value is not None:
+                return value
+            cache_stats[kind]['misses'] += 1
+        value = make()
+        if value is not None:
+            with cache_lock:
+                cache[(kind, key)] = (value, time.monotonic())
+        return value
+
+
+def invalidate_cache(kind=None, key=None):
+    """
+    Drops the cached values of one kind, or one key of it,
+    or everything if no kind is given
+    """
+    with cache_lock:
+        for cached_kind, cached_key in list(cache):
+            if kind in (None, cached_kind) and key in (None, cached_key):
+                del cache[(cached_kind, cached_key)]
+
+
+def reset_cache_stats():
+    """
+    Zeroes the hit and miss counts, at the start of an invocation
+    """
+    with cache_lock:
+        for counts in cache_stats.values():
+            counts['hits'] = counts['misses'] = 0
+
+
+def report_cache_stats(stage):
+    """
+    Logs the cache hits and misses of each kind since the last reset
+    """
+    with cache_lock:
+        stats = {kind: dict(counts) for kind, counts in cache_stats.items()}
+    logger.info(f"{stage} cache hits/misses: " + ', '.join(
+        f"{kind} {counts['hits']}/{counts['misses']}"
+        for kind, counts in stats.items()))
+    return stats
+
+
+def get_client(service):
+    """
+    Returns the shared boto3 client for a service. Clients are
+    thread-safe once made, but making them is not, hence the lock
+    """
+    return get_cached('client', service, lambda: boto3.client(
+        service, config=CLIENT_CONFIGS.get(service)))
+
 
 def pull_secrets(secret_id="source_DB"):
+    """
+    Retrieves the secret from SecretManager,
+    at most once per CACHE_TTLS['secret'] seconds
+    """
+    return get_cached('secret', secret_id, lambda: fetch_secrets(secret_id))
+
+
+def fetch_secrets(secret_id):
     """
     Retrieves the secret from SecretManager
     """
-    secret_manager = boto3.client("secretsmanager")
+    secret_manager = get_client("secretsmanager")
     try:
         response = secret_manager.get_secret_value(SecretId=secret_id)
     except ClientError as error:
@@ -58,13 +270,19 @@ def make_connection(dotenv_path_string):
     load_dotenv(dotenv_path=dotenv_path, override=True)
 
     if dotenv_path_string.endswith('development'):
-        details = pull_secrets()
-        conn = pg8000.connect(
-            database=details['database'],
-            user=details['user'],
-            password=details['password'],
-            host=details['host'],
-            port=details['port'])
+        database, user, password, host, port = pull_secrets()
+        try:
+            conn = pg8000.connect(
+                database=database,
+                user=user,
+                password=password,
+                host=host,
+                port=port)
+        except Exception as error:
+            # The password may have been rotated, fetch it afresh next time
+            invalidate_cache('secret', 'source_DB')
+            raise Exception(
+                f"ERROR CONNECTING TO {host}: {error}") from error
     elif dotenv_path_string.endswith('test'):
         conn = pg8000.connect(
             database=os.getenv('database'),
@@ -89,11 +307,107 @@ def get_titles(dbcur):
         raise Exception(f"ERROR FETCHING TITLES: {error}") from error
 
 
-def get_whole_table(dbcur, title):
+def get_table_stats(dbcur):
+    """
+    Reads how many rows each table has had inserted, updated and
+    deleted, from the statistics collector in one catalog query
+    """
+    sql = """SELECT relname, n_tup_ins, n_tup_upd, n_tup_del
+    FROM pg_stat_user_tables
+    WHERE schemaname = 'public';"""
+    try:
+        dbcur.execute(sql)
+        return {row[0]: list(row[1:]) for row in dbcur.fetchall()}
+    except Exception as error:
+        raise Exception(f"ERROR FETCHING TABLE STATS: {error}") from error
+
+
+def get_changed_tables(tables, table_stats, watermarks):
+    """
+    Picks out the tables whose insert, update or delete counts moved
+    since the last run stored them, or that have no marks yet.
+    The counts are only flushed by Postgres every second or so, but a
+    change they miss is found next run as the marks don't move
+    """
+    changed = []
+    for title in tables:
+        marks = watermarks.get(title[0], {})
+        stats = table_stats.get(title[0])
+        if marks.get('created_at') is None or stats is None or \
+                marks.get('table_stats') != stats:
+            logger.info(f"{title[0]} changed ({stats}), extracting")
+            changed.append(title)
+        else:
+            logger.info(f"{title[0]} unchanged ({stats}), skipping")
+    return changed
+
+
+def update_table_stats(watermarks, table_stats, tables, timings=None):
+    """
+    Stores the insert, update and delete counts the given tables were
+    extracted at, for get_changed_tables to compare with next run,
+    and the seconds they took, for plan_table
+    """
+    if timings is None:
+        timings = {}
+    new_watermarks = dict(watermarks)
+    for title in tables:
+        marks = dict(watermarks.get(title[0], {}))
+        if title[0] in table_stats:
+            marks['table_stats'] = table_stats[title[0]]
+        if title[0] in timings:
+            marks['seconds'] = round(timings[title[0]], 3)
+        if marks:
+            new_watermarks[title[0]] = marks
+    return new_watermarks
+
+
+def key_range_sql(key_range):
+    """
+    Builds the condition for the rows of one key range, given as
+    (key_column, low, high) with low included and high left out.
+    A None bound is open, and the first range also takes null keys
+    """
+    key_column, low, high = key_range
+    conditions = []
+    if low is not None:
+        conditions.append(f"{key_column} >= {int(low)}")
+    if high is not None:
+        conditions.append(f"{key_column} < {int(high)}")
+    condition = ' AND '.join(conditions) or 'TRUE'
+    if low is None:
+        condition = f"{condition} OR {key_column} IS NULL"
+    return f"({condition})"
+
+
+def whole_table_sql(title, key_range=None):
+    """
+    Builds the query for every row of a table, or of one key range
+    """
+    if key_range is not None:
+        return f'SELECT * FROM {title[0]} WHERE {key_range_sql(key_range)}'
+    return f'SELECT * FROM {title[0]}'
+
+
+def recents_table_sql(title, created, updated, key_range=None):
+    """
+    Builds the query for rows created or updated after the given times,
+    in one key range if given
+    """
+    first_con = f"(created_at > '{created}'::timestamp)"
+    second_con = f"(last_updated > '{updated}'::timestamp)"
+    if key_range is not None:
+        return (f"SELECT * FROM {title[0]} WHERE "
+                f"(({first_con}) OR ({second_con})) AND "
+                f"{key_range_sql(key_range)}")
+    return f"SELECT * FROM {title[0]} WHERE ({first_con}) OR ({second_con})"
+
+
+def get_whole_table(dbcur, title, key_range=None):
     """
     Retrieves content of each table in the data lake
     """
-    sql = f'SELECT * FROM {title[0]}'
+    sql = whole_table_sql(title, key_range)
     try:
         dbcur.execute(sql)
         rows = dbcur.fetchall()
@@ -103,13 +417,11 @@ def get_whole_table(dbcur, title):
         raise Exception(f"ERROR FETCHING TABLE {title[0]}: {error}") from error
 
 
-def get_recents_table(dbcur, title, created, updated):
+def get_recents_table(dbcur, title, created, updated, key_range=None):
     """
     Identifies the newly added data and returns in table format
     """
-    first_con = f"(created_at > '{created}'::timestamp)"
-    second_con = f"(last_updated > '{updated}'::timestamp)"
-    sql = f"SELECT * FROM {title[0]} WHERE ({first_con}) OR ({second_con})"
+    sql = recents_table_sql(title, created, updated, key_range)
     try:
         dbcur.execute(sql)
         rows = dbcur.fetchall()
@@ -119,22 +431,297 @@ def get_recents_table(dbcur, title, created, updated):
         raise Exception(f"ERROR FETCHING TABLE {title[0]}: {error}") from error
 
 
+def description_to_schema(description):
+    """
+    Maps the columns of a pg8000 cursor description to an Arrow schema
+    using their type OIDs
+    """
+    fields = []
+    for column in description:
+        name, type_oid = column[0], column[1]
+        if name in DATE_COLUMNS:
+            fields.append((name, pa.date32()))
+        else:
+            fields.append((name, PG_ARROW_TYPES.get(type_oid, pa.string())))
+    return pa.schema(fields)
+
+
+def get_arrow_schema(dbcur, title):
+    """
+    Reads a table's column names and type OIDs without fetching any
+    rows and maps them to an Arrow schema
+    """
+    try:
+        dbcur.execute(f'SELECT * FROM {title[0]} LIMIT 0')
+    except Exception as error:
+        raise Exception(f"ERROR FETCHING TABLE {title[0]}: {error}") from error
+    return description_to_schema(dbcur.description)
+
+
+def build_arrow_array(values, arrow_type):
+    """
+    Builds one typed Arrow array from a column of pg8000 values
+    """
+    if pa.types.is_date32(arrow_type):
+        first = next((value for value in values if value is not None), None)
+        if isinstance(first, str):
+            return pa.array(values, pa.string()).cast(arrow_type)
+    return pa.array(values, arrow_type)
+
+
+def rows_to_record_batch(rows, schema):
+    """
+    Converts rows straight into an Arrow RecordBatch column by column,
+    without building a dict or DataFrame row per row
+    """
+    if rows:
+        columns = zip(*rows)
+    else:
+        columns = [[] for _ in schema]
+    arrays = [
+        build_arrow_array(list(column), field.type)
+        for column, field in zip(columns, schema)]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def rows_to_table(rows, description):
+    """
+    Converts the rows of a query into an Arrow table typed from
+    the query's cursor description
+    """
+    schema = description_to_schema(description)
+    return pa.Table.from_batches([rows_to_record_batch(rows, schema)])
+
+
+def copy_whole_table(dbcur, title):
+    """
+    Retrieves content of a table with COPY TO STDOUT and parses the
+    CSV in bulk with pyarrow, instead of pg8000 building a Python
+    tuple for every row. Returns an Arrow table
+    """
+    schema = get_arrow_schema(dbcur, title)
+    sql = (f"COPY ({whole_table_sql(title)}) TO STDOUT "
+           "WITH (FORMAT csv, HEADER true, NULL '\\N')")
+    buffer = BytesIO()
+    try:
+        dbcur.execute(sql, stream=buffer)
+    except Exception as error:
+        raise Exception(f"ERROR COPYING TABLE {title[0]}: {error}") from error
+
+    buffer.seek(0)
+    convert_options = pa_csv.ConvertOptions(
+        column_types=schema,
+        # NULL is written unquoted as \N, so "" stays an empty string
+        null_values=['\\N'],
+        strings_can_be_null=True,
+        quoted_strings_can_be_null=False,
+        true_values=['t'],
+        false_values=['f'])
+    table = pa_csv.read_csv(buffer, convert_options=convert_options)
+    return table.select(schema.names)
+
+
+def get_key_column(dbcur, title):
+    """
+    Returns the unique column to page a table by: its primary key if it
+    has a single-column one, otherwise its <table>_id column
+    """
+    sql = """SELECT a.attname
+    FROM pg_index i
+    JOIN pg_attribute a
+    ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+    WHERE i.indrelid = %s::regclass AND i.indisprimary;"""
+    try:
+        dbcur.execute(sql, (title[0],))
+        keys = dbcur.fetchall()
+    except Exception as error:
+        raise Exception(
+            f"ERROR FETCHING KEY OF {title[0]}: {error}") from error
+    if len(keys) == 1:
+        return keys[0][0]
+
+    if f'{title[0]}_id' in get_arrow_schema(dbcur, title).names:
+        return f'{title[0]}_id'
+    raise Exception(f"ERROR FETCHING KEY OF {title[0]}: no single key column")
+
+
+def check_key_indexed(dbcur, title, key_column):
+    """
+    Checks if an index leads with a table's key column, so each keyset
+    page seeks to its first key rather than scanning the table
+    """
+    sql = """SELECT 1
+    FROM pg_index i
+    JOIN pg_attribute a
+    ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+    WHERE i.indrelid = %s::regclass AND a.attname = %s;"""
+    try:
+        dbcur.execute(sql, (title[0], key_column))
+        return len(dbcur.fetchall()) > 0
+    except Exception as error:
+        raise Exception(
+            f"ERROR FETCHING INDEXES OF {title[0]}: {error}") from error
+
+
+def get_keyset_page(dbcur, title, key_column, last_key, page_size):
+    """
+    Retrieves the next page_size rows of a table in key order,
+    starting after last_key
+    """
+    if last_key is None:
+        sql = f'SELECT * FROM {title[0]} ORDER BY {key_column} LIMIT %s'
+        args = (page_size,)
+    else:
+        sql = (f'SELECT * FROM {title[0]} WHERE {key_column} > %s '
+               f'ORDER BY {key_column} LIMIT %s')
+        args = (last_key, page_size)
+    try:
+        dbcur.execute(sql, args)
+        return dbcur.fetchall()
+    except Exception as error:
+        raise Exception(f"ERROR FETCHING TABLE {title[0]}: {error}") from error
+
+
+def get_split_points(dbcur, title, key_column, count):
+    """
+    Picks up to count - 1 integer keys splitting a table into ranges of
+    about as many rows, from the pg_stats histogram of the key column,
+    or evenly between its min and max if it has not been analysed
+    """
+    dbcur.execute(
+        """SELECT histogram_bounds::text FROM pg_stats
+        WHERE schemaname = 'public' AND tablename = %s AND attname = %s;""",
+        (title[0], key_column))
+    stats = dbcur.fetchall()
+    if stats and stats[0][0]:
+        bounds = [int(bound) for bound in stats[0][0].strip('{}').split(',')]
+        points = [
+            bounds[round(i * (len(bounds) - 1) / count)]
+            for i in range(1, count)]
+    else:
+        dbcur.execute(f'SELECT MIN({key_column}), MAX({key_column}) '
+                      f'FROM {title[0]}')
+        low, high = dbcur.fetchall()[0]
+        if low is None:
+            return []
+        points = [
+            int(low) + (int(high) - int(low)) * i // count
+            for i in range(1, count)]
+    return sorted(set(points))
+
+
+def plan_key_ranges(dbcur, title, splits):
+    """
+    Splits a table into up to splits key ranges, one per part and
+    connection, or returns [None] to read it whole. Only a table with
+    an index leading with its key column is split, as each range of an
+    unindexed key would scan the whole table
+    """
+    if splits < 2:
+        return [None]
+    try:
+        key_column = get_key_column(dbcur, title)
+        indexed = check_key_indexed(dbcur, title, key_column)
+        if indexed:
+            points = get_split_points(dbcur, title, key_column, splits)
+    except Exception as error:
+        # No single key column, or not an integer one
+        logger.info(f"{title[0]} not split: {error}")
+        return [None]
+    if not indexed:
+        logger.warning(f"{title[0]} not split: no index on {key_column}, "
+                       f"each of its {splits} ranges would scan the table")
+        return [None]
+    edges = [None] + points + [None]
+    logger.info(f"{title[0]} split into {len(edges) - 1} ranges "
+                f"of {key_column} at {points}")
+    return [
+        (key_column, edges[i], edges[i + 1]) for i in range(len(edges) - 1)]
+
+
+def iter_table_batches(dbcur, sql, fetch_size=FETCH_SIZE):
+    """
+    Runs sql through a server-side cursor and yields its rows as
+    Arrow RecordBatches of fetch_size rows, so only one batch is held
+    in memory.
+
+    DECLARE needs an open transaction, which pg8000 starts implicitly
+    unless the connection is in autocommit mode
+    """
+    try:
+        dbcur.execute(f'DECLARE extract_cursor NO SCROLL CURSOR FOR {sql}')
+        schema = None
+        while True:
+            dbcur.execute(f'FETCH FORWARD {fetch_size} FROM extract_cursor')
+            rows = dbcur.fetchall()
+            if not rows:
+                break
+            if schema is None:
+                schema = description_to_schema(dbcur.description)
+            yield rows_to_record_batch(rows, schema)
+        dbcur.execute('CLOSE extract_cursor')
+    except Exception as error:
+        raise Exception(f"ERROR STREAMING QUERY {sql}: {error}") from error
+
+
+def write_batches_to_parquet(batches, sink):
+    """
+    Appends each RecordBatch to sink as its own row group.
+    Returns the row count and latest timestamps written, or None
+    if there were no rows
+    """
+    writer = None
+    summary = {'created_at': None, 'last_updated': None, 'row_count': 0}
+    try:
+        for batch in batches:
+            if writer is None:
+                writer = pq.ParquetWriter(sink, batch.schema)
+            writer.write_batch(batch)
+
+            summary['row_count'] += batch.num_rows
+            for column in ['created_at', 'last_updated']:
+                latest = pc.max(batch.column(column)).as_py()
+                if summary[column] is None or (
+                        latest is not None and latest > summary[column]):
+                    summary[column] = latest
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        return None
+    return summary
+
+
 def get_file_info_in_bucket(bucketname):
     """
-    Returns the names of the files in the s3 bucket in JSON format
+    Returns the names of the files in the s3 bucket in JSON format,
+    following continuation tokens past the first 1000 keys
     """
     try:
-        s3_client = boto3.client('s3')
-        return s3_client.list_objects_v2(Bucket=bucketname)
+        s3_client = get_client('s3')
+        paginator = s3_client.get_paginator('list_objects_v2')
+        contents = []
+        for page in paginator.paginate(Bucket=bucketname):
+            contents.extend(page.get('Contents', []))
+        return {'KeyCount': len(contents), 'Contents': contents}
     except Exception as error:
         raise Exception(f"ERROR CHECKING BUCKET OBJECTS: {error}") from error
 
 
 def get_bucket_name(bucket_prefix):
     """
-    Access S3 and returns the ingested bucket name
+    Access S3 and returns the ingested bucket name,
+    cached once found
+    """
+    return get_cached(
+        'bucket_name', bucket_prefix, lambda: find_bucket_name(bucket_prefix))
+
+
+def find_bucket_name(bucket_prefix):
+    """
+    Lists the buckets for the first one named with bucket_prefix
     """
-    s3_client = boto3.client('s3')
+    s3_client = get_client('s3')
     try:
         response = s3_client.list_buckets()
     except Exception as error:
@@ -145,162 +732,1590 @@ def get_bucket_name(bucket_prefix):
             return bucket['Name']
 
 
+def make_part_key(table, run_id, part=0):
+    """
+    Builds the key for one part of a table written by a run, as
+    table=<name>/extracted_date=<yyyy-mm-dd>/run=<id>/part-<n>.parquet
+    """
+    extracted_date = f'{run_id[:4]}-{run_id[4:6]}-{run_id[6:8]}'
+    return (f'table={table}/extracted_date={extracted_date}/'
+            f'run={run_id}/part-{part}.parquet')
+
+
+def parse_part_key(key):
+    """
+    Splits a part key back into its table, extracted_date, run and part
+    """
+    table, extracted_date, run, part = key.split('/')
+    return {
+        'table': table.split('=', 1)[1],
+        'extracted_date': extracted_date.split('=', 1)[1],
+        'run': run.split('=', 1)[1],
+        'part': int(part[len('part-'):-len('.parquet')])
+    }
+
+
+def get_table_keys(title, response, runs=None):
+    """
+    Returns the keys of a table's parts in the order they were written,
+    only from the given runs if runs is set.
+    A {title}.parquet from before the partitioned layout
+    counts as the oldest part
+    """
+    if response['KeyCount'] == 0:
+        return []
+    keys = [file['Key'] for file in response['Contents']]
+
+    parts = [
+        key for key in keys
+        if key.startswith(f'table={title}/') and key.endswith('.parquet')]
+    parts.sort(key=lambda key: (
+        parse_part_key(key)['run'], parse_part_key(key)['part']))
+    if runs is not None:
+        return [key for key in parts if parse_part_key(key)['run'] in runs]
+
+    if f'{title}.parquet' in keys:
+        parts.insert(0, f'{title}.parquet')
+    return parts
+
+
+def get_table_runs(title, response):
+    """
+    Returns the ids of the runs that wrote parts of a table, oldest first
+    """
+    runs = [parse_part_key(key)['run']
+            for key in get_table_keys(title, response)
+            if key != f'{title}.parquet']
+    return sorted(set(runs))
+
+
 def check_table_in_bucket(title, response):
     """
     Checks if the specified table exists in the S3 bucket
     """
-    if response['KeyCount'] == 0:
-        return False
-    filename = f"{title[0]}.parquet"
-    filenames = [file['Key'] for file in response['Contents']]
-    return filename in filenames
+    return len(get_table_keys(title[0], response)) > 0
 
 
-def get_parquet(title, bucketname, response):
+def get_parquet(title, bucketname, response, runs=None):
     """
-    Retrieves the specified file and converts to a parquet format
+    Retrieves every part of the specified table, or only the parts
+    from the given runs, as one DataFrame
     """
-    filename = f"{title}.parquet"
-    if response['KeyCount'] == 0:
+    keys = get_table_keys(title, response, runs)
+    if not keys:
         return False
-    if filename in [file['Key'] for file in response['Contents']]:
 
+    s3_client = get_client('s3')
+    data_frames = []
+    for key in keys:
         buffer = BytesIO()
-        client = boto3.resource('s3')
-        client_object = client.Object(bucketname, filename)
-        client_object.download_fileobj(buffer)
-        data_frame = pd.read_parquet(buffer)
-        return data_frame
+        s3_client.download_fileobj(bucketname, key, buffer)
+        data_frames.append(pd.read_parquet(buffer))
+    return pd.concat(data_frames, ignore_index=True)
 
 
 def get_most_recent_time(title, bucketname, response):
     """
     Finds the most recent updates and creation times for table rows
     to identify which values need to be updated
+
+    Only needed for tables pushed before the watermark store existed,
+    as it downloads the whole table
     """
-    updates = []
-    creations = []
     table = get_parquet(title[0], bucketname, response)
-    for date in set(table['last_updated']):
-        bisect.insort(updates, date)
-    for date in set(table['created_at']):
-        bisect.insort(creations, date)
-
-    # Stores the most recent values from our previous readings
-    last_update = updates[len(updates)-1]
-    last_creation = creations[len(creations)-1]
-
-    # Compile a sorted list of pre-existing 'last_updated' values
-    # and another of 'created_at' values
-    # returns most recent values in dict
     return {
-        'created_at': last_creation,
-        'last_updated': last_update
+        'created_at': table['created_at'].max(),
+        'last_updated': table['last_updated'].max()
     }
 
 
-def check_each_table(tables, dbcur, bucketname):
+def make_run_id():
     """
-    Gets the newly added data and pushes to a dict in parquet format
+    Returns a sortable identifier for this extraction run
     """
-    to_be_added = []
-    response = get_file_info_in_bucket(bucketname)
+    return datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
 
-    for title in tables:
-        # if there are no existing parquet files storing our data, create them
-        if not check_table_in_bucket(title, response):
-            print(title[0], "to be added")
-            rows, keys = get_whole_table(dbcur, title)
-            to_be_added.append({title[0]: pd.DataFrame(rows, columns=keys)})
-        else:
-            # extract the most recent readings
-            most_recent_readings = get_most_recent_time(
-                title, bucketname, response)
-            # extract raw data
-            readings_created_at = most_recent_readings['created_at']
-            readings_updated = most_recent_readings['last_updated']
-            rows, keys = get_recents_table(
-                dbcur, title, readings_created_at, readings_updated)
-            results = [dict(zip(keys, row)) for row in rows]
 
-            # if there any readings, add them to a dict
-            # with the table title as a key
-            # append them into the to_be_added list
-            # pd.DataFrame will transform the data into a pandas parquet format
-            if len(results) > 0:
-                print(title[0], " is newer")
-            else:
-                print(title[0], "is not new")
+def get_watermarks(bucketname):
+    """
+    Retrieves the per-table high-water marks from the ingested bucket.
+    Returns an empty dict if no run has stored any yet
+    """
+    s3_client = get_client('s3')
+    try:
+        response = s3_client.get_object(Bucket=bucketname, Key=WATERMARKS_KEY)
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return {}
+        raise Exception(f"ERROR FETCHING WATERMARKS: {error}") from error
+    return json.loads(response['Body'].read())
+
 
-            # if len(new_rows) > 0:print({title[0]: pd.DataFrame(new_rows)})
-            if len(results) > 0:
-                to_be_added.append({title[0]: pd.DataFrame(results)})
-    return to_be_added
+def summarise_update(values):
+    """
+    Returns the row count and latest timestamps of one table's update,
+    held either as a DataFrame or an Arrow table
+    """
+    if isinstance(values, pa.Table):
+        return {
+            'created_at': pc.max(values['created_at']).as_py(),
+            'last_updated': pc.max(values['last_updated']).as_py(),
+            'row_count': values.num_rows
+        }
+    return {
+        'created_at': values['created_at'].max(),
+        'last_updated': values['last_updated'].max(),
+        'row_count': len(values)
+    }
 
 
-def push_to_cloud(local_object, bucketname):
+def summarise_updates(updates):
     """
-    Subfunction that pushes local_object to the cloud
+    Summarises every table in the list of dicts pushed by add_updates
     """
-    # seperate key and value from object
-    key = [key for key in local_object.keys()][0]
-    values = local_object[key]
+    summaries = {}
+    for local_object in updates:
+        key = [key for key in local_object.keys()][0]
+        summaries[key] = summarise_update(local_object[key])
+    return summaries
 
-    # use key for file name, and value as the content for the file
-    values.to_parquet(f'/tmp/{key}.parquet')
 
-    s3_client = boto3.client('s3')
-    s3_client.upload_file(f'/tmp/{key}.parquet', bucketname, f'{key}.parquet')
-    os.remove(f'/tmp/{key}.parquet')
+def update_watermarks(watermarks, summaries, run_id):
+    """
+    Moves the high-water marks of every summarised table forward
+    and returns the new manifest
+    """
+    new_watermarks = dict(watermarks)
+    for key, summary in summaries.items():
+        previous = watermarks.get(key, {})
 
-    return True
+        marks = {}
+        for column in ['created_at', 'last_updated']:
+            latest = pd.Timestamp(summary[column])
+            if previous.get(column) is not None:
+                latest = max(pd.Timestamp(previous[column]), latest)
+            marks[column] = None if pd.isna(latest) else str(latest)
+
+        new_watermarks[key] = {
+            **marks,
+            'row_count': previous.get('row_count', 0) + summary['row_count'],
+            'run_id': run_id
+        }
+    return new_watermarks
 
 
-def add_updates(updates, bucketname):
+def put_watermarks(watermarks, bucketname):
     """
-    Iterates through the list of dicts that need to be updated
-    and push to the cloud
+    Replaces the manifest in one PUT, so readers see either
+    the previous run's marks or this run's, never a mix
     """
-    for local_object in updates:
-        push_to_cloud(local_object, bucketname)
+    s3_client = get_client('s3')
+    try:
+        s3_client.put_object(
+            Bucket=bucketname,
+            Key=WATERMARKS_KEY,
+            Body=json.dumps(watermarks, indent=2)
+        )
+    except Exception as error:
+        raise Exception(f"ERROR STORING WATERMARKS: {error}") from error
+    return True
 
 
-def index(dotenv_path_string):
+def get_checkpoint(bucketname, table):
     """
-    Integrates all subfunctions to connect to AWS RDS,
-    find a list of table names, iterate through them
-    to evaluate whether there any updates to make.
+    Retrieves the progress of an unfinished backfill of a table,
+    or None if there isn't one
+    """
+    s3_client = get_client('s3')
+    try:
+        response = s3_client.get_object(
+            Bucket=bucketname, Key=f'{CHECKPOINTS_PREFIX}/{table}.json')
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise Exception(f"ERROR FETCHING CHECKPOINT: {error}") from error
+    return json.loads(response['Body'].read())
 
-    if so, return a list of all neccessary updates
-    in pandas parquet format,
-    if not exit the programme.
+
+def put_checkpoint(bucketname, table, checkpoint):
     """
-    # connect to AWS RDS
-    conn = make_connection(dotenv_path_string)
-    dbcur = conn.cursor()
+    Saves the progress of a table's backfill
+    """
+    s3_client = get_client('s3')
+    try:
+        s3_client.put_object(
+            Bucket=bucketname,
+            Key=f'{CHECKPOINTS_PREFIX}/{table}.json',
+            Body=json.dumps(checkpoint, indent=2))
+    except Exception as error:
+        raise Exception(f"ERROR STORING CHECKPOINT: {error}") from error
+    return True
 
-    # get bucket name
-    bucketname = get_bucket_name('scrumptious-squad-in-data-')
 
-    # Executes SQL query for finding a list of table names inside RDS
-    # and store it in tables variable
-    tables = get_titles(dbcur)
+def delete_checkpoint(bucketname, table):
+    """
+    Removes the progress of a finished backfill
+    """
+    s3_client = get_client('s3')
+    s3_client.delete_object(
+        Bucket=bucketname, Key=f'{CHECKPOINTS_PREFIX}/{table}.json')
+    return True
 
-    # Iterates through the table_names and checks for
-    #  any values which need to updated,
-    # storing them in the 'updates' variable.
-    updates = check_each_table(tables, dbcur, bucketname)
-    dbcur.close()
 
-    add_updates(updates, bucketname)
+def check_checkpoint_in_bucket(title, response):
+    """
+    Checks if a table has a backfill in progress
+    """
+    keys = [file['Key'] for file in response.get('Contents', [])]
+    return f'{CHECKPOINTS_PREFIX}/{title[0]}.json' in keys
 
 
-# Lambda handler
-def extract_lambda_handler(event, context=None):
+def has_watermark(title, watermarks):
     """
-    Fully integrated all subfunctions
+    Checks if a table has finished being extracted before,
+    in which case the bucket need not be listed to read it
     """
-    index(event['dotenv_path_string'])
+    return watermarks.get(title[0], {}).get('created_at') is not None
+
+
+def get_most_recent_readings(title, bucketname, watermarks, response):
+    """
+    Returns the latest 'created_at' and 'last_updated' times already
+    extracted for a table, or None if it has never been extracted
+    or its backfill has not finished.
+    response is only read for tables with no watermark
+    """
+    if has_watermark(title, watermarks):
+        return watermarks[title[0]]
+    if check_checkpoint_in_bucket(title, response):
+        return None
+    if check_table_in_bucket(title, response):
+        return get_most_recent_time(title, bucketname, response)
+    return None
+
+
+def iter_each_table(tables, dbcur, bucketname, watermarks=None,
+                    snapshot_method='rows', plans=None, timings=None,
+                    response=None):
+    """
+    Gets the newly added data of each table in turn,
+    yielding it as a dict of one Arrow table
+
+    With snapshot_method='copy', tables extracted for the first time
+    are read with COPY rather than row by row, unless their plan says
+    otherwise. The seconds each table's query took go in timings.
+    response is the run's listing of the bucket, if it has one
+    """
+    if plans is None:
+        plans = {}
+    if watermarks is None:
+        watermarks = get_watermarks(bucketname)
+
+    for title in tables:
+        # listed once, and only if a table has no watermark
+        if response is None and not has_watermark(title, watermarks):
+            response = get_file_info_in_bucket(bucketname)
+        most_recent_readings = get_most_recent_readings(
+            title, bucketname, watermarks, response)
+
+        # a backfill is only carried on by the stream and parallel modes
+        if most_recent_readings is None and \
+                check_checkpoint_in_bucket(title, response):
+            print(title[0], "has a backfill in progress, skipping")
+            continue
+
+        started = time.perf_counter()
+        table_options = get_table_options(
+            {'snapshot_method': snapshot_method, 'fetch_size': FETCH_SIZE},
+            plans.get(title[0]))
+        update = None
+
+        # if there are no existing parquet files storing our data, create them
+        if most_recent_readings is None:
+            print(title[0], "to be added")
+            if table_options['snapshot_method'] == 'copy':
+                update = {title[0]: copy_whole_table(dbcur, title)}
+            else:
+                rows, keys = get_whole_table(dbcur, title)
+                update = {title[0]: rows_to_table(rows, dbcur.description)}
+        else:
+            # extract raw data
+            readings_created_at = most_recent_readings['created_at']
+            readings_updated = most_recent_readings['last_updated']
+            rows, keys = get_recents_table(
+                dbcur, title, readings_created_at, readings_updated)
+
+            # if there any readings, add them to a dict
+            # with the table title as a key
+            # rows_to_table types each column from the cursor description
+            if len(rows) > 0:
+                print(title[0], " is newer")
+                update = {title[0]: rows_to_table(rows, dbcur.description)}
+            else:
+                print(title[0], "is not new")
+        # Let go of the fetched rows before handing the table on
+        rows = None
+        if timings is not None:
+            timings[title[0]] = time.perf_counter() - started
+        if update is not None:
+            yield update
+
+
+def check_each_table(tables, dbcur, bucketname, watermarks=None,
+                     snapshot_method='rows', plans=None, timings=None,
+                     response=None):
+    """
+    Gets the newly added data and pushes to a dict as Arrow tables,
+    see iter_each_table
+    """
+    return list(iter_each_table(
+        tables, dbcur, bucketname, watermarks, snapshot_method, plans,
+        timings, response))
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Writable file object that uploads whatever is written to it as the
+    parts of an S3 multipart upload, without touching /tmp.
+
+    At most max_concurrency parts are queued or uploading at once, so
+    memory stays around part_size * (max_concurrency + 1). Objects
+    smaller than one part are sent with a single put_object.
+    Leaving a with block on an exception aborts the upload
+    """
+
+    def __init__(self, bucketname, key, s3_client=None,
+                 part_size=UPLOAD_PART_SIZE,
+                 max_concurrency=UPLOAD_CONCURRENCY):
+        super().__init__()
+        self.bucketname = bucketname
+        self.key = key
+        self.s3_client = s3_client or get_client('s3')
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self._buffer = bytearray()
+        self._position = 0
+        self._upload_id = None
+        self._parts = []
+        self._aborted = False
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        self._buffer.extend(data)
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._submit_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _submit_part(self, body):
+        if self._upload_id is None:
+            self._upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucketname, Key=self.key)['UploadId']
+        # Blocks while max_concurrency parts are still uploading
+        self._slots.acquire()
+        part_number = len(self._parts) + 1
+        self._parts.append(
+            self._executor.submit(self._upload_part, part_number, body))
+
+    def _upload_part(self, part_number, body):
+        try:
+            response = self.s3_client.upload_part(
+                Bucket=self.bucketname, Key=self.key,
+                UploadId=self._upload_id, PartNumber=part_number, Body=body)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self._slots.release()
+
+    def abort(self):
+        """
+        Drops everything written so far instead of uploading it
+        """
+        self._aborted = True
+        self._executor.shutdown(wait=True)
+        if self._upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucketname, Key=self.key,
+                UploadId=self._upload_id)
+        self._buffer = bytearray()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._aborted:
+                return
+            if self._upload_id is None:
+                self.s3_client.put_object(
+                    Bucket=self.bucketname, Key=self.key,
+                    Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._submit_part(bytes(self._buffer))
+                parts = [future.result() for future in self._parts]
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucketname, Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={'Parts': parts})
+        except Exception as error:
+            self.abort()
+            raise Exception(
+                f"ERROR UPLOADING {self.key}: {error}") from error
+        finally:
+            self._executor.shutdown(wait=True)
+            super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and not self.closed:
+            self.abort()
+        self.close()
+
+
+def upload_parquet(values, bucketname, key, s3_client=None):
+    """
+    Serialises a DataFrame or Arrow table as parquet straight into
+    the bucket under key
+    """
+    with S3MultipartWriter(bucketname, key, s3_client) as sink:
+        if isinstance(values, pa.Table):
+            pq.write_table(values, sink)
+        else:
+            values.to_parquet(sink)
+    return True
+
+
+def stream_table_to_cloud(dbcur, title, sql, bucketname,
+                          fetch_size=FETCH_SIZE, s3_client=None, run_id=None,
+                          part=0):
+    """
+    Streams the result of sql into a new part of the table batch by
+    batch, uploading as it goes. Returns the summary of what was written,
+    or None if the query returned no rows
+    """
+    if run_id is None:
+        run_id = make_run_id()
+    sink = S3MultipartWriter(
+        bucketname, make_part_key(title[0], run_id, part), s3_client)
+    with sink:
+        summary = write_batches_to_parquet(
+            iter_table_batches(dbcur, sql, fetch_size), sink)
+        if summary is None:
+            sink.abort()
+    return summary
+
+
+def snapshot_table_to_cloud(dbcur, title, bucketname, s3_client=None,
+                            run_id=None):
+    """
+    Copies every row of a table into a new part of it in one go.
+    Returns the summary of what was written, or None for an empty table
+    """
+    table = copy_whole_table(dbcur, title)
+    if table.num_rows == 0:
+        return None
+    if run_id is None:
+        run_id = make_run_id()
+    upload_parquet(
+        table, bucketname, make_part_key(title[0], run_id), s3_client)
+    return summarise_update(table)
+
+
+def backfill_table_to_cloud(dbcur, title, bucketname, page_size=PAGE_SIZE,
+                            s3_client=None, run_id=None, deadline=None,
+                            checkpoint=None):
+    """
+    Pages through a table by its key, pushing each page as its own part
+    and saving the last key after every page, so that a backfill cut
+    short by the deadline or an error carries on from the checkpoint
+    next time. Returns the summary of the whole table once it is done,
+    or None if it stopped early or the table is empty.
+
+    The pages are not read from one snapshot, and rows already paged
+    can change before the last page, so once it is read the rows
+    created or updated since the backfill started are pushed as one
+    more part, see catch_up_backfill()
+    """
+    if checkpoint is None:
+        checkpoint = {
+            'run_id': run_id or make_run_id(),
+            'key_column': get_key_column(dbcur, title),
+            'started_at': get_database_time(dbcur),
+            'last_key': None,
+            'part': 0,
+            'row_count': 0,
+            'created_at': None,
+            'last_updated': None
+        }
+    else:
+        print(title[0], "resuming after", checkpoint['last_key'])
+    key_column = checkpoint['key_column']
+
+    while True:
+        if deadline is not None and time.monotonic() > deadline:
+            logger.info(
+                f"Backfill of {title[0]} stopped after {key_column} "
+                f"{checkpoint['last_key']}, it resumes next run")
+            return None
+
+        started = time.perf_counter()
+        rows = get_keyset_page(
+            dbcur, title, key_column, checkpoint['last_key'], page_size)
+        if not rows:
+            break
+        table = rows_to_table(rows, dbcur.description)
+        upload_parquet(table, bucketname, make_part_key(
+            title[0], checkpoint['run_id'], checkpoint['part']), s3_client)
+
+        page = summarise_update(table)
+        for column in ['created_at', 'last_updated']:
+            latest = [
+                pd.Timestamp(value)
+                for value in [checkpoint[column], page[column]]
+                if value is not None]
+            checkpoint[column] = str(max(latest)) if latest else None
+        checkpoint['last_key'] = table.column(key_column)[-1].as_py()
+        checkpoint['part'] += 1
+        checkpoint['row_count'] += page['row_count']
+        put_checkpoint(bucketname, title[0], checkpoint)
+
+        elapsed = time.perf_counter() - started
+        logger.info(
+            f"Backfilled {title[0]} page {checkpoint['part']}: "
+            f"{page['row_count']} rows up to {key_column} "
+            f"{checkpoint['last_key']} in {elapsed:.2f}s "
+            f"({page['row_count'] / max(elapsed, 1e-6):.0f} rows/s, "
+            f"{checkpoint['row_count']} rows so far)")
+
+    summary = {
+        'created_at': checkpoint['created_at'],
+        'last_updated': checkpoint['last_updated'],
+        'row_count': checkpoint['row_count']
+    }
+    summary = catch_up_backfill(
+        dbcur, title, bucketname, checkpoint, summary, s3_client)
+    delete_checkpoint(bucketname, title[0])
+    if summary['row_count'] == 0:
+        return None
+    return summary
+
+
+def get_database_time(dbcur):
+    """
+    Reads the database's current time, as the timestamps of its rows
+    are written
+    """
+    try:
+        dbcur.execute('SELECT LOCALTIMESTAMP;')
+        return str(dbcur.fetchall()[0][0])
+    except Exception as error:
+        raise Exception(f"ERROR FETCHING DATABASE TIME: {error}") from error
+
+
+def catch_up_backfill(dbcur, title, bucketname, checkpoint, summary,
+                      s3_client=None):
+    """
+    Pushes the rows of a finished backfill created or updated since it
+    started as the part after its pages, so changes to rows paged
+    before the last page are not lost behind the watermark the later
+    pages set. Returns summary with those rows added.
+
+    Checkpoints saved before started_at was recorded have nothing to
+    catch up from
+    """
+    if checkpoint.get('started_at') is None:
+        return summary
+    started_at = checkpoint['started_at']
+    caught_up = stream_table_to_cloud(
+        dbcur, title, recents_table_sql(title, started_at, started_at),
+        bucketname, s3_client=s3_client, run_id=checkpoint['run_id'],
+        part=checkpoint['part'])
+    if caught_up is None:
+        return summary
+    logger.info(f"Caught {title[0]} up with {caught_up['row_count']} rows "
+                f"changed since its backfill started at {started_at}")
+    return combine_summaries([summary, caught_up])
+
+
+def get_extract_options(event):
+    """
+    Picks the extract settings out of the lambda event,
+    falling back to DEFAULT_OPTIONS for any it leaves out
+    """
+    options = dict(DEFAULT_OPTIONS)
+    for key in DEFAULT_OPTIONS:
+        if key in event:
+            options[key] = event[key]
+    return options
+
+
+def extract_table_to_cloud(dbcur, title, most_recent_readings, bucketname,
+                           options=None, s3_client=None, run_id=None,
+                           deadline=None, key_range=None, part=0):
+    """
+    Pushes the rows of a table newer than most_recent_readings, or all
+    of them if it has never been extracted, as a new part of the table.
+    With key_range, only the rows of that range, as the given part
+    """
+    if options is None:
+        options = DEFAULT_OPTIONS
+    if most_recent_readings is None:
+        print(title[0], "to be added")
+        checkpoint = get_checkpoint(bucketname, title[0])
+        if checkpoint is None and options['snapshot_method'] == 'keyset' \
+                and not check_key_indexed(
+                    dbcur, title, get_key_column(dbcur, title)):
+            # Every page would scan the table, reading it whole is O(n)
+            logger.warning(
+                f"{title[0]} has no index on its key column, "
+                "reading it with a cursor rather than keyset pages")
+            options = dict(options, snapshot_method='rows')
+        if options['snapshot_method'] == 'keyset' or checkpoint is not None:
+            return backfill_table_to_cloud(
+                dbcur, title, bucketname, options['page_size'], s3_client,
+                run_id, deadline, checkpoint)
+        if options['snapshot_method'] == 'copy':
+            return snapshot_table_to_cloud(
+                dbcur, title, bucketname, s3_client, run_id)
+        sql = whole_table_sql(title, key_range)
+    else:
+        sql = recents_table_sql(
+            title,
+            most_recent_readings['created_at'],
+            most_recent_readings['last_updated'],
+            key_range)
+    return stream_table_to_cloud(
+        dbcur, title, sql, bucketname, options['fetch_size'], s3_client,
+        run_id, part)
+
+
+def stream_each_table(tables, dbcur, bucketname, watermarks, options=None,
+                      run_id=None, deadline=None, plans=None, timings=None,
+                      response=None):
+    """
+    Streaming version of check_each_table and add_updates, where peak
+    memory is bounded by fetch_size rather than the size of each table.
+    Returns the summaries of the tables that were pushed
+    """
+    if options is None:
+        options = DEFAULT_OPTIONS
+    if plans is None:
+        plans = {}
+    summaries = {}
+
+    for title in tables:
+        started = time.perf_counter()
+        # listed once, and only if a table has no watermark
+        if response is None and not has_watermark(title, watermarks):
+            response = get_file_info_in_bucket(bucketname)
+        most_recent_readings = get_most_recent_readings(
+            title, bucketname, watermarks, response)
+        summary = extract_table_to_cloud(
+            dbcur, title, most_recent_readings, bucketname,
+            get_table_options(options, plans.get(title[0])),
+            run_id=run_id, deadline=deadline)
+        if summary is None:
+            print(title[0], "is not new")
+        else:
+            summaries[title[0]] = summary
+        if timings is not None:
+            timings[title[0]] = time.perf_counter() - started
+    return summaries
+
+
+def make_connection_pool(dotenv_path_string, size):
+    """
+    Opens size connections up front and returns them in a queue.
+    pg8000 connections are not thread-safe, so a worker takes one
+    out of the queue for as long as it is using it
+    """
+    pool = queue.Queue(maxsize=size)
+    for _ in range(size):
+        pool.put(make_connection(dotenv_path_string))
+    return pool
+
+
+def close_connection(conn):
+    """
+    Ends the connection's open transaction, then closes it. Extraction
+    only reads, and the replication setup commits its own changes, so
+    the transaction is rolled back. A connection that already failed
+    is only closed
+    """
+    try:
+        conn.rollback()
+    except Exception as error:
+        logger.warning(f"Could not roll back before closing: {error}")
+    finally:
+        conn.close()
+
+
+def close_connection_pool(pool):
+    """
+    Closes every connection left in the pool
+    """
+    while not pool.empty():
+        pool.get_nowait().close()
+
+
+def export_snapshot(conn):
+    """
+    Starts a REPEATABLE READ transaction on the coordinator connection
+    and exports its snapshot, for workers to read every table as of
+    the same moment. It stays valid until conn's transaction ends
+    """
+    conn.rollback()
+    dbcur = conn.cursor()
+    try:
+        dbcur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        dbcur.execute('SELECT pg_export_snapshot();')
+        return dbcur.fetchall()[0][0]
+    except Exception as error:
+        raise Exception(f"ERROR EXPORTING SNAPSHOT: {error}") from error
+    finally:
+        dbcur.close()
+
+
+def import_snapshot(dbcur, snapshot_id):
+    """
+    Makes the transaction dbcur is starting see the exported snapshot
+    """
+    dbcur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+    dbcur.execute(f"SET TRANSACTION SNAPSHOT '{snapshot_id}'")
+
+
+def extract_table(pool, title, most_recent_readings, bucketname, options,
+                  s3_client, run_id, deadline=None, snapshot_id=None,
+                  key_range=None, part=0):
+    """
+    Pushes one table, or one key range of it as the given part, to the
+    bucket on a connection borrowed from pool, as of the snapshot if
+    one is given. Returns its summary and how long it took
+    """
+    conn = pool.get()
+    dbcur = conn.cursor()
+    started = time.perf_counter()
+    try:
+        if snapshot_id is not None:
+            import_snapshot(dbcur, snapshot_id)
+        summary = extract_table_to_cloud(
+            dbcur, title, most_recent_readings, bucketname, options,
+            s3_client, run_id, deadline, key_range, part)
+        conn.commit()
+        return {
+            'summary': summary,
+            'seconds': time.perf_counter() - started
+        }
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        dbcur.close()
+        pool.put(conn)
+
+
+def combine_summaries(summaries):
+    """
+    Adds up the summaries of the parts of one table, or returns None
+    if none of them had any rows
+    """
+    summaries = [summary for summary in summaries if summary is not None]
+    if not summaries:
+        return None
+    combined = {'row_count': sum(
+        summary['row_count'] for summary in summaries)}
+    for column in ['created_at', 'last_updated']:
+        latest = [
+            pd.Timestamp(summary[column]) for summary in summaries
+            if summary[column] is not None]
+        combined[column] = max(latest) if latest else None
+    return combined
+
+
+def get_table_sizes(dbcur):
+    """
+    Reads the estimated row count and size on disk of every table
+    """
+    sql = """SELECT c.relname, c.reltuples, pg_relation_size(c.oid)
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'public' AND c.relkind = 'r';"""
+    try:
+        dbcur.execute(sql)
+        return {
+            row[0]: {'reltuples': row[1], 'bytes': row[2]}
+            for row in dbcur.fetchall()}
+    except Exception as error:
+        raise Exception(f"ERROR FETCHING TABLE SIZES: {error}") from error
+
+
+def get_timestamp_indexes(dbcur):
+    """
+    Finds which of created_at and last_updated lead an index,
+    by table
+    """
+    sql = """SELECT t.relname, a.attname
+    FROM pg_index i
+    JOIN pg_class t ON t.oid = i.indrelid
+    JOIN pg_namespace n ON n.oid = t.relnamespace
+    JOIN pg_attribute a
+    ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+    WHERE n.nspname = 'public'
+    AND a.attname IN ('created_at', 'last_updated');"""
+    try:
+        dbcur.execute(sql)
+        indexes = {}
+        for table, column in dbcur.fetchall():
+            indexes.setdefault(table, set()).add(column)
+        return {table: sorted(columns) for table, columns in indexes.items()}
+    except Exception as error:
+        raise Exception(f"ERROR FETCHING INDEXES: {error}") from error
+
+
+def plan_table(title, size, indexed, marks, response, options):
+    """
+    Picks how to extract one table:
+    a snapshot the first time, an incremental read after that;
+    how many key ranges to read it as, from its estimated rows and how
+    long it took last time, unless only an index scan is needed;
+    and how many rows to fetch at a time, from its row width
+    """
+    rows = max(size['reltuples'], 0)
+    seconds = marks.get('seconds')
+    plan = {
+        'reltuples': rows,
+        'bytes': size['bytes'],
+        'indexed': indexed,
+        'previous_seconds': seconds
+    }
+
+    # response is only read for tables with no watermark
+    if marks.get('created_at') is not None:
+        plan['strategy'] = 'incremental'
+        plan['snapshot_method'] = None
+    elif check_checkpoint_in_bucket(title, response):
+        plan['strategy'] = 'snapshot'
+        plan['snapshot_method'] = 'keyset'
+    elif not check_table_in_bucket(title, response):
+        plan['strategy'] = 'snapshot'
+        plan['snapshot_method'] = options['snapshot_method']
+    else:
+        plan['strategy'] = 'incremental'
+        plan['snapshot_method'] = None
+
+    if plan['snapshot_method'] not in (None, 'rows'):
+        splits = 1
+    elif plan['strategy'] == 'incremental' and len(indexed) == 2:
+        # Its indexes find the new rows without scanning the table
+        splits = 1
+    else:
+        splits = max(
+            math.ceil(rows / options['rows_per_split']),
+            math.ceil((seconds or 0) / SECONDS_PER_SPLIT))
+    plan['splits'] = max(1, min(options['max_workers'], splits))
+
+    plan['fetch_size'] = options['fetch_size']
+    if rows > 0 and size['bytes'] > 0:
+        plan['fetch_size'] = max(1, min(
+            options['fetch_size'], int(BATCH_BYTES * rows / size['bytes'])))
+    return plan
+
+
+def plan_extract(tables, dbcur, watermarks, response, options):
+    """
+    Plans every table with plan_table, then applies the overrides
+    given by options['plan'], as {table: {field: value}}
+    """
+    sizes = get_table_sizes(dbcur)
+    indexes = get_timestamp_indexes(dbcur)
+    plans = {}
+    for title in tables:
+        plans[title[0]] = plan_table(
+            title,
+            sizes.get(title[0], {'reltuples': -1, 'bytes': 0}),
+            indexes.get(title[0], []),
+            watermarks.get(title[0], {}),
+            response,
+            options)
+
+    for table, overrides in options['plan'].items():
+        unknown = set(overrides) - set(PLAN_OVERRIDES)
+        if unknown:
+            raise ValueError(
+                f"Can't override {', '.join(sorted(unknown))} in the plan "
+                f"of {table}, only {', '.join(PLAN_OVERRIDES)}")
+        if table in plans:
+            plans[table].update(overrides)
+            plans[table]['overridden'] = sorted(overrides)
+    return plans
+
+
+def check_plan_overrides(plans, mode):
+    """
+    Warns about the overrides in plans that mode can't apply, and lists
+    them under 'ignored' in each table's plan: only parallel mode reads
+    key ranges, and the batch and pipeline modes read tables whole,
+    neither in keyset pages nor fetch_size rows at a time
+    """
+    whole = mode not in ('stream', 'cdc', 'parallel')
+    for table, plan in plans.items():
+        ignored = []
+        for override in plan.get('overridden', []):
+            if override == 'splits' and plan['splits'] > 1 and \
+                    mode != 'parallel':
+                ignored.append(override)
+            elif override == 'snapshot_method' and whole and \
+                    plan['snapshot_method'] == 'keyset':
+                ignored.append(override)
+            elif override == 'fetch_size' and whole:
+                ignored.append(override)
+        if ignored:
+            plan['ignored'] = ignored
+            logger.warning(
+                f"{mode} mode ignores the {', '.join(ignored)} planned "
+                f"for {table}")
+    return plans
+
+
+def get_table_options(options, plan=None):
+    """
+    Returns options with the fetch size and snapshot method
+    of one table's plan
+    """
+    if plan is None:
+        return options
+    return {
+        **options,
+        'fetch_size': plan['fetch_size'],
+        'snapshot_method': plan['snapshot_method'] or
+        options['snapshot_method']
+    }
+
+
+def put_plan(plans, bucketname, run_id, mode):
+    """
+    Writes the plan of a run to the bucket for operators to read
+    """
+    s3_client = get_client('s3')
+    try:
+        s3_client.put_object(
+            Bucket=bucketname,
+            Key=f'{PLANS_PREFIX}/{run_id}.json',
+            Body=json.dumps(
+                {'run_id': run_id, 'mode': mode, 'tables': plans}, indent=2))
+    except Exception as error:
+        raise Exception(f"ERROR STORING PLAN: {error}") from error
+    return True
+
+
+def extract_tables_in_parallel(tables, pool, bucketname, watermarks,
+                               options=None, run_id=None, deadline=None,
+                               snapshot_id=None, plans=None, response=None):
+    """
+    Runs extract_table for every table on a pool of threads, one per
+    connection, all reading the exported snapshot if one is given.
+    Tables given key ranges by their plans, see plan_extract, have
+    their ranges read at once, each pushed as its own part.
+    Returns the outcome of each table, so one table failing
+    does not lose the others' work
+    """
+    if options is None:
+        options = DEFAULT_OPTIONS
+    s3_client = get_client('s3')
+    if run_id is None:
+        run_id = make_run_id()
+    if plans is None:
+        plans = {}
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=options['max_workers']) as executor:
+        for title in tables:
+            if response is None and not has_watermark(title, watermarks):
+                response = get_file_info_in_bucket(bucketname)
+            most_recent_readings = get_most_recent_readings(
+                title, bucketname, watermarks, response)
+            plan = plans.get(title[0])
+            key_ranges = plan.get('ranges', [None]) if plan else [None]
+            futures[title[0]] = [
+                executor.submit(
+                    extract_table, pool, title, most_recent_readings,
+                    bucketname, get_table_options(options, plan), s3_client,
+                    run_id, deadline, snapshot_id, key_range, part)
+                for part, key_range in enumerate(key_ranges)]
+
+    results = {}
+    for key, table_futures in futures.items():
+        try:
+            outcomes = [future.result() for future in table_futures]
+            summary = combine_summaries(
+                [outcome['summary'] for outcome in outcomes])
+        except Exception as error:
+            logger.error(f"ERROR EXTRACTING TABLE {key}: {error}")
+            results[key] = {'status': 'failed', 'error': str(error)}
+            if len(table_futures) > 1:
+                # Don't leave the ranges that did finish behind
+                for part in range(len(table_futures)):
+                    s3_client.delete_object(
+                        Bucket=bucketname,
+                        Key=make_part_key(key, run_id, part))
+        else:
+            print(key, "is not new" if summary is None else "is newer")
+            results[key] = {
+                'status': 'ok',
+                'summary': summary,
+                'seconds': sum(outcome['seconds'] for outcome in outcomes)
+            }
+    return results
+
+
+def setup_replication(conn, tables, slot=REPLICATION_SLOT,
+                      publication=PUBLICATION):
+    """
+    Publishes the tables and creates the logical replication slot that
+    mode='cdc' reads. Tables without a primary key get REPLICA IDENTITY
+    FULL, without which Postgres refuses updates and deletes on
+    published tables. Needs a role that owns the tables
+    """
+    dbcur = conn.cursor()
+    try:
+        dbcur.execute(
+            "SELECT 1 FROM pg_publication WHERE pubname = %s;",
+            (publication,))
+        if not dbcur.fetchall():
+            for title in tables:
+                dbcur.execute(
+                    """SELECT 1 FROM pg_index
+                    WHERE indrelid = %s::regclass AND indisprimary;""",
+                    (title[0],))
+                if not dbcur.fetchall():
+                    dbcur.execute(
+                        f'ALTER TABLE {title[0]} REPLICA IDENTITY FULL')
+            names = ', '.join(title[0] for title in tables)
+            dbcur.execute(
+                f'CREATE PUBLICATION {publication} FOR TABLE {names}')
+            # A slot can't be made in a transaction that has written
+            conn.commit()
+
+        dbcur.execute(
+            "SELECT 1 FROM pg_replication_slots WHERE slot_name = %s;",
+            (slot,))
+        if not dbcur.fetchall():
+            dbcur.execute(
+                "SELECT pg_create_logical_replication_slot(%s, 'pgoutput');",
+                (slot,))
+        conn.commit()
+    except Exception as error:
+        conn.rollback()
+        raise Exception(f"ERROR SETTING UP REPLICATION: {error}") from error
+    finally:
+        dbcur.close()
+
+
+def drop_replication(conn, slot=REPLICATION_SLOT, publication=PUBLICATION):
+    """
+    Drops the replication slot, so the database stops keeping WAL for
+    it, and the publication
+    """
+    dbcur = conn.cursor()
+    dbcur.execute(
+        """SELECT pg_drop_replication_slot(slot_name)
+        FROM pg_replication_slots WHERE slot_name = %s;""", (slot,))
+    dbcur.execute(f'DROP PUBLICATION IF EXISTS {publication}')
+    conn.commit()
+    dbcur.close()
+
+
+def check_replication_slot(dbcur, slot=REPLICATION_SLOT):
+    """
+    Checks if the replication slot exists
+    """
+    dbcur.execute(
+        "SELECT 1 FROM pg_replication_slots WHERE slot_name = %s;", (slot,))
+    return len(dbcur.fetchall()) > 0
+
+
+def get_replication_changes(dbcur, slot=REPLICATION_SLOT,
+                            publication=PUBLICATION, max_changes=MAX_CHANGES):
+    """
+    Reads the pgoutput messages waiting in the slot without consuming
+    them. Whole transactions are returned, stopping at the first commit
+    after max_changes changes
+    """
+    sql = """SELECT lsn::text, data
+    FROM pg_logical_slot_peek_binary_changes(
+        %s, NULL, %s, 'proto_version', '1', 'publication_names', %s);"""
+    try:
+        dbcur.execute(sql, (slot, max_changes, publication))
+        return dbcur.fetchall()
+    except Exception as error:
+        raise Exception(f"ERROR READING REPLICATION SLOT: {error}") from error
+
+
+def advance_replication_slot(dbcur, lsn, slot=REPLICATION_SLOT):
+    """
+    Moves the slot past lsn, so the changes up to it are not read again
+    and the database can recycle their WAL
+    """
+    dbcur.execute(
+        "SELECT pg_replication_slot_advance(%s, %s::pg_lsn);", (slot, lsn))
+
+
+def read_pgoutput_string(data, offset):
+    """
+    Reads a null-terminated string from a pgoutput message
+    """
+    end = data.index(b'\0', offset)
+    return data[offset:end].decode(), end + 1
+
+
+def read_pgoutput_tuple(data, offset):
+    """
+    Reads the column values of a pgoutput TupleData as text,
+    with None for nulls and unchanged TOASTed values
+    """
+    (count,) = struct.unpack_from('!h', data, offset)
+    offset += 2
+    values = []
+    for _ in range(count):
+        kind = data[offset:offset + 1]
+        offset += 1
+        if kind == b't':
+            (length,) = struct.unpack_from('!i', data, offset)
+            offset += 4
+            values.append(data[offset:offset + length].decode())
+            offset += length
+        else:
+            values.append(None)
+    return values, offset
+
+
+def decode_pgoutput(messages, relations=None):
+    """
+    Decodes pgoutput messages into the inserted, updated and deleted
+    rows of each table, as text values. Deletes carry the old row, all
+    of it under REPLICA IDENTITY FULL. A truncated table drops the
+    changes read before it and is marked truncated. Returns the changes
+    by table and the end LSN of the last transaction, or None if there
+    was none
+    """
+    if relations is None:
+        relations = {}
+    changes = {}
+    end_lsn = None
+    for lsn, data in messages:
+        data = bytes(data)
+        kind = data[:1]
+        if kind == b'R':
+            (relation_id,) = struct.unpack_from('!I', data, 1)
+            # The schema name comes before the table name
+            _, offset = read_pgoutput_string(data, 5)
+            name, offset = read_pgoutput_string(data, offset)
+            (count,) = struct.unpack_from('!h', data, offset + 1)
+            offset += 3
+            columns = []
+            for _ in range(count):
+                column, offset = read_pgoutput_string(data, offset + 1)
+                (type_oid,) = struct.unpack_from('!I', data, offset)
+                columns.append((column, type_oid))
+                offset += 8
+            relations[relation_id] = (name, columns)
+        elif kind in (b'I', b'U', b'D'):
+            (relation_id,) = struct.unpack_from('!I', data, 1)
+            offset = 5
+            if kind == b'U' and data[offset:offset + 1] in (b'K', b'O'):
+                # Skip the old row, the new one follows it
+                _, offset = read_pgoutput_tuple(data, offset + 1)
+            values, offset = read_pgoutput_tuple(data, offset + 1)
+            name, columns = relations[relation_id]
+            table = changes.setdefault(
+                name, {'columns': columns, 'rows': [], 'changes': []})
+            if table['columns'] != columns:
+                raise Exception(
+                    f"ERROR DECODING CHANGES: {name} changed its columns")
+            table['rows'].append(values)
+            table['changes'].append(
+                ({b'I': 'insert', b'U': 'update', b'D': 'delete'}[kind], lsn))
+        elif kind == b'T':
+            # The relation count and options come before their ids
+            (count,) = struct.unpack_from('!i', data, 1)
+            for relation_id in struct.unpack_from(f'!{count}I', data, 6):
+                name, columns = relations[relation_id]
+                changes[name] = {
+                    'columns': columns, 'rows': [], 'changes': [],
+                    'truncated': True}
+        elif kind == b'C':
+            (end,) = struct.unpack_from('!Q', data, 10)
+            end_lsn = f'{end >> 32:X}/{end & 0xFFFFFFFF:X}'
+    return changes, end_lsn
+
+
+def changes_to_table(columns, rows, changes):
+    """
+    Converts the text values of a table's changes into a typed Arrow
+    table, adding what each change was and the LSN it was made at
+    """
+    schema = description_to_schema(columns)
+    if rows:
+        values = zip(*rows)
+    else:
+        values = [[] for _ in schema]
+    arrays = []
+    for column, field in zip(values, schema):
+        array = pa.array(column, pa.string())
+        if pa.types.is_boolean(field.type):
+            array = pc.equal(array, 't')
+        elif not pa.types.is_string(field.type):
+            array = array.cast(field.type)
+        arrays.append(array)
+    change_types, lsns = zip(*changes) if changes else ([], [])
+    arrays += [
+        pa.array(change_types, pa.string()), pa.array(lsns, pa.string())]
+    names = schema.names + ['change_type', 'change_lsn']
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def delete_table_parts(bucketname, table, s3_client=None):
+    """
+    Deletes every part of a table from the bucket, the legacy
+    {table}.parquet included, and returns how many there were
+    """
+    if s3_client is None:
+        s3_client = get_client('s3')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    deleted = 0
+    try:
+        for page in paginator.paginate(
+                Bucket=bucketname, Prefix=f'table={table}/'):
+            keys = [{'Key': file['Key']} for file in page.get('Contents', [])]
+            if keys:
+                s3_client.delete_objects(
+                    Bucket=bucketname, Delete={'Objects': keys})
+                deleted += len(keys)
+        s3_client.delete_object(Bucket=bucketname, Key=f'{table}.parquet')
+    except Exception as error:
+        raise Exception(
+            f"ERROR DELETING PARTS OF {table}: {error}") from error
+    logger.warning(f"{table} was truncated, deleted its {deleted} parts")
+    return deleted
+
+
+def cdc_to_cloud(conn, bucketname, options=None, s3_client=None, run_id=None,
+                 slot=REPLICATION_SLOT, publication=PUBLICATION):
+    """
+    Pushes the changes waiting in the replication slot, max_changes at a
+    time, as parts of each changed table. The slot only moves on once a
+    batch is in the bucket, so a failed run reads the same changes again.
+    A truncated table has every part pushed before the truncate deleted,
+    so transform reads only the rows written since; outputs built from
+    it incrementally need a full transform run.
+    Returns the summaries of the tables that were pushed
+    """
+    if options is None:
+        options = DEFAULT_OPTIONS
+    if run_id is None:
+        run_id = make_run_id()
+    dbcur = conn.cursor()
+    relations = {}
+    parts = {}
+    summaries = {}
+    try:
+        while True:
+            messages = get_replication_changes(
+                dbcur, slot, publication, options['max_changes'])
+            changes, end_lsn = decode_pgoutput(messages, relations)
+            if end_lsn is None:
+                break
+            for name, change in changes.items():
+                if change.get('truncated'):
+                    # Every row pushed so far is gone from the table
+                    delete_table_parts(bucketname, name, s3_client)
+                    parts[name] = 0
+                    summaries.pop(name, None)
+                    if not change['rows']:
+                        continue
+                values = changes_to_table(
+                    change['columns'], change['rows'], change['changes'])
+                part = parts.get(name, 0)
+                upload_parquet(
+                    values, bucketname, make_part_key(name, run_id, part),
+                    s3_client)
+                parts[name] = part + 1
+                summaries.setdefault(name, []).append(values)
+                print(name, len(change['rows']), "changes")
+            advance_replication_slot(dbcur, end_lsn, slot)
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        dbcur.close()
+    return {
+        name: summarise_update(pa.concat_tables(values))
+        for name, values in summaries.items()}
+
+
+def push_to_cloud(local_object, bucketname, run_id=None, part=0):
+    """
+    Subfunction that pushes local_object to the cloud as a new part
+    of its table, leaving the parts from earlier runs in place
+    """
+    # seperate key and value from object
+    key = [key for key in local_object.keys()][0]
+    values = local_object[key]
+
+    if run_id is None:
+        run_id = make_run_id()
+    # use key for file name, and value as the content for the file
+    return upload_parquet(values, bucketname, make_part_key(key, run_id, part))
+
+
+def add_updates(updates, bucketname, run_id=None):
+    """
+    Iterates through the list of dicts that need to be updated
+    and push to the cloud, all under the same run
+    """
+    if run_id is None:
+        run_id = make_run_id()
+    for local_object in updates:
+        push_to_cloud(local_object, bucketname, run_id)
+
+
+def pipeline_each_table(tables, dbcur, bucketname, watermarks, options=None,
+                        run_id=None, plans=None, timings=None, response=None):
+    """
+    Pipelined version of check_each_table and add_updates: the tables
+    are queried one after another while upload_workers threads push the
+    ones already read, with at most PIPELINE_DEPTH tables waiting in
+    between. Each table is let go of as soon as it is pushed, so peak
+    memory is a few tables rather than all of them.
+    A failed upload does not stop the others, as in parallel mode.
+    Returns the summaries of the tables that were pushed and the names
+    of those that failed to be, for their marks to stay put
+    """
+    if options is None:
+        options = DEFAULT_OPTIONS
+    if run_id is None:
+        run_id = make_run_id()
+    uploads = queue.Queue(maxsize=PIPELINE_DEPTH)
+    summaries = {}
+    errors = []
+
+    def upload():
+        while True:
+            update = uploads.get()
+            if update is None:
+                return
+            key = list(update)[0]
+            try:
+                push_to_cloud(update, bucketname, run_id)
+                summaries[key] = summarise_update(update[key])
+            except Exception as error:
+                logger.error(f"ERROR UPLOADING TABLE {key}: {error}")
+                errors.append(key)
+            update = None
+
+    workers = [
+        threading.Thread(target=upload)
+        for _ in range(options['upload_workers'])]
+    for worker in workers:
+        worker.start()
+    try:
+        for update in iter_each_table(
+                tables, dbcur, bucketname, watermarks,
+                options['snapshot_method'], plans, timings, response):
+            uploads.put(update)
+            update = None
+    finally:
+        # One stop sign per worker, after the tables already queued
+        for _ in workers:
+            uploads.put(None)
+        for worker in workers:
+            worker.join()
+
+    return summaries, errors
+
+
+def get_deadline(context):
+    """
+    Returns the time.monotonic() by which a run should stop starting
+    new work, or None when not running inside a Lambda
+    """
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    remaining = context.get_remaining_time_in_millis() / 1000
+    return time.monotonic() + remaining - DEADLINE_MARGIN
+
+
+def index(dotenv_path_string, options=None, deadline=None):
+    """
+    Integrates all subfunctions to connect to AWS RDS,
+    find a list of table names, iterate through them
+    to evaluate whether there any updates to make.
+
+    if so, return a list of all neccessary updates
+    as Arrow tables,
+    if not exit the programme.
+
+    options (see DEFAULT_OPTIONS) picks how:
+    mode='stream' writes each table to the bucket in batches
+    of fetch_size rows instead of holding it all in memory.
+    mode='pipeline' pushes each table while the next is queried.
+    mode='parallel' streams up to max_workers tables at once, all
+    from one snapshot exported by the first connection, splitting
+    tables of more than rows_per_split rows into key ranges.
+    snapshot_method='copy' reads tables extracted for the first time
+    with COPY TO STDOUT rather than row by row, and
+    snapshot_method='keyset' backfills them page_size rows at a time,
+    resuming from a checkpoint if a run stops before the deadline;
+    tables with no index on their key column are read with a cursor.
+    mode='cdc' pushes the inserts, updates and deletes waiting in a
+    logical replication slot instead of polling the timestamps.
+    The first cdc run creates the slot and streams the tables.
+    skip_unchanged leaves out the tables whose pg_stat_user_tables
+    counts have not moved since the last run.
+    Each table's snapshot method, key ranges and fetch size are planned
+    by plan_extract, overridden by options['plan'], warning about the
+    overrides the mode can't apply, and the plan is written to the bucket.
+    """
+    if options is None:
+        options = DEFAULT_OPTIONS
+    if options['mode'] not in MODES:
+        logger.warning(
+            f"Unknown mode {options['mode']!r}, running in batch mode, "
+            f"expected one of {', '.join(MODES)}")
+    if options['mode'] in ('batch', 'pipeline') and \
+            options['snapshot_method'] == 'keyset':
+        raise ValueError(
+            "keyset backfills push each page as they go, "
+            "use mode 'stream' or 'parallel'")
+
+    # connect to AWS RDS
+    conn = make_connection(dotenv_path_string)
+    try:
+        dbcur = conn.cursor()
+
+        # get bucket name
+        bucketname = get_bucket_name('scrumptious-squad-in-data-')
+
+        # Executes SQL query for finding a list of table names inside RDS
+        # and store it in tables variable
+        tables = get_titles(dbcur)
+
+        # Read the high-water marks once for the whole run
+        run_id = make_run_id()
+        watermarks = get_watermarks(bucketname)
+
+        # Only query the tables written to since the last run
+        table_stats = get_table_stats(dbcur)
+        if options['skip_unchanged']:
+            changed = get_changed_tables(tables, table_stats, watermarks)
+        else:
+            changed = tables
+
+        failed = []
+        timings = {}
+        read_slot = options['mode'] == 'cdc' and check_replication_slot(dbcur)
+        response = None
+        if not read_slot:
+            # List the bucket once for the whole run,
+            # and only if a table has no watermark to read from
+            if not all(has_watermark(title, watermarks) for title in changed):
+                response = get_file_info_in_bucket(bucketname)
+            # Choose how to read each table, then show how
+            plans = plan_extract(changed, dbcur, watermarks, response, options)
+            check_plan_overrides(plans, options['mode'])
+            if options['mode'] == 'parallel':
+                for title in changed:
+                    plans[title[0]]['ranges'] = plan_key_ranges(
+                        dbcur, title, plans[title[0]]['splits'])
+            put_plan(plans, bucketname, run_id, options['mode'])
+
+        if read_slot:
+            dbcur.close()
+            summaries = cdc_to_cloud(conn, bucketname, options, run_id=run_id)
+            changed = []
+        elif options['mode'] == 'parallel':
+            dbcur.close()
+            # The workers read as of this connection's snapshot
+            # for as long as it stays open
+            snapshot_id = export_snapshot(conn)
+            tasks = sum(len(plan['ranges']) for plan in plans.values())
+            pool = make_connection_pool(
+                dotenv_path_string, max(1, min(options['max_workers'], tasks)))
+            try:
+                results = extract_tables_in_parallel(
+                    changed, pool, bucketname, watermarks, options, run_id,
+                    deadline, snapshot_id, plans, response)
+            finally:
+                close_connection_pool(pool)
+            summaries = {
+                key: result['summary'] for key, result in results.items()
+                if result['status'] == 'ok' and result['summary'] is not None}
+            timings = {
+                key: result['seconds'] for key, result in results.items()
+                if result['status'] == 'ok'}
+            failed = [
+                key for key, result in results.items()
+                if result['status'] == 'failed']
+        elif options['mode'] in ('stream', 'cdc'):
+            if options['mode'] == 'cdc':
+                # Changes from here on wait in the slot for the next run,
+                # this run brings the tables up to date
+                setup_replication(conn, tables)
+            summaries = stream_each_table(
+                changed, dbcur, bucketname, watermarks, options, run_id,
+                deadline, plans, timings, response)
+            dbcur.close()
+        elif options['mode'] == 'pipeline':
+            summaries, failed = pipeline_each_table(
+                changed, dbcur, bucketname, watermarks, options, run_id, plans,
+                timings, response)
+            dbcur.close()
+        else:
+            # Iterates through the table_names and checks for
+            #  any values which need to updated,
+            # storing them in the 'updates' variable.
+            updates = check_each_table(
+                changed, dbcur, bucketname, watermarks,
+                options['snapshot_method'], plans, timings, response)
+            dbcur.close()
+
+            add_updates(updates, bucketname, run_id)
+            summaries = summarise_updates(updates)
+    finally:
+        # Ends the open transaction, and with it any exported snapshot
+        # or cursor, rather than leaving it idle until the process ends
+        close_connection(conn)
+
+    # Only move the marks on once every update is in the bucket
+    watermarks = update_watermarks(watermarks, summaries, run_id)
+    watermarks = update_table_stats(watermarks, table_stats, [
+        title for title in changed if title[0] not in failed], timings)
+    put_watermarks(watermarks, bucketname)
+
+    if failed:
+        raise Exception(f"ERROR EXTRACTING TABLES: {', '.join(failed)}")
+
+
+# Lambda handler
+def extract_lambda_handler(event, context=None):
+    """
+    Fully integrated all subfunctions
+    """
+    reset_cache_stats()
+    try:
+        index(
+            event['dotenv_path_string'],
+            get_extract_options(event),
+            get_deadline(context)
+        )
+    finally:
+        report_cache_stats('extract')
     logger.info("Completed")
     print("done")
     print(context)
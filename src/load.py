@@ -6,7 +6,10 @@ and load to data warehouse
 import io
 import json
 import logging
+import threading
+import time
 import boto3
+import pandas as pd
 import pyarrow.parquet as pq
 from botocore.exceptions import ClientError
 from sqlalchemy import create_engine
@@ -14,12 +17,111 @@ from sqlalchemy import create_engine
 logger = logging.getLogger('mylogger')
 logger.setLevel(logging.INFO)
 
+# Clients, bucket names and secrets kept between warm invocations
+# of the Lambda, with how many seconds each kind stays fresh
+CACHE_TTLS = {'client': 3600, 'bucket_name': 3600, 'secret': 900}
+cache = {}
+cache_lock = threading.RLock()
+# Held while a value is made, one per kind and key
+key_locks = {}
+cache_stats = {kind: {'hits': 0, 'misses': 0} for kind in CACHE_TTLS}
+
+
+def get_cached_entry(kind, key):
+    """
+    Returns the fresh cached value of one kind for key, counting the
+    hit, or None. Only call it holding cache_lock
+    """
+    entry = cache.get((kind, key))
+    if entry is not None and \
+            time.monotonic() - entry[1] < CACHE_TTLS[kind]:
+        cache_stats[kind]['hits'] += 1
+        return entry[0]
+    return None
+
+
+def get_cached(kind, key, make):
+    """
+    Returns the cached value of one kind for key, calling make() to
+    fill it in when it is missing or older than CACHE_TTLS[kind].
+    None is never cached, so a missing bucket is looked for again.
+
+    make() runs under a lock of its own key only, so threads filling
+    other keys or reading fresh ones never wait on it, and threads
+    after the same key wait for its value rather than making it again
+    """
+    with cache_lock:
+        value = get_cached_entry(kind, key)
+        if value is not None:
+            return value
+        key_lock = key_locks.setdefault((kind, key), threading.RLock())
+    with key_lock:
+        with cache_lock:
+            # Filled while this thread waited for the key
+            value = get_cached_entry(kind, key)
+            if value is not None:
+                return value
+            cache_stats[kind]['misses'] += 1
+        value = make()
+        if value is not None:
+            with cache_lock:
+                cache[(kind, key)] = (value, time.monotonic())
+        return value
+
+
+def invalidate_cache(kind=None, key=None):
+    """
+    Drops the cached values of one kind, or one key of it,
+    or everything if no kind is given
+    """
+    with cache_lock:
+        for cached_kind, cached_key in list(cache):
+            if kind in (None, cached_kind) and key in (None, cached_key):
+                del cache[(cached_kind, cached_key)]
+
+
+def reset_cache_stats():
+    """
+    Zeroes the hit and miss counts, at the start of an invocation
+    """
+    with cache_lock:
+        for counts in cache_stats.values():
+            counts['hits'] = counts['misses'] = 0
+
+
+def report_cache_stats(stage):
+    """
+    Logs the cache hits and misses of each kind since the last reset
+    """
+    with cache_lock:
+        stats = {kind: dict(counts) for kind, counts in cache_stats.items()}
+    logger.info(f"{stage} cache hits/misses: " + ', '.join(
+        f"{kind} {counts['hits']}/{counts['misses']}"
+        for kind, counts in stats.items()))
+    return stats
+
+
+def get_client(service):
+    """
+    Returns the shared boto3 client for a service. Clients are
+    thread-safe once made, but making them is not, hence the lock
+    """
+    return get_cached('client', service, lambda: boto3.client(service))
+
 
 def pull_secrets(secret_id):
+    """
+    Retrieves the secret from SecretManager,
+    at most once per CACHE_TTLS['secret'] seconds
+    """
+    return get_cached('secret', secret_id, lambda: fetch_secrets(secret_id))
+
+
+def fetch_secrets(secret_id):
     """
     Retrieves the secret from SecretManager
     """
-    secret_manager = boto3.client("secretsmanager")
+    secret_manager = get_client("secretsmanager")
     try:
         response = secret_manager.get_secret_value(SecretId=secret_id)
     except ClientError as error:
@@ -34,10 +136,19 @@ def pull_secrets(secret_id):
 def get_bucket_name(bucket_prefix):
     """
     Returns the name of the first S3 bucket that matches the given prefix
-    Returns None if no matching bucket is found or an error occurs
+    Returns None if no matching bucket is found or an error occurs.
+    Found names are cached
+    """
+    return get_cached(
+        'bucket_name', bucket_prefix, lambda: find_bucket_name(bucket_prefix))
+
+
+def find_bucket_name(bucket_prefix):
+    """
+    Lists the buckets for the first one named with bucket_prefix
     """
     try:
-        s3_client = boto3.client('s3')
+        s3_client = get_client('s3')
         response = s3_client.list_buckets()
 
         for bucket in response.get('Buckets', []):
@@ -54,22 +165,36 @@ def get_data(bucket_prefix):
     Returns the dictionary of the retrieved files
     """
     try:
-        s3_client = boto3.client('s3')
         bucket_name = get_bucket_name(bucket_prefix)
 
         if not bucket_name:
             return []
-        s3_client = boto3.client('s3')
-        objects = s3_client.list_objects_v2(
-            Bucket=bucket_name)['Contents']
+        s3_client = get_client('s3')
+        # Incremental runs add a part per fact per run, past the
+        # 1000 keys one listing call returns
+        paginator = s3_client.get_paginator('list_objects_v2')
+        objects = [
+            obj for page in paginator.paginate(Bucket=bucket_name)
+            for obj in page.get('Contents', [])]
         dfs = {}
         for obj in objects:
             key = obj['Key']
-            filename = key.split('/')[-1].split('.')[0]
+            if not key.endswith('.parquet'):
+                # Such as the state kept by incremental transform runs
+                continue
+            path = key.split('/')
+            if path[-1].startswith('run=') and len(path) > 1:
+                # A part added by an incremental transform run
+                filename = path[-2]
+            else:
+                filename = path[-1].split('.')[0]
             obj = s3_client.get_object(Bucket=bucket_name, Key=key)
             buffer = io.BytesIO(obj['Body'].read())
             table = pq.read_table(buffer)
             data_frame = table.to_pandas()
+            if f"df_{filename}" in dfs:
+                data_frame = pd.concat(
+                    [dfs[f"df_{filename}"], data_frame], ignore_index=True)
             dfs[f"df_{filename}"] = data_frame
         return dfs
 
@@ -115,6 +240,8 @@ def load_data_to_warehouse(secret_id, bucket_prefix):
         }
     except Exception as error:
         print(f"Error loading data into the data warehouse: {str(error)}")
+        # The password may have been rotated, fetch it afresh next time
+        invalidate_cache('secret', secret_id)
         return False
 
 
@@ -122,6 +249,7 @@ def load_lambda_handler(event, context):
     """
     Fully integrated all subfunctions
     """
+    reset_cache_stats()
     try:
         # Retrieve the secret ID and bucket prefix from the event
         secret_id = event.get('secret_id')
@@ -150,3 +278,5 @@ def load_lambda_handler(event, context):
             'statusCode': 500,
             'body': f"Error: {str(error)}"
         }
+    finally:
+        report_cache_stats('load')
@@ -3,18 +3,219 @@ the transform function will change the schema of the data
 turning it into fact and dim tables
 """
 
+import hashlib
+import io
+import json
+import logging
+import resource
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
 from io import BytesIO
-import os
+import threading
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import boto3
-import numpy as np
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# S3 rejects multipart parts under 5 MiB, apart from the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+UPLOAD_PART_SIZE = 8 * 1024 * 1024
+UPLOAD_CONCURRENCY = 4
+# pa.concat_tables takes promote_options from pyarrow 14
+PYARROW_VERSION = tuple(int(part) for part in pa.__version__.split('.')[:2])
+# Least bytes fetched by each ranged read of a streamed part
+RANGE_READ_SIZE = 1024 * 1024
+# Parts of the ingested tables downloaded at once
+DOWNLOAD_WORKERS = 8
+# Loads, builds and uploads of transform() run at once
+DAG_WORKERS = 4
+
+# String columns with at most this many distinct values per row are
+# carried as pandas categoricals or Arrow dictionaries, and so written
+# as parquet dictionaries
+CATEGORY_RATIO = 0.5
+
+# Rows of an ingested fact table read, built and written at a time
+# when facts are streamed, each becoming a row group
+FACT_BATCH_SIZE = 65536
+
+# The tables transform reads from the ingested bucket
+INGESTED_TABLES = [
+    'address', 'counterparty', 'currency', 'department', 'design',
+    'payment_type', 'payment', 'purchase_order', 'sales_order', 'staff',
+    'transaction'
+]
+
+# What transform has made of the ingested parts so far, in incremental
+# mode, kept in the processed bucket
+STATE_KEY = 'transform_state.json'
+
+# The fingerprints of the inputs each output was last built from,
+# kept in the processed bucket
+FINGERPRINTS_KEY = 'transform_fingerprints.json'
+# Bump when a builder changes, so every output is built again
+TRANSFORM_VERSION = 2
+
+# The date columns of the ingested tables facts are built from,
+# every one of which dim_date must cover
+FACT_DATE_COLUMNS = {
+    'sales_order': [
+        'created_at', 'last_updated', 'agreed_payment_date',
+        'agreed_delivery_date'],
+    'purchase_order': [
+        'created_at', 'last_updated', 'agreed_payment_date',
+        'agreed_delivery_date'],
+    'payment': ['created_at', 'last_updated', 'payment_date']
+}
+# Days dim_date runs on past the latest date of the facts
+DATE_HORIZON_DAYS = 365
+
+# Settings the transform event can override
+DEFAULT_OPTIONS = {
+    'mode': 'full',
+    'skip_unchanged': True,
+    'date_horizon_days': DATE_HORIZON_DAYS,
+    'engine': 'pandas',
+    'dag_workers': DAG_WORKERS,
+    'category_ratio': CATEGORY_RATIO,
+    'stream_facts': False,
+    'batch_size': FACT_BATCH_SIZE
+}
+
+logger = logging.getLogger('MyLogger')
+logger.setLevel(logging.INFO)
+
+# Clients, bucket names and listings kept between warm invocations
+# of the Lambda, with how many seconds each kind stays fresh
+CACHE_TTLS = {
+    'client': 3600, 'bucket_name': 3600, 'listing': 300, 'dim_date': 3600}
+cache = {}
+cache_lock = threading.RLock()
+# Held while a value is made, one per kind and key
+key_locks = {}
+cache_stats = {kind: {'hits': 0, 'misses': 0} for kind in CACHE_TTLS}
+
+
+def make_s3_config():
+    """
+    Only checksums S3 requests that require it. From botocore 1.36
+    upload_part is otherwise sent as aws-chunked with a trailing
+    checksum, which moto stores undecoded
+    """
+    try:
+        return Config(
+            request_checksum_calculation='when_required',
+            response_checksum_validation='when_required')
+    except TypeError:
+        # Older botocore only checksums when required already
+        return Config()
+
+
+# Settings for the clients of each service that needs any
+CLIENT_CONFIGS = {'s3': make_s3_config()}
+
+
+def get_cached_entry(kind, key):
+    """
+    Returns the fresh cached value of one kind for key, counting the
+    hit, or None. Only call it holding cache_lock
+    """
+    entry = cache.get((kind, key))
+    if entry is not None and \
+            time.monotonic() - entry[1] < CACHE_TTLS[kind]:
+        cache_stats[kind]['hits'] += 1
+        return entry[0]
+    return None
+
+
+def get_cached(kind, key, make):
+    """
+    Returns the cached value of one kind for key, calling make() to
+    fill it in when it is missing or older than CACHE_TTLS[kind].
+    None is never cached, so a missing bucket is looked for again.
+
+    make() runs under a lock of its own key only, so threads filling
+    other keys or reading fresh ones never wait on it, and threads
+    after the same key wait for its value rather than making it again
+    """
+    with cache_lock:
+        value = get_cached_entry(kind, key)
+        if value is not None:
+            return value
+        key_lock = key_locks.setdefault((kind, key), threading.RLock())
+    with key_lock:
+        with cache_lock:
+            # Filled while this thread waited for the key
+            value = get_cached_entry(kind, key)
+            if value is not None:
+                return value
+            cache_stats[kind]['misses'] += 1
+        value = make()
+        if value is not None:
+            with cache_lock:
+                cache[(kind, key)] = (value, time.monotonic())
+        return value
+
+
+def invalidate_cache(kind=None, key=None):
+    """
+    Drops the cached values of one kind, or one key of it,
+    or everything if no kind is given
+    """
+    with cache_lock:
+        for cached_kind, cached_key in list(cache):
+            if kind in (None, cached_kind) and key in (None, cached_key):
+                del cache[(cached_kind, cached_key)]
+
+
+def reset_cache_stats():
+    """
+    Zeroes the hit and miss counts, at the start of an invocation
+    """
+    with cache_lock:
+        for counts in cache_stats.values():
+            counts['hits'] = counts['misses'] = 0
+
+
+def report_cache_stats(stage):
+    """
+    Logs the cache hits and misses of each kind since the last reset
+    """
+    with cache_lock:
+        stats = {kind: dict(counts) for kind, counts in cache_stats.items()}
+    logger.info(f"{stage} cache hits/misses: " + ', '.join(
+        f"{kind} {counts['hits']}/{counts['misses']}"
+        for kind, counts in stats.items()))
+    return stats
+
+
+def get_client(service):
+    """
+    Returns the shared boto3 client for a service. Clients are
+    thread-safe once made, but making them is not, hence the lock
+    """
+    return get_cached('client', service, lambda: boto3.client(
+        service, config=CLIENT_CONFIGS.get(service)))
 
 
 def get_bucket_name(bucket_prefix):
     """
-    Get the right bucket
+    Get the right bucket, cached once found
     """
-    s3_client = boto3.client('s3')
+    return get_cached(
+        'bucket_name', bucket_prefix, lambda: find_bucket_name(bucket_prefix))
+
+
+def find_bucket_name(bucket_prefix):
+    """
+    Lists the buckets for the first one named with bucket_prefix
+    """
+    s3_client = get_client('s3')
     response = s3_client.list_buckets()
 
     for bucket in response['Buckets']:
@@ -22,25 +223,285 @@ def get_bucket_name(bucket_prefix):
             return bucket['Name']
 
 
-def get_parquet(title):
+def parse_part_key(key):
+    """
+    Splits a part key written by extract into its table,
+    extracted_date, run and part
+    """
+    table, extracted_date, run, part = key.split('/')
+    return {
+        'table': table.split('=', 1)[1],
+        'extracted_date': extracted_date.split('=', 1)[1],
+        'run': run.split('=', 1)[1],
+        'part': int(part[len('part-'):-len('.parquet')])
+    }
+
+
+def get_table_keys(title, keys, latest_only=False):
+    """
+    Picks out the keys of a table's parts in the order they were written.
+    A {title}.parquet from before the partitioned layout counts as the
+    oldest part. With latest_only, only the parts of the newest run
+    that wrote it
+    """
+    parts = [
+        key for key in keys
+        if key.startswith(f'table={title}/') and key.endswith('.parquet')]
+    parts.sort(key=lambda key: (
+        parse_part_key(key)['run'], parse_part_key(key)['part']))
+    if not parts:
+        # From before extract wrote partitioned parts
+        return [f'{title}.parquet'] if f'{title}.parquet' in keys else []
+    if latest_only:
+        latest_run = parse_part_key(parts[-1])['run']
+        return [
+            key for key in parts if parse_part_key(key)['run'] == latest_run]
+    if f'{title}.parquet' in keys:
+        parts.insert(0, f'{title}.parquet')
+    return parts
+
+
+def get_bucket_objects(bucketname):
+    """
+    Lists every key in the bucket with its ETag and Size, once per
+    invocation: transform() drops the cached listing before it starts
+    reading
+    """
+    def list_objects():
+        paginator = get_client('s3').get_paginator('list_objects_v2')
+        return {
+            file['Key']: {'ETag': file['ETag'], 'Size': file['Size']}
+            for page in paginator.paginate(Bucket=bucketname)
+            for file in page.get('Contents', [])}
+    return get_cached('listing', bucketname, list_objects)
+
+
+def get_bucket_keys(bucketname):
+    """
+    Lists every key in the bucket, from the cached listing
+    """
+    return list(get_bucket_objects(bucketname))
+
+
+def download_object(bucketname, key):
+    """
+    Reads one object of the bucket into memory,
+    logging its size and how long it took
+    """
+    started = time.perf_counter()
+    buffer = BytesIO()
+    get_client('s3').download_fileobj(bucketname, key, buffer)
+    logger.info(
+        f"Downloaded {key}: {buffer.getbuffer().nbytes} bytes "
+        f"in {time.perf_counter() - started:.3f}s")
+    buffer.seek(0)
+    return buffer
+
+
+def download_table(bucketname, key):
+    """
+    Reads one object of the bucket into an Arrow table
+    """
+    return pq.read_table(download_object(bucketname, key))
+
+
+def cast_to_schema(table, schema):
+    """
+    Casts the columns of an Arrow table or record batch that schema
+    also holds to their types in it, leaving any others as they are
+    """
+    for field in schema:
+        if field.name not in table.schema.names:
+            continue
+        index = table.schema.get_field_index(field.name)
+        if not table.schema.field(index).type.equals(field.type):
+            # Unsafe so floats fit the scale of the decimals they become
+            table = table.set_column(index, field.name, pc.cast(
+                table[field.name], field.type, safe=False))
+    return table
+
+
+def cast_parts(parts):
     """
-    Get files from the bucket
+    Casts every part of a table to the column types of its newest part.
+    The {title}.parquet pandas wrote before extract typed its parts
+    holds int64 ids, dates as text and numerics as floats, which would
+    not concatenate with the int32, date32 and decimal typed parts
+    """
+    if not parts:
+        return parts
+    return [cast_to_schema(part, parts[-1].schema) for part in parts]
+
+
+def download_parts(titles, latest_only=False, max_workers=DOWNLOAD_WORKERS,
+                   processed=None):
+    """
+    Lists the bucket once and downloads the parts of several tables
+    at once on max_workers threads, as Arrow tables cast to the types
+    of the newest part by cast_parts().
+
+    Returns every part of each table, oldest first, or only the parts
+    from the latest extraction that wrote it if latest_only is set.
+    Parts whose ETag matches the one recorded for their key in
+    processed are left out
     """
     bucketname = get_bucket_name('scrumptious-squad-in-data-')
-    s3_client = boto3.client('s3')
-    response = s3_client.list_objects_v2(Bucket=bucketname)
-    filename = f"{title}.parquet"
-
-    if response['KeyCount'] == 0:
-        return False
-
-    if filename in [file['Key'] for file in response['Contents']]:
-        buffer = BytesIO()
-        client = boto3.resource('s3')
-        client_object = client.Object(bucketname, filename)
-        client_object.download_fileobj(buffer)
-        data_frame = pd.read_parquet(buffer)
+    objects = get_bucket_objects(bucketname)
+    table_keys = {
+        title: get_table_keys(title, list(objects), latest_only)
+        for title in titles}
+    if processed is not None:
+        table_keys = {
+            title: [
+                key for key in keys
+                if processed.get(key) != objects[key]['ETag']]
+            for title, keys in table_keys.items()}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        downloads = {
+            key: executor.submit(download_table, bucketname, key)
+            for title in titles for key in table_keys[title]}
+    return {
+        title: cast_parts(
+            [downloads[key].result() for key in table_keys[title]])
+        for title in titles}
+
+
+def get_current_rows(data_frame, title):
+    """
+    Keeps the latest version of each row of an ingested table,
+    whose parts hold every version in the order it was extracted
+    """
+    if data_frame is False or f'{title}_id' not in data_frame:
         return data_frame
+    return data_frame.drop_duplicates(
+        f'{title}_id', keep='last').reset_index(drop=True)
+
+
+def get_current_rows_arrow(table, title):
+    """
+    get_current_rows() for an Arrow table
+    """
+    if f'{title}_id' not in table.column_names:
+        return table
+    positions = table.append_column(
+        '__row', pa.array(np.arange(table.num_rows, dtype='int64'))
+    ).group_by(f'{title}_id', use_threads=False).aggregate(
+        [('__row', 'max')])['__row_max']
+    return table.take(np.sort(positions.to_numpy()))
+
+
+def get_parquets(titles, latest_only=False, max_workers=DOWNLOAD_WORKERS,
+                 processed=None, keep_deleted=False):
+    """
+    Get the files of several tables from the bucket, as download_parts()
+    reads them, keeping the latest version of each row, and leaving
+    out the rows cdc parts deleted unless keep_deleted.
+
+    Returns each table as a DataFrame, or as False if it has no parts
+    """
+    parts = download_parts(titles, latest_only, max_workers, processed)
+    data_frames = {}
+    for title in titles:
+        if not parts[title]:
+            data_frames[title] = False
+            continue
+        data_frame = get_current_rows(pd.concat(
+            [part.to_pandas() for part in parts[title]], ignore_index=True),
+            title)
+        if 'change_type' in data_frame and not keep_deleted:
+            # Parts from extract's cdc mode also hold the deleted rows
+            data_frame = data_frame[data_frame.change_type != 'delete']
+            data_frame = data_frame.reset_index(drop=True)
+        data_frames[title] = data_frame
+    return data_frames
+
+
+def concat_parts(tables):
+    """
+    Concatenates the Arrow parts of a table, with nulls for the columns
+    only some of them hold. From pyarrow 14, types that widen to one
+    another are merged too, such as int32 and int64 ids
+    """
+    if PYARROW_VERSION >= (14, 0):
+        return pa.concat_tables(tables, promote_options='permissive')
+    # Older pyarrow only fills in missing columns, so the parts must
+    # share their types already, as cast_parts() sees to
+    return pa.concat_tables(tables, promote=True)
+
+
+def get_tables(titles, latest_only=False, max_workers=DOWNLOAD_WORKERS):
+    """
+    get_parquets() for the Arrow engine, returning each table
+    as a pyarrow Table, or as False if it has no parts
+    """
+    parts = download_parts(titles, latest_only, max_workers)
+    tables = {}
+    for title in titles:
+        if not parts[title]:
+            tables[title] = False
+            continue
+        table = concat_parts(parts[title])
+        tables[title] = drop_deleted_rows(
+            get_current_rows_arrow(table, title))
+    return tables
+
+
+def drop_deleted_rows(table):
+    """
+    Drops the deleted rows that parts from extract's cdc mode
+    also hold out of an Arrow table or record batch
+    """
+    if 'change_type' not in table.schema.names:
+        return table
+    return table.filter(pc.fill_null(
+        pc.not_equal(table['change_type'], 'delete'), True))
+
+
+def get_parquet(title, latest_only=False):
+    """
+    Get files from the bucket.
+
+    Reads the latest version of every row of the table, or only the
+    rows from the latest extraction that wrote it with latest_only
+    """
+    return get_parquets([title], latest_only)[title]
+
+
+def get_low_cardinality_columns(values, ratio=CATEGORY_RATIO):
+    """
+    Picks the string columns of a DataFrame or an Arrow table with at
+    most ratio distinct values per row
+    """
+    limit = ratio * len(values)
+    if isinstance(values, pa.Table):
+        return [
+            field.name for field in values.schema
+            if (pa.types.is_string(field.type)
+                or pa.types.is_large_string(field.type))
+            and pc.count_distinct(values[field.name]).as_py() <= limit]
+    return [
+        column for column in values.columns
+        if pd.api.types.infer_dtype(values[column]) == 'string'
+        and values[column].nunique() <= limit]
+
+
+def encode_categories(values, ratio=CATEGORY_RATIO):
+    """
+    Carries the low-cardinality string columns of a DataFrame as
+    categoricals, or of an Arrow table as dictionary arrays.
+    A ratio of None leaves every column as it is
+    """
+    if ratio is None or values is False or not len(values):
+        return values
+    columns = get_low_cardinality_columns(values, ratio)
+    if isinstance(values, pa.Table):
+        for column in columns:
+            values = values.set_column(
+                values.schema.get_field_index(column), column,
+                values[column].dictionary_encode())
+        return values
+    return values.astype({column: 'category' for column in columns})
 
 
 def create_dim_date(start_date, end_date):
@@ -61,178 +522,582 @@ def create_dim_date(start_date, end_date):
     return dim_date
 
 
+# What each dim is made of, interpreted by build_dim(): the ingested
+# table its rows come from, tables inner joined by (table, column of
+# the rows, column of the table), so rows without a match are left
+# out as the hand-written merges did, its columns in order as
+# {dim column: source column} and columns derived by mapping the values
+# of another through a dict, with the value for anything it leaves out
+DIM_SPECS = {
+    'dim_location': {
+        'source': 'address',
+        'columns': {
+            'location_id': 'address_id',
+            'address_line_1': 'address_line_1',
+            'address_line_2': 'address_line_2',
+            'district': 'district',
+            'city': 'city',
+            'postal_code': 'postal_code',
+            'country': 'country',
+            'phone': 'phone'
+        }
+    },
+    'dim_design': {
+        'source': 'design',
+        'columns': {
+            'design_id': 'design_id',
+            'design_name': 'design_name',
+            'file_location': 'file_location',
+            'file_name': 'file_name'
+        }
+    },
+    'dim_currency': {
+        'source': 'currency',
+        'columns': {
+            'currency_id': 'currency_id',
+            'currency_code': 'currency_code'
+        },
+        'derived': {
+            'currency_name': ('currency_code', {
+                'GBP': 'British Pound Sterling',
+                'USD': 'United States Dollar',
+                'EUR': 'Euro'
+            }, '0')
+        }
+    },
+    'dim_counterparty': {
+        'source': 'counterparty',
+        'joins': [('address', 'legal_address_id', 'address_id')],
+        'columns': {
+            'counterparty_id': 'counterparty_id',
+            'counterparty_legal_name': 'counterparty_legal_name',
+            'counterparty_legal_address_line_1': 'address_line_1',
+            'counterparty_legal_address_line_2': 'address_line_2',
+            'counterparty_legal_district': 'district',
+            'counterparty_legal_city': 'city',
+            'counterparty_legal_postal_code': 'postal_code',
+            'counterparty_legal_country': 'country',
+            'counterparty_legal_phone_number': 'phone'
+        }
+    },
+    'dim_staff': {
+        'source': 'staff',
+        'joins': [('department', 'department_id', 'department_id')],
+        'columns': {
+            'staff_id': 'staff_id',
+            'first_name': 'first_name',
+            'last_name': 'last_name',
+            'department_name': 'department_name',
+            'location': 'location',
+            'email_address': 'email_address'
+        },
+        'sort': 'staff_id'
+    },
+    'dim_transaction': {
+        'source': 'transaction',
+        'columns': {
+            'transaction_id': 'transaction_id',
+            'transaction_type': 'transaction_type',
+            'sales_order_id': 'sales_order_id',
+            'purchase_order_id': 'purchase_order_id'
+        }
+    },
+    'dim_payment_type': {
+        'source': 'payment_type',
+        'columns': {
+            'payment_type_id': 'payment_type_id',
+            'payment_type_name': 'payment_type_name'
+        }
+    }
+}
+
+
+def get_spec_tables(spec):
+    """
+    Returns the ingested tables a dim spec reads, its source first
+    """
+    return [spec['source'], *[join[0] for join in spec.get('joins', [])]]
+
+
+def build_dim(spec, frames):
+    """
+    Builds a dim from its spec and the ingested tables it names.
+    Each lookup only brings the columns the dim takes from it, and the
+    columns are picked and renamed in one projection rather than
+    copied into an empty DataFrame one at a time
+    """
+    rows = frames[spec['source']]
+    for table, left_on, right_on in spec.get('joins', []):
+        lookup = frames[table]
+        columns = list(dict.fromkeys([right_on, *[
+            column for column in spec['columns'].values()
+            if column in lookup and column not in rows]]))
+        rows = rows.merge(
+            lookup[columns], how='inner', left_on=left_on, right_on=right_on)
+    dim = rows.loc[:, list(spec['columns'].values())].set_axis(
+        list(spec['columns']), axis=1, copy=False)
+    for column, derived in spec.get('derived', {}).items():
+        source_column, values, default = derived
+        source = dim[source_column]
+        if isinstance(source.dtype, pd.CategoricalDtype):
+            # Mapped once per category rather than once per row
+            dim[column] = source.map(
+                lambda value: values.get(value, default))
+        else:
+            dim[column] = source.map(values).fillna(default)
+    if 'sort' in spec:
+        dim = dim.sort_values(spec['sort'])
+    return dim.reset_index(drop=True)
+
+
 def create_dim_location(df_address):
     """
     Create dim_location
     """
-    dim_location = pd.DataFrame()
-    dim_location['location_id'] = df_address['address_id']
-    dim_location['address_line_1'] = df_address['address_line_1']
-    dim_location['address_line_2'] = df_address['address_line_2']
-    dim_location['district'] = df_address['district']
-    dim_location['city'] = df_address['city']
-    dim_location['postal_code'] = df_address['postal_code']
-    dim_location['country'] = df_address['country']
-    dim_location['phone'] = df_address['phone']
-    return dim_location
+    return build_dim(DIM_SPECS['dim_location'], {'address': df_address})
 
 
 def create_dim_design(df_design):
     """
     Create dim_design
     """
-    dim_design = pd.DataFrame()
-    dim_design['design_id'] = df_design['design_id']
-    dim_design['design_name'] = df_design['design_name']
-    dim_design['file_location'] = df_design['file_location']
-    dim_design['file_name'] = df_design['file_name']
-    return dim_design
+    return build_dim(DIM_SPECS['dim_design'], {'design': df_design})
 
 
 def create_dim_currency(df_currency):
     """
     Create dim_currency
     """
-    dim_currency = pd.DataFrame()
-    dim_currency['currency_id'] = df_currency['currency_id']
-    dim_currency['currency_code'] = df_currency['currency_code']
-    condition_1 = dim_currency['currency_code'] == 'GBP'
-    condition_2 = dim_currency['currency_code'] == 'USD'
-    condition_3 = dim_currency['currency_code'] == 'EUR'
-    conditions = [condition_1, condition_2, condition_3]
-    values = ['British Pound Sterling', 'United States Dollar', 'Euro']
-    dim_currency['currency_name'] = np.select(conditions, values)
-    return dim_currency
+    return build_dim(DIM_SPECS['dim_currency'], {'currency': df_currency})
 
 
 def create_dim_counterparty(df_a, df_c):
     """
     Create dim_counterparty
     """
-    dim_cp = pd.DataFrame()
-    a = pd.merge(df_a, df_c, left_on='address_id', right_on='legal_address_id')
-    dim_cp['counterparty_id'] = df_c['counterparty_id']
-    dim_cp['counterparty_legal_name'] = df_c['counterparty_legal_name']
-    dim_cp['counterparty_legal_address_line_1'] = a['address_line_1']
-    dim_cp['counterparty_legal_address_line_2'] = a['address_line_2']
-    dim_cp['counterparty_legal_district'] = a['district']
-    dim_cp['counterparty_legal_city'] = a['city']
-    dim_cp['counterparty_legal_postal_code'] = a['postal_code']
-    dim_cp['counterparty_legal_country'] = a['country']
-    dim_cp['counterparty_legal_phone_number'] = a['phone']
-    return dim_cp
+    return build_dim(
+        DIM_SPECS['dim_counterparty'], {'address': df_a, 'counterparty': df_c})
 
 
 def create_dim_staff(df_staff, df_department):
     """
     Create dim_staff
     """
-    dim_staff = pd.DataFrame()
-    df_stf_dep = pd.merge(df_staff, df_department, on='department_id')
-    dim_staff['staff_id'] = df_stf_dep['staff_id']
-    dim_staff['first_name'] = df_stf_dep['first_name']
-    dim_staff['last_name'] = df_stf_dep['last_name']
-    dim_staff['department_name'] = df_stf_dep['department_name']
-    dim_staff['location'] = df_stf_dep['location']
-    dim_staff['email_address'] = df_stf_dep['email_address']
-    dim_staff.sort_values('staff_id', inplace=True)
-    return dim_staff
+    return build_dim(
+        DIM_SPECS['dim_staff'],
+        {'staff': df_staff, 'department': df_department})
 
 
 def create_dim_transaction(df_transaction):
     """
     Create dim_transaction
     """
-    dim_transaction = pd.DataFrame()
-    dim_transaction['transaction_id'] = df_transaction['transaction_id']
-    dim_transaction['transaction_type'] = df_transaction['transaction_type']
-    dim_transaction['sales_order_id'] = df_transaction['sales_order_id']
-    dim_transaction['purchase_order_id'] = df_transaction['purchase_order_id']
-    return dim_transaction
+    return build_dim(
+        DIM_SPECS['dim_transaction'], {'transaction': df_transaction})
 
 
 def create_dim_payment_type(df_payment_type):
     """
     Create dim_payment_type
     """
-    dim_pt = pd.DataFrame()
-    dim_pt['payment_type_id'] = df_payment_type['payment_type_id']
-    dim_pt['payment_type_name'] = df_payment_type['payment_type_name']
-    return dim_pt
+    return build_dim(
+        DIM_SPECS['dim_payment_type'], {'payment_type': df_payment_type})
+
+
+def split_timestamp(column):
+    """
+    Splits a timestamp column into typed date and time columns,
+    cast by Arrow in one pass rather than a Series per row
+    """
+    # Postgres keeps microseconds, so nothing finer is lost
+    timestamps = pa.Array.from_pandas(pd.to_datetime(column)).cast(
+        pa.timestamp('us'), safe=False)
+    dates = timestamps.cast(pa.date32()).to_pandas()
+    times = timestamps.cast(pa.time64('us')).to_pandas()
+    dates.index = times.index = column.index
+    return dates, times
+
+
+# What each fact is made of: the ingested table its rows come from and
+# its columns in order as {fact column: source column}, where a source
+# of ('date', column) or ('time', column) is that part of a timestamp
+FACT_SPECS = {
+    'fact_sales_order': {
+        'source': 'sales_order',
+        'columns': {
+            'sales_order_id': 'sales_order_id',
+            'created_date': ('date', 'created_at'),
+            'created_time': ('time', 'created_at'),
+            'last_updated_date': ('date', 'last_updated'),
+            'last_updated_time': ('time', 'last_updated'),
+            'sales_staff_id': 'staff_id',
+            'counterparty_id': 'counterparty_id',
+            'units_sold': 'units_sold',
+            'unit price': 'unit_price',
+            'currency_id': 'currency_id',
+            'design_id': 'design_id',
+            'agreed_payment_date': 'agreed_payment_date',
+            'agreed_delivery_date': 'agreed_delivery_date',
+            'agreed_delivery_location_id': 'agreed_delivery_location_id'
+        }
+    },
+    'fact_purchase_order': {
+        'source': 'purchase_order',
+        'columns': {
+            'purchase_order_id': 'purchase_order_id',
+            'created_date': ('date', 'created_at'),
+            'created_time': ('time', 'created_at'),
+            'last_updated_date': ('date', 'last_updated'),
+            'last_updated_time': ('time', 'last_updated'),
+            'staff_id': 'staff_id',
+            'counterparty_id': 'counterparty_id',
+            'item_code': 'item_code',
+            'item_quantity': 'item_quantity',
+            'item_unit_price': 'item_unit_price',
+            'currency_id': 'currency_id',
+            'agreed_delivery_date': 'agreed_delivery_date',
+            'agreed_payment_date': 'agreed_payment_date',
+            'agreed_delivery_location_id': 'agreed_delivery_location_id'
+        }
+    },
+    'fact_payment': {
+        'source': 'payment',
+        'columns': {
+            'payment_id': 'payment_id',
+            'created_date': ('date', 'created_at'),
+            'created_time': ('time', 'created_at'),
+            'last_updated_date': ('date', 'last_updated'),
+            'last_updated': ('time', 'last_updated'),
+            'transaction_id': 'transaction_id',
+            'counterparty_id': 'counterparty_id',
+            'payment_amount': 'payment_amount',
+            'currency_id': 'currency_id',
+            'payment_type_id': 'payment_type_id',
+            'paid': 'paid',
+            'payment_date': 'payment_date'
+        }
+    }
+}
+
+
+def build_fact(spec, data_frame):
+    """
+    Builds a fact from its spec and the ingested table it names,
+    splitting each timestamp it takes apart once
+    """
+    splits = {}
+    columns = {}
+    for column, source in spec['columns'].items():
+        if isinstance(source, tuple):
+            part, source = source
+            if source not in splits:
+                splits[source] = dict(zip(
+                    ('date', 'time'), split_timestamp(data_frame[source])))
+            columns[column] = splits[source][part]
+        else:
+            columns[column] = data_frame[source]
+    return pd.DataFrame(columns)
 
 
 def create_fact_sales_order(df_s):
     """
     Create fact_sales_order
     """
-    fact_s = pd.DataFrame()
-    # fact_s.insert(0, "sales_record_id", range(1, 1 + len(df_s)))
-    fact_s["sales_order_id"] = df_s["sales_order_id"]
-    fact_s[["created_date", "created_time"]] = df_s["created_at"].apply(
-        lambda x: pd.Series(str(x).split(" ")))
-    str1 = "last_updated_date"
-    str2 = "last_updated_time"
-    fact_s[[str1, str2]] = df_s["last_updated"].apply(
-        lambda x: pd.Series(str(x).split(" ")))
-    fact_s["sales_staff_id"] = df_s["staff_id"]
-    fact_s["counterparty_id"] = df_s["counterparty_id"]
-    fact_s["units_sold"] = df_s["units_sold"]
-    fact_s["unit price"] = df_s["unit_price"]
-    fact_s["currency_id"] = df_s["currency_id"]
-    fact_s["design_id"] = df_s["design_id"]
-    fact_s["agreed_payment_date"] = df_s["agreed_payment_date"]
-    fact_s["agreed_delivery_date"] = df_s["agreed_delivery_date"]
-    fact_s["agreed_delivery_location_id"] = df_s["agreed_delivery_location_id"]
-    return fact_s
+    return build_fact(FACT_SPECS['fact_sales_order'], df_s)
 
 
 def create_fact_purchase_order(df_p):
     """
     Create fact_purchase_order
     """
-    fact_p = pd.DataFrame()
-    # fact_p.insert(
-    #     0, "purchase_record_id", range(1, 1 + len(df_p)))
-    fact_p["purchase_order_id"] = df_p["purchase_order_id"]
-    fact_p[["created_date", "created_time"]] = df_p["created_at"].apply(
-        lambda x: pd.Series(str(x).split(" ")))
-    str1 = "last_updated_date"
-    str2 = "last_updated_time"
-    fact_p[[str1, str2]] = df_p["last_updated"].apply(
-        lambda x: pd.Series(str(x).split(" ")))
-    fact_p["staff_id"] = df_p["staff_id"]
-    fact_p["counterparty_id"] = df_p["counterparty_id"]
-    fact_p["item_code"] = df_p["item_code"]
-    fact_p["item_quantity"] = df_p["item_quantity"]
-    fact_p["item_unit_price"] = df_p["item_unit_price"]
-    fact_p["currency_id"] = df_p["currency_id"]
-    fact_p["agreed_delivery_date"] = df_p["agreed_delivery_date"]
-    fact_p["agreed_payment_date"] = df_p["agreed_payment_date"]
-    fact_p["agreed_delivery_location_id"] = df_p["agreed_delivery_location_id"]
-    return fact_p
+    return build_fact(FACT_SPECS['fact_purchase_order'], df_p)
 
 
 def create_fact_payment(df_pay):
     """
     Create fact_payment
     """
-    fact_pay = pd.DataFrame()
-    # fact_pay.insert(0, "payment_record_id", range(1, 1 + len(df_pay)))
-    fact_pay["payment_id"] = df_pay["payment_id"]
-    fact_pay[["created_date", "created_time"]] = df_pay["created_at"].apply(
-        lambda x: pd.Series(str(x).split(" ")))
-    str1 = "last_updated_date"
-    str2 = "last_updated"
-    fact_pay[[str1, str2]] = df_pay["last_updated"].apply(
-        lambda x: pd.Series(str(x).split(" ")))
-    fact_pay["transaction_id"] = df_pay["transaction_id"]
-    fact_pay["counterparty_id"] = df_pay["counterparty_id"]
-    fact_pay["payment_amount"] = df_pay["payment_amount"]
-    fact_pay["currency_id"] = df_pay["currency_id"]
-    fact_pay["payment_type_id"] = df_pay["payment_type_id"]
-    fact_pay["paid"] = df_pay["paid"]
-    fact_pay["payment_date"] = df_pay["payment_date"]
-    return fact_pay
+    return build_fact(FACT_SPECS['fact_payment'], df_pay)
+
+
+def split_timestamp_arrow(column):
+    """
+    Splits a timestamp column of an Arrow table into date32
+    and time64 arrays with pyarrow.compute casts
+    """
+    timestamps = pc.cast(column, pa.timestamp('us'), safe=False)
+    return {
+        'date': pc.cast(timestamps, pa.date32()),
+        'time': pc.cast(timestamps, pa.time64('us'))
+    }
+
+
+def build_dim_arrow(spec, tables):
+    """
+    build_dim() for Arrow tables: lookups with Table.join, then one
+    select and rename_columns, the derived columns mapped with
+    pyarrow.compute.index_in and take
+    """
+    rows = tables[spec['source']]
+    # Table.join does not keep the order of the rows
+    rows = rows.append_column(
+        '__row', pa.array(np.arange(rows.num_rows, dtype='int64')))
+    for table, left_on, right_on in spec.get('joins', []):
+        lookup = tables[table]
+        columns = list(dict.fromkeys([right_on, *[
+            column for column in spec['columns'].values()
+            if column in lookup.column_names
+            and column not in rows.column_names]]))
+        rows = rows.join(
+            lookup.select(columns), keys=left_on, right_keys=right_on,
+            join_type='inner')
+    rows = rows.sort_by(spec.get('sort', '__row'))
+    dim = rows.select(list(spec['columns'].values())).rename_columns(
+        list(spec['columns']))
+    for column, derived in spec.get('derived', {}).items():
+        source_column, values, default = derived
+        indices = pc.index_in(
+            dim[source_column], value_set=pa.array(list(values)))
+        dim = dim.append_column(column, pc.fill_null(
+            pc.take(pa.array(list(values.values())), indices), default))
+    return dim
+
+
+def build_fact_arrow(spec, table):
+    """
+    build_fact() for Arrow tables
+    """
+    splits = {}
+    columns = []
+    for source in spec['columns'].values():
+        if isinstance(source, tuple):
+            part, source = source
+            if source not in splits:
+                splits[source] = split_timestamp_arrow(table[source])
+            columns.append(splits[source][part])
+        else:
+            columns.append(table[source])
+    return pa.Table.from_arrays(columns, names=list(spec['columns']))
+
+
+def make_dim_builder(spec):
+    """
+    Returns a builder of the dim in spec taking its tables in the
+    order get_spec_tables() gives them, and that order
+    """
+    tables = get_spec_tables(spec)
+
+    def builder(*data_frames):
+        return build_dim(spec, dict(zip(tables, data_frames)))
+    return builder, tables
+
+
+# The builder of each output and the ingested tables it takes, in order
+OUTPUT_BUILDERS = {
+    **{output: make_dim_builder(spec) for output, spec in DIM_SPECS.items()},
+    **{output: (
+        lambda data_frame, spec=spec: build_fact(spec, data_frame),
+        [spec['source']]) for output, spec in FACT_SPECS.items()}
+}
+
+# The same for the Arrow engine, each builder taking and returning
+# pyarrow Tables
+ARROW_BUILDERS = {
+    **{output: (
+        lambda *tables, spec=spec: build_dim_arrow(
+            spec, dict(zip(get_spec_tables(spec), tables))),
+        get_spec_tables(spec)) for output, spec in DIM_SPECS.items()},
+    **{output: (
+        lambda table, spec=spec: build_fact_arrow(spec, table),
+        [spec['source']]) for output, spec in FACT_SPECS.items()}
+}
+
+# Dims whose rows come from one table and look up another, as
+# (rows table, looked up table, column of the rows naming the lookup)
+DIM_LOOKUPS = {
+    output: (spec['source'], table, left_on)
+    for output, spec in DIM_SPECS.items()
+    for table, left_on, _ in spec.get('joins', [])
+}
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Writable file object that uploads whatever is written to it as the
+    parts of an S3 multipart upload, without touching /tmp.
+
+    At most max_concurrency parts are queued or uploading at once, so
+    memory stays around part_size * (max_concurrency + 1). Objects
+    smaller than one part are sent with a single put_object.
+    Leaving a with block on an exception aborts the upload
+    """
+
+    def __init__(self, bucketname, key, s3_client=None,
+                 part_size=UPLOAD_PART_SIZE,
+                 max_concurrency=UPLOAD_CONCURRENCY):
+        super().__init__()
+        self.bucketname = bucketname
+        self.key = key
+        self.s3_client = s3_client or get_client('s3')
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self._buffer = bytearray()
+        self._position = 0
+        self._upload_id = None
+        self._parts = []
+        self._aborted = False
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        self._buffer.extend(data)
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._submit_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _submit_part(self, body):
+        if self._upload_id is None:
+            self._upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucketname, Key=self.key)['UploadId']
+        # Blocks while max_concurrency parts are still uploading
+        self._slots.acquire()
+        part_number = len(self._parts) + 1
+        self._parts.append(
+            self._executor.submit(self._upload_part, part_number, body))
+
+    def _upload_part(self, part_number, body):
+        try:
+            response = self.s3_client.upload_part(
+                Bucket=self.bucketname, Key=self.key,
+                UploadId=self._upload_id, PartNumber=part_number, Body=body)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self._slots.release()
+
+    def abort(self):
+        """
+        Drops everything written so far instead of uploading it
+        """
+        self._aborted = True
+        self._executor.shutdown(wait=True)
+        if self._upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucketname, Key=self.key,
+                UploadId=self._upload_id)
+        self._buffer = bytearray()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._aborted:
+                return
+            if self._upload_id is None:
+                self.s3_client.put_object(
+                    Bucket=self.bucketname, Key=self.key,
+                    Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._submit_part(bytes(self._buffer))
+                parts = [future.result() for future in self._parts]
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucketname, Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={'Parts': parts})
+        except Exception as error:
+            self.abort()
+            raise Exception(
+                f"ERROR UPLOADING {self.key}: {error}") from error
+        finally:
+            self._executor.shutdown(wait=True)
+            super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and not self.closed:
+            self.abort()
+        self.close()
+
+
+class S3RangeReader(io.RawIOBase):
+    """
+    Seekable, read-only file object over an S3 object that fetches only
+    the bytes read from it, with ranged get_object calls. ParquetFile
+    reads the footer and the column chunks it needs through it rather
+    than the whole object
+    """
+
+    def __init__(self, bucketname, key, size, s3_client=None):
+        super().__init__()
+        self.bucketname = bucketname
+        self.key = key
+        self.size = size
+        self.s3_client = s3_client or get_client('s3')
+        self.bytes_read = 0
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer):
+        end = min(self._position + len(buffer), self.size)
+        if end <= self._position:
+            return 0
+        try:
+            body = self.s3_client.get_object(
+                Bucket=self.bucketname, Key=self.key,
+                Range=f'bytes={self._position}-{end - 1}')['Body'].read()
+        except Exception as error:
+            raise Exception(
+                f"ERROR READING {self.key}: {error}") from error
+        buffer[:len(body)] = body
+        self._position += len(body)
+        self.bytes_read += len(body)
+        return len(body)
+
+
+def open_parquet_part(bucketname, key, size):
+    """
+    Opens an object of the bucket as a ParquetFile read in ranges,
+    RANGE_READ_SIZE bytes at least at a time, see S3RangeReader
+    """
+    reader = S3RangeReader(bucketname, key, size)
+    return pq.ParquetFile(
+        io.BufferedReader(reader, buffer_size=RANGE_READ_SIZE)), reader
+
+
+def upload_parquet(values, bucketname, key, s3_client=None):
+    """
+    Serialises a DataFrame or Arrow table as parquet straight into
+    the bucket under key
+    """
+    with S3MultipartWriter(bucketname, key, s3_client) as sink:
+        if isinstance(values, pa.Table):
+            pq.write_table(values, sink)
+        else:
+            values.to_parquet(sink)
+        logger.info(f"Uploaded {key}: {sink.tell()} bytes")
+    return True
 
 
 def push_to_cloud(local_object):
@@ -242,79 +1107,788 @@ def push_to_cloud(local_object):
     # seperate key and value from object
     key = [key for key in local_object.keys()][0]
     values = local_object[key]
-    # use key for file name, and value as the content for the file
-    values.to_parquet(f'/tmp/{key}.parquet')
-    s3_client = boto3.client('s3')
     bucket_name = get_bucket_name('scrumptious-squad-pr-data-')
-    out_buffer = BytesIO()
-    values.to_parquet(out_buffer, index=False, compression="gzip")
-    s3_client.upload_file(f'/tmp/{key}.parquet', bucket_name, f'{key}.parquet')
-    os.remove(f'/tmp/{key}.parquet')
+    # use key for file name, and value as the content for the file
+    return upload_parquet(values, bucket_name, f'{key}.parquet')
+
+
+def get_peak_rss():
+    """
+    Returns the peak resident memory of this process so far in MiB,
+    as Linux reports ru_maxrss in KiB. A warm Lambda keeps its process,
+    so this covers every invocation it has run, not just the last
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def merge_date_ranges(ranges):
+    """
+    Returns the span of several (first day, last day) ranges,
+    ignoring any that are None
+    """
+    ranges = [bounds for bounds in ranges if bounds is not None]
+    if not ranges:
+        return None
+    return (min(bounds[0] for bounds in ranges),
+            max(bounds[1] for bounds in ranges))
+
+
+def get_current_row_masks(bucketname, objects, keys, title, columns=()):
+    """
+    Marks the rows of each part of a table holding the newest version
+    of their id, the ones get_current_rows() keeps, newest part first.
+    Only the id column, the change_type of cdc parts and columns are
+    read, in ranges. A part's mask is None if all of its rows are kept.
+
+    Returns the masks, how many current rows are left once deletes are
+    dropped, and the distinct values of columns in those rows
+    """
+    id_column = f'{title}_id'
+    masks = {}
+    seen = set()
+    current = 0
+    values = {column: set() for column in columns}
+    for key in reversed(keys):
+        parquet_file, _ = open_parquet_part(
+            bucketname, key, objects[key]['Size'])
+        names = parquet_file.schema_arrow.names
+        table = parquet_file.read(columns=[
+            column for column in [id_column, 'change_type', *columns]
+            if column in names])
+        if id_column in names:
+            ids = table[id_column].to_pandas()
+            newest = ~ids.duplicated(keep='last') & ~ids.isin(seen)
+            seen.update(ids.unique())
+            masks[key] = None if newest.all() else newest.to_numpy()
+            if masks[key] is not None:
+                table = table.filter(pa.array(masks[key]))
+        else:
+            masks[key] = None
+        table = drop_deleted_rows(table)
+        current += table.num_rows
+        for column in columns:
+            if column in names:
+                values[column].update(
+                    pc.unique(table[column].drop_null()).to_pylist())
+    return masks, current, values
+
+
+def get_stream_schema(schema, current, values, ratio=CATEGORY_RATIO):
+    """
+    Dictionary encodes the string columns of an ingested table's schema
+    with at most ratio distinct values per current row, the columns
+    encode_categories() encodes when the whole table is loaded
+    """
+    if ratio is None or not current:
+        return schema
+    for column, distinct in values.items():
+        if len(distinct) <= ratio * current:
+            index = schema.get_field_index(column)
+            schema = schema.set(index, pa.field(
+                column, pa.dictionary(pa.int32(), schema.field(index).type)))
+    return schema
+
+
+def stream_fact(output, pr_bucket, batch_size=FACT_BATCH_SIZE,
+                latest_only=False, category_ratio=CATEGORY_RATIO):
+    """
+    Builds a fact batch_size rows at a time: each part of the ingested
+    table is read in key order with ParquetFile.iter_batches, and each
+    batch is built and written as one row group of the fact, straight
+    into the processed bucket. As the fact is written in full, every
+    part is read unless latest_only, keeping the newest version of each
+    row by get_current_row_masks().
+
+    The parts are read in ranges through S3RangeReader, so only the
+    id column and the fact's string columns are fetched twice, and
+    memory stays around one row group, one batch and the table's ids.
+    Older parts are cast to the types of the newest, as cast_parts()
+    does, and the low-cardinality string columns are dictionary
+    encoded as encode_categories() would, so the fact is written with
+    the schema the Arrow engine gives it.
+
+    Returns the rows and row groups written and the first and last day
+    of the dates the facts hold
+    """
+    spec = FACT_SPECS[output]
+    in_bucket = get_bucket_name('scrumptious-squad-in-data-')
+    objects = get_bucket_objects(in_bucket)
+    keys = get_table_keys(spec['source'], list(objects), latest_only)
+    summary = {'rows': 0, 'row_groups': 0, 'dates': None}
+    if not keys:
+        return summary
+    schema = open_parquet_part(
+        in_bucket, keys[-1], objects[keys[-1]]['Size'])[0].schema_arrow
+    columns = [
+        field.name for field in schema
+        if field.name in spec['columns'].values()
+        and (pa.types.is_string(field.type)
+             or pa.types.is_large_string(field.type))]
+    masks, current, values = get_current_row_masks(
+        in_bucket, objects, keys, spec['source'], columns)
+    schema = get_stream_schema(schema, current, values, category_ratio)
+
+    with S3MultipartWriter(pr_bucket, f'{output}.parquet') as sink:
+        writer = None
+        try:
+            for key in keys:
+                parquet_file, reader = open_parquet_part(
+                    in_bucket, key, objects[key]['Size'])
+                offset = 0
+                for batch in parquet_file.iter_batches(batch_size=batch_size):
+                    table = cast_to_schema(
+                        pa.Table.from_batches([batch]), schema)
+                    if masks[key] is not None:
+                        table = table.filter(pa.array(
+                            masks[key][offset:offset + batch.num_rows]))
+                    offset += batch.num_rows
+                    table = drop_deleted_rows(table)
+                    if table.num_rows == 0:
+                        continue
+                    fact = build_fact_arrow(spec, table)
+                    if writer is None:
+                        writer = pq.ParquetWriter(sink, fact.schema)
+                    writer.write_table(fact.cast(writer.schema))
+                    summary['rows'] += fact.num_rows
+                    summary['row_groups'] += 1
+                    summary['dates'] = merge_date_ranges([
+                        summary['dates'],
+                        get_fact_date_range({spec['source']: table}, 0)])
+                logger.info(
+                    f"Streamed {reader.bytes_read} of "
+                    f"{objects[key]['Size']} bytes of {key}")
+            if writer is None:
+                # Every row was empty or dropped, write the columns anyway
+                writer = pq.ParquetWriter(sink, build_fact_arrow(
+                    spec, schema.empty_table()).schema)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    logger.info(
+        f"Streamed {summary['rows']} rows of {output} in "
+        f"{summary['row_groups']} row groups")
+    return summary
+
+
+def get_transform_options(event):
+    """
+    Picks the transform settings out of the lambda event,
+    falling back to DEFAULT_OPTIONS for any it leaves out
+    """
+    options = dict(DEFAULT_OPTIONS)
+    for key in DEFAULT_OPTIONS:
+        if key in event:
+            options[key] = event[key]
+    return options
+
+
+def make_run_id():
+    """
+    Returns a sortable identifier for this transform run
+    """
+    return datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+
+
+def get_column_names(values):
+    """
+    Returns the column names of a DataFrame or an Arrow table
+    """
+    if isinstance(values, pa.Table):
+        return values.column_names
+    return list(values.columns)
+
+
+def to_series(column):
+    """
+    Returns a column of a DataFrame or an Arrow table as a Series
+    """
+    if isinstance(column, pa.ChunkedArray):
+        return column.to_pandas()
+    return column
+
+
+def get_fact_date_range(ingested, horizon_days=DATE_HORIZON_DAYS):
+    """
+    Returns the first and last day dim_date must hold for the facts
+    built from the ingested tables: their earliest date up to
+    horizon_days past their latest. None if they hold no dates
+    """
+    dates = [
+        pd.to_datetime(to_series(ingested[title][column]), errors='coerce')
+        for title, columns in FACT_DATE_COLUMNS.items()
+        if title in ingested and ingested[title] is not False
+        for column in columns if column in get_column_names(ingested[title])]
+    dates = pd.concat(dates) if dates else pd.Series(dtype='datetime64[ns]')
+    if dates.isna().all():
+        return None
+    return get_horizon_range(
+        (dates.min().normalize(), dates.max().normalize()), horizon_days)
+
+
+def get_horizon_range(dates, horizon_days=DATE_HORIZON_DAYS):
+    """
+    Runs a (first day, last day) range of dates on horizon_days,
+    as Timestamps so the days add without a unitless numpy timedelta
+    """
+    if dates is None:
+        return None
+    return (pd.Timestamp(dates[0]),
+            pd.Timestamp(dates[1]) + pd.Timedelta(horizon_days, unit='D'))
+
+
+def get_dim_date_keys(bucketname):
+    """
+    Picks the dim_date written in full and the days added to it
+    out of the processed bucket's listing
+    """
+    return [
+        key for key in get_bucket_keys(bucketname)
+        if key == 'dim_date.parquet' or key.startswith('dim_date/')]
+
+
+def get_dim_date_range(bucketname):
+    """
+    Returns the first and last day of the processed dim_date, kept
+    between warm invocations, or None if it has not been written yet
+    """
+    def read_range():
+        keys = get_dim_date_keys(bucketname)
+        if not keys:
+            return None
+        dates = []
+        for key in keys:
+            buffer = BytesIO()
+            get_client('s3').download_fileobj(bucketname, key, buffer)
+            dates.append(pd.read_parquet(buffer, columns=['date_id']))
+        dates = pd.concat(dates)['date_id']
+        return (pd.Timestamp(dates.min()), pd.Timestamp(dates.max()))
+    return get_cached('dim_date', bucketname, read_range)
+
+
+def extend_dim_date(bucketname, ingested, horizon_days=DATE_HORIZON_DAYS,
+                    run_id=None, category_ratio=CATEGORY_RATIO):
+    """
+    Makes the processed dim_date cover the dates of the facts built
+    from the ingested tables. It is written in full the first time,
+    and afterwards only the missing days are added, as a new part
+    under dim_date/run=<id>.parquet. Returns how many days were written
+    """
+    return extend_dim_date_range(
+        bucketname, get_fact_date_range(ingested, horizon_days), run_id,
+        category_ratio)
+
+
+def extend_dim_date_range(bucketname, needed, run_id=None,
+                          category_ratio=CATEGORY_RATIO):
+    """
+    extend_dim_date() for a range of (first day, last day) already
+    worked out, or None if there are no dates to cover
+    """
+    if needed is None:
+        return 0
+    current = get_dim_date_range(bucketname)
+    if current is None:
+        days = create_dim_date(*needed)
+        upload_parquet(
+            encode_categories(days, category_ratio), bucketname,
+            'dim_date.parquet')
+        extended = needed
+    else:
+        one_day = pd.Timedelta(1, unit='D')
+        new_days = []
+        if needed[0] < current[0]:
+            new_days.append(create_dim_date(needed[0], current[0] - one_day))
+        if needed[1] > current[1]:
+            new_days.append(create_dim_date(current[1] + one_day, needed[1]))
+        if not new_days:
+            logger.info(f"dim_date already covers {needed[0]:%Y-%m-%d} "
+                        f"to {needed[1]:%Y-%m-%d}")
+            return 0
+        days = pd.concat(new_days, ignore_index=True)
+        if run_id is None:
+            run_id = make_run_id()
+        upload_parquet(
+            encode_categories(days, category_ratio), bucketname,
+            f'dim_date/run={run_id}.parquet')
+        extended = (min(needed[0], current[0]), max(needed[1], current[1]))
+    # Remember the new range rather than read it back next time
+    invalidate_cache('dim_date', bucketname)
+    get_cached('dim_date', bucketname, lambda: extended)
+    logger.info(f"Added {len(days)} days to dim_date")
+    return len(days)
+
+
+def get_transform_state(bucketname):
+    """
+    Retrieves the ETag of every ingested part already transformed.
+    Returns an empty state if no incremental run has stored one yet
+    """
+    try:
+        response = get_client('s3').get_object(
+            Bucket=bucketname, Key=STATE_KEY)
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return {'processed': {}}
+        raise Exception(f"ERROR FETCHING TRANSFORM STATE: {error}") from error
+    return json.loads(response['Body'].read())
+
+
+def put_transform_state(state, bucketname):
+    """
+    Replaces the transform state in one PUT
+    """
+    try:
+        get_client('s3').put_object(
+            Bucket=bucketname, Key=STATE_KEY, Body=json.dumps(state, indent=2))
+    except Exception as error:
+        raise Exception(f"ERROR STORING TRANSFORM STATE: {error}") from error
+    return True
+
+
+def get_ingested_parts(objects):
+    """
+    Returns the ETag of every part of the ingested tables
+    in a listing of the ingested bucket
+    """
+    return {
+        key: objects[key]['ETag'] for title in INGESTED_TABLES
+        for key in get_table_keys(title, list(objects))}
+
+
+def delete_fact_parts(bucketname, outputs):
+    """
+    Deletes the parts incremental runs added under <fact>/ for facts
+    that have just been written in full, which hold their rows already.
+    Returns how many were deleted
+    """
+    s3_client = get_client('s3')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    deleted = 0
+    try:
+        for output in outputs:
+            for page in paginator.paginate(
+                    Bucket=bucketname, Prefix=f'{output}/'):
+                keys = [{'Key': file['Key']}
+                        for file in page.get('Contents', [])]
+                if keys:
+                    # A page holds at most the 1000 keys a call can delete
+                    s3_client.delete_objects(
+                        Bucket=bucketname, Delete={'Objects': keys})
+                    deleted += len(keys)
+    except Exception as error:
+        raise Exception(f"ERROR DELETING FACT PARTS: {error}") from error
+    if deleted:
+        logger.info(f"Deleted {deleted} incremental fact parts")
+    return deleted
+
+
+def split_deleted_rows(data_frame, title):
+    """
+    Takes the rows cdc parts deleted out of a table read with
+    keep_deleted, returning the rest of it and the deleted ids
+    """
+    if data_frame is False or 'change_type' not in data_frame:
+        return data_frame, []
+    deleted = data_frame.change_type == 'delete'
+    return (data_frame[~deleted].reset_index(drop=True),
+            data_frame[deleted][f'{title}_id'].unique())
+
+
+def get_deleted_dim_ids(output, deleted, history):
+    """
+    Returns the ids of the rows of a dim whose ingested row has been
+    deleted, or whose looked up row has, as the inner join drops those
+    """
+    if output not in DIM_LOOKUPS:
+        return list(deleted[OUTPUT_BUILDERS[output][1][0]])
+    rows_table, lookup_table, column = DIM_LOOKUPS[output]
+    ids = list(deleted[rows_table])
+    if len(deleted[lookup_table]) and history[rows_table] is not False:
+        rows = history[rows_table]
+        ids += list(rows[rows[column].isin(
+            deleted[lookup_table])][f'{rows_table}_id'])
+    return ids
+
+
+def get_changed_ids(data_frame, title):
+    """
+    Returns the ids of the rows of an ingested table's new parts
+    """
+    if data_frame is False:
+        return []
+    return data_frame[f'{title}_id'].unique()
+
+
+def get_processed_dim(bucketname, output):
+    """
+    Reads a dim back from the processed bucket, or returns None
+    if it has not been written yet
+    """
+    buffer = BytesIO()
+    try:
+        get_client('s3').download_fileobj(
+            bucketname, f'{output}.parquet', buffer)
+    except ClientError as error:
+        if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise Exception(f"ERROR FETCHING {output}: {error}") from error
+    return pd.read_parquet(buffer)
+
+
+def upsert_dim(bucketname, output, changed_rows,
+               category_ratio=CATEGORY_RATIO, deleted_ids=()):
+    """
+    Replaces the rows of a processed dim that share an id with
+    changed_rows, adds the new ones, drops the deleted_ids and writes
+    the dim back
+    """
+    key_column = changed_rows.columns[0]
+    dim = get_processed_dim(bucketname, output)
+    if dim is not None:
+        dim = dim[~dim[key_column].isin(changed_rows[key_column])
+                  & ~dim[key_column].isin(deleted_ids)]
+        changed_rows = pd.concat([dim, changed_rows], ignore_index=True)
+    dim = changed_rows.sort_values(key_column).reset_index(drop=True)
+    return upload_parquet(
+        encode_categories(dim, category_ratio), bucketname,
+        f'{output}.parquet')
+
+
+def build_changed_dim(output, deltas, history):
+    """
+    Builds the rows of a dim whose ingested rows, or the rows they
+    look up, have changed since the last incremental run
+    """
+    builder, tables = OUTPUT_BUILDERS[output]
+    if output not in DIM_LOOKUPS:
+        return builder(get_current_rows(deltas[tables[0]], tables[0]))
+
+    rows_table, lookup_table, column = DIM_LOOKUPS[output]
+    rows = get_current_rows(history[rows_table], rows_table)
+    rows = rows[
+        rows[f'{rows_table}_id'].isin(get_changed_ids(
+            deltas[rows_table], rows_table)) |
+        rows[column].isin(get_changed_ids(
+            deltas[lookup_table], lookup_table))].reset_index(drop=True)
+    frames = {
+        rows_table: rows,
+        lookup_table: get_current_rows(history[lookup_table], lookup_table)}
+    return builder(*[frames[title] for title in tables])
+
+
+def transform_incrementally(options=None):
+    """
+    Transforms only the ingested parts that no earlier run has
+    processed, keyed by their ETags. Fact rows go to the processed
+    bucket as a new part per run, under <fact>/run=<id>.parquet,
+    and only the changed rows of each dim are upserted into it.
+    Rows cdc parts deleted are dropped from the dims, but stay in the
+    fact parts earlier runs added until a full run rewrites the facts.
+    The state only keeps the ETags of parts still in the bucket.
+    Returns the number of rows written to each output
+    """
+    if options is None:
+        options = DEFAULT_OPTIONS
+    run_id = make_run_id()
+    in_bucket = get_bucket_name('scrumptious-squad-in-data-')
+    pr_bucket = get_bucket_name('scrumptious-squad-pr-data-')
+    state = get_transform_state(pr_bucket)
+    objects = get_bucket_objects(in_bucket)
+    processed = {
+        key: etag for key, etag in state['processed'].items()
+        if key in objects}
+
+    new_keys = [
+        key for title in INGESTED_TABLES
+        for key in get_table_keys(title, list(objects), latest_only=False)
+        if processed.get(key) != objects[key]['ETag']]
+    if not new_keys:
+        logger.info("No new ingested parts to transform")
+        return {}
+
+    deltas = get_parquets(
+        INGESTED_TABLES, latest_only=False, processed=processed,
+        keep_deleted=True)
+    deleted = {}
+    for title in INGESTED_TABLES:
+        deltas[title], deleted[title] = split_deleted_rows(
+            deltas[title], title)
+    changed = {title for title in INGESTED_TABLES
+               if deltas[title] is not False}
+    # Dims that look rows up need every current row of both tables
+    history_tables = sorted({
+        title for output, lookup in DIM_LOOKUPS.items()
+        if changed & set(lookup[:2]) for title in lookup[:2]})
+    history = get_parquets(history_tables, latest_only=False)
+
+    written = {}
+    days = extend_dim_date(
+        pr_bucket, deltas, options['date_horizon_days'], run_id,
+        options['category_ratio'])
+    if days:
+        written['dim_date'] = days
+    for output, (builder, tables) in OUTPUT_BUILDERS.items():
+        if not changed & set(tables):
+            continue
+        if output.startswith('fact_'):
+            fact = builder(deltas[tables[0]])
+            upload_parquet(
+                encode_categories(fact, options['category_ratio']),
+                pr_bucket, f'{output}/run={run_id}.parquet')
+            written[output] = len(fact)
+        else:
+            dim = build_changed_dim(output, deltas, history)
+            upsert_dim(pr_bucket, output, dim, options['category_ratio'],
+                       get_deleted_dim_ids(output, deleted, history))
+            written[output] = len(dim)
+        logger.info(f"Transformed {written[output]} rows of {output}")
+
+    processed.update({key: objects[key]['ETag'] for key in new_keys})
+    put_transform_state({'processed': processed, 'run_id': run_id}, pr_bucket)
+    return written
+
+
+def get_fingerprints(bucketname):
+    """
+    Retrieves the input fingerprint of every output built so far.
+    Returns an empty dict if no run has stored any yet
+    """
+    try:
+        response = get_client('s3').get_object(
+            Bucket=bucketname, Key=FINGERPRINTS_KEY)
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return {}
+        raise Exception(f"ERROR FETCHING FINGERPRINTS: {error}") from error
+    return json.loads(response['Body'].read())
+
+
+def put_fingerprints(fingerprints, bucketname):
+    """
+    Replaces the stored fingerprints in one PUT
+    """
+    try:
+        get_client('s3').put_object(
+            Bucket=bucketname, Key=FINGERPRINTS_KEY,
+            Body=json.dumps(fingerprints, indent=2))
+    except Exception as error:
+        raise Exception(f"ERROR STORING FINGERPRINTS: {error}") from error
     return True
 
 
-def transform():
+def get_output_tables(output):
     """
-    Read the parquet files from the s3 bucket
-    and put the outcome in a Dataframe.
+    Returns the ingested tables an output is built from
     """
-    df_address = get_parquet('address')
-    df_counterparty = get_parquet('counterparty')
-    df_currency = get_parquet('currency')
-    df_department = get_parquet('department')
-    df_design = get_parquet('design')
-    df_payment_type = get_parquet('payment_type')
-    df_payment = get_parquet('payment')
-    df_purchase_order = get_parquet('purchase_order')
-    df_sales_order = get_parquet('sales_order')
-    df_staff = get_parquet('staff')
-    df_transaction = get_parquet('transaction')
+    if output == 'dim_date':
+        return list(FACT_DATE_COLUMNS)
+    return OUTPUT_BUILDERS[output][1]
+
 
+def fingerprint_output(output, objects, options=None):
     """
-    Converts dataframes to dictionaries
+    Hashes what an output is built from: the key, ETag and size of
+    every part transform() reads of its ingested tables, the version
+    of the builders and, for dim_date, its horizon
     """
-    dim_date = {'dim_date': create_dim_date('2022-01-01', '2024-01-01')}
-    dim_location = {'dim_location': create_dim_location(df_address)}
-    dim_design = {'dim_design': create_dim_design(df_design)}
-    dim_currency = {'dim_currency': create_dim_currency(df_currency)}
-    dim_counterparty = {'dim_counterparty': create_dim_counterparty(
-        df_address, df_counterparty)}
-    dim_staff = {'dim_staff': create_dim_staff(df_staff, df_department)}
-    dim_transaction = {
-        'dim_transaction': create_dim_transaction(df_transaction)}
-    dim_payment_type = {
-        'dim_payment_type': create_dim_payment_type(df_payment_type)}
-    fact_sales_order = {
-        'fact_sales_order': create_fact_sales_order(df_sales_order)}
-    fact_purchase_orders = {
-        'fact_purchase_order': create_fact_purchase_order(df_purchase_order)}
-    fact_payment = {'fact_payment': create_fact_payment(df_payment)}
+    if options is None:
+        options = DEFAULT_OPTIONS
+    inputs = [
+        [key, objects[key]['ETag'], objects[key]['Size']]
+        for title in get_output_tables(output)
+        for key in get_table_keys(title, list(objects))]
+    if output == 'dim_date':
+        inputs.append(options['date_horizon_days'])
+    return hashlib.sha256(json.dumps(
+        [TRANSFORM_VERSION, output, inputs]).encode()).hexdigest()
 
+
+def run_dag(nodes, max_workers=DAG_WORKERS):
+    """
+    Runs a DAG given as {name: (function, [names it depends on])} on
+    max_workers threads. Each function is called with the results of
+    its dependencies, in order, once they have all finished, and a
+    result is dropped as soon as its last dependent has finished.
+    Logs and returns the seconds each node took
     """
-    Uploads each dataframe into a parquet file
-    and uploads that file into the processed data s3 bucket
+    consumers = {name: 0 for name in nodes}
+    for _, depends_on in nodes.values():
+        for dependency in depends_on:
+            consumers[dependency] += 1
+    results = {}
+    finished = set()
+    timings = {}
+    waiting = dict(nodes)
+    running = {}
+
+    def run_node(name, function, args):
+        started = time.perf_counter()
+        result = function(*args)
+        timings[name] = time.perf_counter() - started
+        logger.info(f"DAG node {name} took {timings[name]:.3f}s")
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            for name, (function, depends_on) in list(waiting.items()):
+                if finished.issuperset(depends_on):
+                    args = [results[dependency] for dependency in depends_on]
+                    running[executor.submit(
+                        run_node, name, function, args)] = name
+                    del waiting[name]
+            if not running:
+                raise Exception(
+                    f"ERROR RUNNING DAG: {sorted(waiting)} can never run")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as error:
+                    for pending in running:
+                        pending.cancel()
+                    raise Exception(
+                        f"ERROR RUNNING {name}: {error}") from error
+                finished.add(name)
+                if consumers[name]:
+                    results[name] = result
+                for dependency in nodes[name][1]:
+                    consumers[dependency] -= 1
+                    if not consumers[dependency]:
+                        # Its last dependent is done, let it be freed
+                        del results[dependency]
+    return timings
+
+
+def make_transform_dag(outputs, pr_bucket, options=None):
+    """
+    Lays out the transform of outputs as a DAG for run_dag(): one load
+    per ingested table they read, shared by every output reading it,
+    then a build and an upload per output. dim_date is extended
+    straight from the loads of the fact tables.
+
+    With stream_facts, each fact is one node streaming it batch by batch
+    instead, and dim_date is extended from the dates they report
     """
+    if options is None:
+        options = DEFAULT_OPTIONS
+    if options['engine'] == 'arrow':
+        load, builders = get_tables, ARROW_BUILDERS
+    else:
+        load, builders = get_parquets, OUTPUT_BUILDERS
+    streamed = []
+    if options['stream_facts']:
+        streamed = [output for output in outputs if output in FACT_SPECS]
 
-    push_to_cloud(dim_date)
-    push_to_cloud(dim_location)
-    push_to_cloud(dim_design)
-    push_to_cloud(dim_currency)
-    push_to_cloud(dim_counterparty)
-    push_to_cloud(dim_staff)
-    push_to_cloud(dim_transaction)
-    push_to_cloud(dim_payment_type)
-    push_to_cloud(fact_sales_order)
-    push_to_cloud(fact_purchase_orders)
-    push_to_cloud(fact_payment)
+    nodes = {}
+    for output in streamed:
+        nodes[f'upload:{output}'] = (
+            lambda output=output: stream_fact(
+                output, pr_bucket, options['batch_size'],
+                category_ratio=options['category_ratio']), [])
+    if 'dim_date' in outputs and options['stream_facts']:
+        nodes['upload:dim_date'] = (
+            lambda *summaries: extend_dim_date_range(
+                pr_bucket, get_horizon_range(
+                    merge_date_ranges(
+                        [summary['dates'] for summary in summaries]),
+                    options['date_horizon_days']),
+                category_ratio=options['category_ratio']),
+            [f'upload:{output}' for output in streamed])
+        streamed.append('dim_date')
 
-# transform()
+    loaded = [output for output in outputs if output not in streamed]
+    for title in sorted({
+            title for output in loaded
+            for title in get_output_tables(output)}):
+        nodes[f'load:{title}'] = (
+            lambda title=title: encode_categories(
+                load([title])[title], options['category_ratio']), [])
+    for output in loaded:
+        loads = [f'load:{title}' for title in get_output_tables(output)]
+        if output == 'dim_date':
+            nodes['upload:dim_date'] = (
+                lambda *tables: extend_dim_date(
+                    pr_bucket, dict(zip(FACT_DATE_COLUMNS, tables)),
+                    options['date_horizon_days'],
+                    category_ratio=options['category_ratio']), loads)
+            continue
+        nodes[f'build:{output}'] = (builders[output][0], loads)
+        nodes[f'upload:{output}'] = (
+            lambda values, output=output: push_to_cloud({
+                output: encode_categories(values, options['category_ratio'])}),
+            [f'build:{output}'])
+    return nodes
+
+
+def transform(options=None):
+    """
+    Read the parquet files from the s3 bucket, build every dim and
+    fact from them and upload each to the processed data s3 bucket.
+
+    With skip_unchanged, an output whose inputs have the same
+    fingerprint as when it was last built is neither downloaded,
+    built nor uploaded again. The engine option picks whether the
+    outputs are built as pandas DataFrames or pyarrow Tables.
+
+    The facts written in full replace the parts transform_incrementally()
+    added to them, and its state moves on to every part read here
+    """
+    if options is None:
+        options = DEFAULT_OPTIONS
+    # Extract may have written new parts since the last invocation
+    invalidate_cache('listing')
+    objects = get_bucket_objects(
+        get_bucket_name('scrumptious-squad-in-data-'))
+    pr_bucket = get_bucket_name('scrumptious-squad-pr-data-')
+
+    fingerprints = {
+        output: fingerprint_output(output, objects, options)
+        for output in ['dim_date', *OUTPUT_BUILDERS]}
+    stored = get_fingerprints(pr_bucket) if options['skip_unchanged'] else {}
+    stale = []
+    for output, fingerprint in fingerprints.items():
+        if stored.get(output) == fingerprint:
+            logger.info(f"Fingerprint cache hit for {output}, skipping")
+        else:
+            logger.info(f"Fingerprint cache miss for {output}")
+            stale.append(output)
+
+    run_dag(
+        make_transform_dag(stale, pr_bucket, options), options['dag_workers'])
+    delete_fact_parts(
+        pr_bucket, [output for output in stale if output.startswith('fact_')])
+    put_transform_state(
+        {'processed': get_ingested_parts(objects), 'run_id': make_run_id()},
+        pr_bucket)
+    for output in stale:
+        stored[output] = fingerprints[output]
+
+    if options['skip_unchanged']:
+        put_fingerprints(stored, pr_bucket)
+    return stale
 
 
 # Lambda handler
 def transform_lambda_handler(event, context):
     """
-    Fully integrated all subfunctions
+    Fully integrated all subfunctions.
+    The event's mode picks transform() ('full'), which rebuilds every
+    output, or transform_incrementally() ('incremental')
     """
-
-    transform()
+    options = get_transform_options(event or {})
+    reset_cache_stats()
+    try:
+        if options['mode'] == 'incremental':
+            # Extract may have written new parts since the last invocation
+            invalidate_cache('listing')
+            transform_incrementally(options)
+        else:
+            transform(options)
+    finally:
+        report_cache_stats('transform')
+        logger.info(
+            f"Peak RSS of the process: {get_peak_rss():.0f} MiB, "
+            "over every invocation it has run")
     # logger.info("Completed")
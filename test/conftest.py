@@ -0,0 +1,19 @@
+"""
+Fixtures shared by every test module
+"""
+import pytest
+import src.extract
+import src.load
+import src.transform
+
+
+@pytest.fixture(autouse=True)
+def clear_warm_caches():
+    """
+    Each test gets its own mocked AWS, so nothing cached by one test,
+    as if by a warm Lambda, may leak into the next.
+    """
+    for module in (src.extract, src.transform, src.load):
+        module.invalidate_cache()
+        module.reset_cache_stats()
+    yield
@@ -18,15 +18,53 @@ from src.extract import (
     extract_lambda_handler,
     get_parquet,
     get_most_recent_time,
-    get_file_info_in_bucket
+    get_file_info_in_bucket,
+    get_watermarks,
+    iter_table_batches,
+    whole_table_sql,
+    stream_table_to_cloud,
+    make_part_key,
+    parse_part_key,
+    get_table_keys,
+    get_table_runs,
+    S3MultipartWriter,
+    MIN_PART_SIZE,
+    copy_whole_table,
+    get_whole_table,
+    rows_to_table,
+    get_key_column,
+    upload_parquet,
+    get_cached,
+    invalidate_cache,
+    cache,
+    cache_stats,
+    CACHE_TTLS,
+    setup_replication,
+    drop_replication,
+    get_replication_changes,
+    cdc_to_cloud,
+    DEFAULT_OPTIONS,
+    get_recents_table,
+    export_snapshot,
+    import_snapshot,
+    plan_key_ranges,
+    plan_extract,
+    push_to_cloud
 )
+import json
 import os
+import threading
 from moto import (mock_secretsmanager, mock_s3)
 import pytest
 import boto3
 from unittest.mock import patch
 from src.set_up.make_secrets import (entry_test_db)
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datetime import date
+from decimal import Decimal
+from io import BytesIO
 
 
 @pytest.fixture(scope='function')
@@ -121,6 +159,21 @@ def mock_bucket(premock_s3):
     )
 
 
+@pytest.fixture
+def indexed_sales_order():
+    """Indexes sales_order by its key, as keyset backfills need."""
+
+    conn = make_connection('config/.env.test')
+    dbcur = conn.cursor()
+    dbcur.execute(
+        'CREATE UNIQUE INDEX sales_order_key ON sales_order (sales_order_id)')
+    conn.commit()
+    yield
+    dbcur.execute('DROP INDEX sales_order_key')
+    conn.commit()
+    conn.close()
+
+
 def test_get_bucket_name_returns_correct_name(mock_bucket, premock_s3):
     """
     Calls get_bucket_name with bucket name prefixes to retrieve the bucket's
@@ -240,9 +293,10 @@ def test_get_table_and_check_each_table__no_files_exist_yet(mock_bucket):
 
     # Get the rows to be added to .parquet files for each table as df in a dict
     to_be_added = check_each_table(tables, dbcur, bucketname)
-    address_df = to_be_added[0]['address']
-    design_df = to_be_added[4]['design']
-    sales_order_df = to_be_added[8]['sales_order']
+    # Tables are added as Arrow tables
+    address_df = to_be_added[0]['address'].to_pandas()
+    design_df = to_be_added[4]['design'].to_pandas()
+    sales_order_df = to_be_added[8]['sales_order'].to_pandas()
 
     assert len(to_be_added) == 11
 
@@ -297,10 +351,10 @@ def test_push_to_cloud_and_add_updates_uploads_to_s3(mock_bucket, premock_s3):
     # Get the rows to be added to .parquet files for each table as df in a dict
     to_be_added = check_each_table(tables, dbcur, bucketname)
 
-    # .parquet file names are just the table name and the file extension
-    prepared_parquet_filenames = [title[0] + '.parquet' for title in tables]
+    # Each table is written as the first part of this run's partition
+    prepared_table_names = [title[0] for title in tables]
     # Sort to make assertion easier
-    prepared_parquet_filenames.sort()
+    prepared_table_names.sort()
 
     # Convert the rows to be added for each table from DataFrames to parquets
     # and upload to an S3 bucket
@@ -310,10 +364,16 @@ def test_push_to_cloud_and_add_updates_uploads_to_s3(mock_bucket, premock_s3):
         Bucket='scrumptious-squad-in-data-testmock')
     response_file_names = [content['Key']
                            for content in (response['Contents'])]
+    response_parts = [parse_part_key(key) for key in response_file_names]
+    response_table_names = [part['table'] for part in response_parts]
     # Sort to make assertion easier
-    response_file_names.sort()
+    response_table_names.sort()
 
-    assert response_file_names == prepared_parquet_filenames
+    assert response_table_names == prepared_table_names
+    # Every table was written by the same run
+    assert len(set(part['run'] for part in response_parts)) == 1
+    assert all(part['part'] == 0 for part in response_parts)
+    assert response_file_names[0].startswith('table=')
 
 
 def test_get_parquet_returns_the_correct_dataframe(mock_bucket, premock_s3):
@@ -496,7 +556,7 @@ def test_get_table_and_check_each_table_when_no_incoming_files(mock_bucket):
     to_be_added = check_each_table(tables, dbcur, bucketname)
 
     # Only 1 table is updated here,the index doesn't follow the tables var
-    sales_order_df = to_be_added[0]['sales_order']
+    sales_order_df = to_be_added[0]['sales_order'].to_pandas()
 
     assert len(to_be_added) == 1
 
@@ -509,7 +569,7 @@ def test_get_table_and_check_each_table_when_no_incoming_files(mock_bucket):
     assert sales_order_df.loc[sales_order_df.sales_order_id == 7][[
         'currency_id']].values[0] == 2
     assert sales_order_df.loc[sales_order_df.sales_order_id == 7][[
-        'agreed_delivery_date']].values[0] == '2023-09-09'
+        'agreed_delivery_date']].values[0] == date(2023, 9, 9)
     assert sales_order_df.loc[sales_order_df.sales_order_id == 8][[
         'last_updated']].values[0] == pd.Timestamp(2023, 3, 3, 8, 45)
     assert sales_order_df.loc[sales_order_df.sales_order_id == 8][[
@@ -578,8 +638,14 @@ def test_push_to_cloud_add_updates_with_some_files(mock_bucket, premock_s3):
 
     # Get the response JSON from listing an S3 bucket's contents
     response = get_file_info_in_bucket(bucketname)
-    # Get the data from .parquets in an S3 bucket as DataFrames
-    sales_order_df = get_parquet('sales_order', bucketname, response)
+    # Earlier runs' parts are kept, so read only the newest run's rows
+    runs = get_table_runs('sales_order', response)
+    assert len(runs) == 2
+    sales_order_df = get_parquet(
+        'sales_order', bucketname, response, runs=runs[-1:])
+
+    # Reading every run gives the whole history
+    assert get_parquet('sales_order', bucketname, response).shape[0] == 8
 
     # Test number of columns
     assert sales_order_df.shape[1] == 12
@@ -590,10 +656,901 @@ def test_push_to_cloud_add_updates_with_some_files(mock_bucket, premock_s3):
     assert sales_order_df.loc[sales_order_df.sales_order_id == 7][[
         'currency_id']].values[0] == 2
     assert sales_order_df.loc[sales_order_df.sales_order_id == 7][[
-        'agreed_delivery_date']].values[0] == '2023-09-09'
+        'agreed_delivery_date']].values[0] == date(2023, 9, 9)
     assert sales_order_df.loc[sales_order_df.sales_order_id == 8][[
         'last_updated']].values[0] == pd.Timestamp(2023, 3, 3, 8, 45)
     assert sales_order_df.loc[sales_order_df.sales_order_id == 8][[
         'design_id']].values[0] == 7
     assert sales_order_df.loc[sales_order_df.sales_order_id == 8][[
         'unit_price']].values[0] == 5.00
+
+
+def test_extraction_stores_watermarks_for_each_table(mock_bucket):
+    """
+    After one extraction the ingested bucket holds a manifest with the
+    latest 'created_at' and 'last_updated' times and row count per table.
+    """
+
+    # Execute extraction once with the seeded Totesys database
+    extract_lambda_handler({'dotenv_path_string': 'config/.env.test'})
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+
+    watermarks = get_watermarks(bucketname)
+
+    assert len(watermarks) == 11
+    assert watermarks['sales_order']['created_at'] == '2023-01-01 10:00:00'
+    assert watermarks['sales_order']['last_updated'] == '2023-01-01 10:00:00'
+    assert watermarks['sales_order']['row_count'] == 6
+    assert watermarks['address']['row_count'] == 5
+
+
+@patch('src.extract.get_parquet')
+def test_check_each_table_uses_watermarks_not_parquets(mock_get_parquet,
+                                                       mock_bucket):
+    """
+    Once watermarks exist, check_each_table should not download
+    any of the ingested parquet files to find the latest times.
+    """
+
+    # Execute extraction once with the seeded Totesys database
+    extract_lambda_handler({'dotenv_path_string': 'config/.env.test'})
+
+    tables = (['sales_order'], ['staff'])
+    # Connect to the local test totesys database
+    conn = make_connection('config/.env.test')
+    dbcur = conn.cursor()
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+
+    to_be_added = check_each_table(tables, dbcur, bucketname)
+
+    assert to_be_added == []
+    mock_get_parquet.assert_not_called()
+
+
+def test_iter_table_batches_yields_fetch_size_rows_at_a_time():
+    """
+    The server-side cursor returns the 5 seeded addresses in
+    batches of at most fetch_size rows.
+    """
+
+    # Connect to the local test totesys database
+    conn = make_connection('config/.env.test')
+    dbcur = conn.cursor()
+
+    batches = list(iter_table_batches(
+        dbcur, whole_table_sql(['address']), fetch_size=2))
+
+    assert [batch.num_rows for batch in batches] == [2, 2, 1]
+    assert batches[0].schema.names[0] == 'address_id'
+    assert batches[0].schema.field('created_at').type == pa.timestamp('us')
+    conn.rollback()
+
+
+def test_streaming_extraction_writes_one_row_group_per_batch(mock_bucket,
+                                                             premock_s3):
+    """
+    Streams the seeded tables into the bucket 2 rows at a time.
+    The parquet files hold the same data as a batch extraction,
+    split into row groups of 2 rows.
+    """
+
+    # Execute a streaming extraction with the seeded Totesys database
+    extract_lambda_handler({
+        'dotenv_path_string': 'config/.env.test',
+        'mode': 'stream',
+        'fetch_size': 2
+    })
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+    # Get the response JSON from listing an S3 bucket's contents
+    response = get_file_info_in_bucket(bucketname)
+
+    sales_order_df = get_parquet('sales_order', bucketname, response)
+    assert sales_order_df.shape == (6, 12)
+    assert sales_order_df.loc[sales_order_df.sales_order_id == 4][[
+        'staff_id']].values[0] == 1
+
+    key = get_table_keys('sales_order', response)[0]
+    body = premock_s3.get_object(Bucket=bucketname, Key=key)['Body'].read()
+    assert pq.ParquetFile(BytesIO(body)).num_row_groups == 3
+
+    watermarks = get_watermarks(bucketname)
+    assert watermarks['sales_order']['row_count'] == 6
+    assert watermarks['sales_order']['created_at'] == '2023-01-01 10:00:00'
+
+
+def test_parallel_extraction_pushes_every_table(mock_bucket, premock_s3):
+    """
+    Extracts the seeded tables three at a time, each on its own
+    connection, and checks every table reached the bucket.
+    """
+
+    extract_lambda_handler({
+        'dotenv_path_string': 'config/.env.test',
+        'mode': 'parallel',
+        'max_workers': 3
+    })
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+    # Get the response JSON from listing an S3 bucket's contents
+    response = get_file_info_in_bucket(bucketname)
+
+    file_names = [content['Key'] for content in response['Contents']]
+    assert len([name for name in file_names if name.endswith('.parquet')]) \
+        == 11
+    assert all(check_table_in_bucket(title, response) for title in (
+        ['design'], ['payment'], ['transaction']))
+    design_df = get_parquet('design', bucketname, response)
+    assert design_df.shape == (6, 6)
+    assert len(get_watermarks(bucketname)) == 11
+
+
+def test_parallel_extraction_reports_failed_tables(mock_bucket):
+    """
+    One table failing does not stop the others being pushed
+    and having their watermarks moved on.
+    """
+
+    def fail_on_staff(dbcur, title, *args):
+        if title[0] == 'staff':
+            raise Exception('connection dropped')
+        return stream_table_to_cloud(dbcur, title, *args)
+
+    with patch('src.extract.stream_table_to_cloud',
+               side_effect=fail_on_staff):
+        with pytest.raises(Exception, match='staff'):
+            extract_lambda_handler({
+                'dotenv_path_string': 'config/.env.test',
+                'mode': 'parallel'
+            })
+
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+    watermarks = get_watermarks(bucketname)
+
+    assert len(watermarks) == 10
+    assert 'staff' not in watermarks
+
+
+def test_get_table_keys_orders_parts_by_run_and_part():
+    """
+    Parts are returned oldest run first, then in part order, with a file
+    from before the partitioned layout first of all.
+    """
+
+    keys = [
+        make_part_key('payment', '20230102T000000000000Z', 10),
+        make_part_key('payment', '20230102T000000000000Z', 2),
+        make_part_key('payment', '20230101T000000000000Z', 0),
+        make_part_key('payments', '20230101T000000000000Z', 0),
+        'payment.parquet',
+        'watermarks.json'
+    ]
+    response = {
+        'KeyCount': len(keys),
+        'Contents': [{'Key': key} for key in keys]
+    }
+
+    assert keys[0] == ('table=payment/extracted_date=2023-01-02/'
+                       'run=20230102T000000000000Z/part-10.parquet')
+    assert get_table_keys('payment', response) == [
+        'payment.parquet', keys[2], keys[1], keys[0]]
+    assert get_table_keys(
+        'payment', response, runs=['20230102T000000000000Z']) == [
+        keys[1], keys[0]]
+    assert get_table_runs('payment', response) == [
+        '20230101T000000000000Z', '20230102T000000000000Z']
+
+
+def test_s3_multipart_writer_uploads_in_parts(mock_bucket, premock_s3):
+    """
+    Writing more than one part's worth of bytes uses a multipart upload,
+    and the object reassembles to exactly what was written.
+    """
+
+    body = os.urandom(MIN_PART_SIZE * 2 + 1000)
+    with S3MultipartWriter('scrumptious-squad-in-data-testmock', 'big.bin',
+                           part_size=MIN_PART_SIZE) as sink:
+        for start in range(0, len(body), 1024 * 1024):
+            sink.write(body[start:start + 1024 * 1024])
+        assert sink.tell() == len(body)
+
+    response = premock_s3.get_object(
+        Bucket='scrumptious-squad-in-data-testmock', Key='big.bin')
+    assert response['Body'].read() == body
+    assert response['ETag'].endswith('-3"')
+
+
+def test_s3_multipart_writer_aborts_on_error(mock_bucket, premock_s3):
+    """
+    An exception while writing leaves nothing behind in the bucket.
+    """
+
+    with pytest.raises(ValueError):
+        with S3MultipartWriter('scrumptious-squad-in-data-testmock',
+                               'broken.bin',
+                               part_size=MIN_PART_SIZE) as sink:
+            sink.write(os.urandom(MIN_PART_SIZE + 1))
+            raise ValueError('query failed')
+
+    response = premock_s3.list_objects_v2(
+        Bucket='scrumptious-squad-in-data-testmock')
+    assert response['KeyCount'] == 0
+    uploads = premock_s3.list_multipart_uploads(
+        Bucket='scrumptious-squad-in-data-testmock')
+    assert 'Uploads' not in uploads
+
+
+def test_copy_whole_table_matches_row_by_row_fetch():
+    """
+    COPY gives the same rows as the row protocol, with each column
+    typed from the table's definition.
+    """
+
+    # Connect to the local test totesys database
+    conn = make_connection('config/.env.test')
+    dbcur = conn.cursor()
+
+    for title in (['address'], ['payment'], ['sales_order']):
+        table = copy_whole_table(dbcur, title)
+        rows, keys = get_whole_table(dbcur, title)
+
+        assert table.column_names == keys
+        assert table.to_pylist() == \
+            rows_to_table(rows, dbcur.description).to_pylist()
+
+    assert table.schema.field('unit_price').type == pa.decimal128(38, 10)
+    assert table.schema.field('created_at').type == pa.timestamp('us')
+    assert table.column('unit_price')[1].as_py() == Decimal('2.00')
+    payment = copy_whole_table(dbcur, ['payment'])
+    assert payment.schema.field('paid').type == pa.bool_()
+    assert payment.schema.field('payment_date').type == pa.string()
+    assert payment.column('paid')[1].as_py() is True
+
+
+def test_copy_snapshot_extraction(mock_bucket):
+    """
+    A first extraction using COPY pushes the same tables as the
+    default row by row extraction.
+    """
+
+    extract_lambda_handler({
+        'dotenv_path_string': 'config/.env.test',
+        'snapshot_method': 'copy'
+    })
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+    # Get the response JSON from listing an S3 bucket's contents
+    response = get_file_info_in_bucket(bucketname)
+
+    sales_order_df = get_parquet('sales_order', bucketname, response)
+    assert sales_order_df.shape == (6, 12)
+    assert sales_order_df.loc[sales_order_df.sales_order_id == 4][[
+        'staff_id']].values[0] == 1
+    assert get_watermarks(bucketname)['sales_order']['row_count'] == 6
+
+
+def test_rows_to_table_types_columns_from_the_description():
+    """
+    Rows are converted straight to typed Arrow columns: numeric as
+    decimal, timestamps as timestamps and the agreed dates as dates.
+    """
+
+    # Connect to the local test totesys database
+    conn = make_connection('config/.env.test')
+    dbcur = conn.cursor()
+    rows, keys = get_whole_table(dbcur, ['sales_order'])
+
+    table = rows_to_table(rows, dbcur.description)
+
+    assert table.column_names == keys
+    assert table.num_rows == 6
+    assert table.schema.field('sales_order_id').type == pa.int32()
+    assert table.schema.field('unit_price').type == pa.decimal128(38, 10)
+    assert table.schema.field('last_updated').type == pa.timestamp('us')
+    assert table.schema.field('agreed_delivery_date').type == pa.date32()
+    assert table.column('agreed_delivery_date')[0].as_py() == date(2023, 1, 1)
+    assert table.column('unit_price')[1].as_py() == Decimal('2.00')
+
+    # The COPY snapshot gives the same types
+    assert copy_whole_table(dbcur, ['sales_order']).schema == table.schema
+
+
+def test_keyset_backfill_pushes_a_part_per_page(mock_bucket, premock_s3,
+                                                indexed_sales_order):
+    """
+    A keyset backfill of 2 rows a page pushes sales_order in three
+    parts of one run, and leaves no checkpoint once it is done.
+    """
+
+    extract_lambda_handler({
+        'dotenv_path_string': 'config/.env.test',
+        'mode': 'stream',
+        'snapshot_method': 'keyset',
+        'page_size': 2
+    })
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+    # Get the response JSON from listing an S3 bucket's contents
+    response = get_file_info_in_bucket(bucketname)
+
+    keys = get_table_keys('sales_order', response)
+    assert [parse_part_key(key)['part'] for key in keys] == [0, 1, 2]
+    sales_order_df = get_parquet('sales_order', bucketname, response)
+    assert list(sales_order_df.sales_order_id) == [1, 2, 3, 4, 5, 6]
+    assert not any(
+        file['Key'].startswith('checkpoints/')
+        for file in response['Contents'])
+    assert get_watermarks(bucketname)['sales_order']['row_count'] == 6
+
+    conn = make_connection('config/.env.test')
+    assert get_key_column(conn.cursor(), ['sales_order']) == 'sales_order_id'
+    conn.rollback()
+    conn.close()
+
+
+def test_keyset_backfill_of_an_unindexed_key_reads_with_a_cursor(
+        mock_bucket, caplog):
+    """
+    Without an index on sales_order_id every page would scan the table,
+    so it is read in one part with a cursor instead, and said so.
+    """
+
+    extract_lambda_handler({
+        'dotenv_path_string': 'config/.env.test',
+        'mode': 'stream',
+        'snapshot_method': 'keyset',
+        'page_size': 2
+    })
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+    response = get_file_info_in_bucket(bucketname)
+
+    keys = get_table_keys('sales_order', response)
+    assert [parse_part_key(key)['part'] for key in keys] == [0]
+    sales_order_df = get_parquet('sales_order', bucketname, response)
+    assert list(sales_order_df.sales_order_id) == [1, 2, 3, 4, 5, 6]
+    assert 'sales_order has no index on its key column' in caplog.text
+
+
+def test_unknown_mode_is_warned_about(mock_bucket, caplog):
+    """
+    A mode index() does not know runs as batch, and says so.
+    """
+
+    extract_lambda_handler({
+        'dotenv_path_string': 'config/.env.test',
+        'mode': 'steam'
+    })
+    assert "Unknown mode 'steam', running in batch mode" in caplog.text
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+    assert len(get_watermarks(bucketname)) == 11
+
+
+def test_keyset_backfill_resumes_from_its_checkpoint(mock_bucket,
+                                                     indexed_sales_order):
+    """
+    A backfill that fails part way through carries on after the last
+    key it checkpointed, without paging any row twice, then catches up
+    with the rows changed since it started, even those already paged.
+    """
+
+    def fail_on_third_page(values, bucketname, key, *args):
+        if key.startswith('table=sales_order/') and 'part-2' in key:
+            raise Exception('connection dropped')
+        return upload_parquet(values, bucketname, key, *args)
+
+    event = {
+        'dotenv_path_string': 'config/.env.test',
+        'mode': 'stream',
+        'snapshot_method': 'keyset',
+        'page_size': 2
+    }
+    with patch('src.extract.upload_parquet',
+               side_effect=fail_on_third_page):
+        with pytest.raises(Exception, match='connection dropped'):
+            extract_lambda_handler(event)
+
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+    assert 'created_at' not in get_watermarks(bucketname).get(
+        'sales_order', {})
+
+    # A batch run leaves the backfill alone
+    extract_lambda_handler({'dotenv_path_string': 'config/.env.test'})
+    assert 'created_at' not in get_watermarks(bucketname).get(
+        'sales_order', {})
+
+    # An order already paged changes before one still to be paged,
+    # which moves the watermark past the first change
+    conn = make_connection('config/.env.test')
+    dbcur = conn.cursor()
+    # Kept in key order, as the other tests read the table unordered
+    dbcur.execute("""CREATE TEMP TABLE sales_order_backup AS
+        SELECT * FROM sales_order ORDER BY sales_order_id;""")
+    for sales_order_id in [1, 6]:
+        dbcur.execute(
+            """UPDATE sales_order SET units_sold = 99,
+            last_updated = LOCALTIMESTAMP WHERE sales_order_id = %s""",
+            (sales_order_id,))
+        conn.commit()
+    try:
+        # The next stream run finishes it, whatever its snapshot_method
+        extract_lambda_handler({
+            'dotenv_path_string': 'config/.env.test',
+            'mode': 'stream'
+        })
+    finally:
+        dbcur.execute('DELETE FROM sales_order')
+        dbcur.execute(
+            'INSERT INTO sales_order SELECT * FROM sales_order_backup')
+        dbcur.execute('DROP TABLE sales_order_backup')
+        conn.commit()
+        conn.close()
+    response = get_file_info_in_bucket(bucketname)
+
+    assert len(get_table_runs('sales_order', response)) == 1
+    keys = get_table_keys('sales_order', response)
+    assert [parse_part_key(key)['part'] for key in keys] == [0, 1, 2, 3]
+    sales_order_df = get_parquet('sales_order', bucketname, response)
+    assert list(sales_order_df.sales_order_id) == [1, 2, 3, 4, 5, 6, 1, 6]
+    newest = sales_order_df.drop_duplicates('sales_order_id', keep='last')
+    assert list(newest.set_index(
+        'sales_order_id').units_sold[[1, 6]]) == [99, 99]
+    # Six paged rows and the two caught up
+    assert get_watermarks(bucketname)['sales_order']['row_count'] == 8
+
+
+def test_get_cached_keeps_values_until_stale_or_invalidated():
+    """
+    A cached value is made once, then served until it is older than
+    its kind's TTL or is invalidated. None is never kept.
+    """
+    made = []
+
+    def make():
+        made.append(1)
+        return 'scrumptious-squad-in-data-testmock'
+
+    assert get_cached('bucket_name', 'prefix', make) == \
+        'scrumptious-squad-in-data-testmock'
+    get_cached('bucket_name', 'prefix', make)
+    assert len(made) == 1
+    assert cache_stats['bucket_name'] == {'hits': 1, 'misses': 1}
+
+    invalidate_cache('bucket_name', 'prefix')
+    get_cached('bucket_name', 'prefix', make)
+    assert len(made) == 2
+
+    with patch.dict(CACHE_TTLS, {'bucket_name': 0}):
+        get_cached('bucket_name', 'prefix', make)
+    assert len(made) == 3
+
+    assert get_cached('bucket_name', 'missing', lambda: None) is None
+    assert get_cached('bucket_name', 'missing', make) is not None
+    assert cache_stats['bucket_name']['misses'] == 5
+
+
+def test_get_cached_makes_values_outside_the_cache_lock():
+    """
+    While one value is being made, other keys are made and fresh ones
+    read without waiting for it, and the same key is made only once.
+    """
+    started = threading.Event()
+    release = threading.Event()
+    made = []
+
+    def make_slowly():
+        made.append(1)
+        started.set()
+        release.wait(5)
+        return 'slow'
+
+    def read_others():
+        values.append(get_cached('bucket_name', 'other', lambda: 'other'))
+        values.append(get_cached('bucket_name', 'fresh', make_slowly))
+
+    values = []
+    get_cached('bucket_name', 'fresh', lambda: 'fresh')
+    threads = [
+        threading.Thread(
+            target=get_cached, args=('bucket_name', 'slow', make_slowly))
+        for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    try:
+        assert started.wait(5)
+        reader = threading.Thread(target=read_others)
+        reader.start()
+        reader.join(2)
+        assert values == ['other', 'fresh']
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join()
+    assert get_cached('bucket_name', 'slow', make_slowly) == 'slow'
+    assert len(made) == 1
+    invalidate_cache('bucket_name')
+
+
+def test_a_failed_connection_drops_the_cached_secret():
+    """
+    The secret may have been rotated, so a connection it fails to make
+    has it fetched afresh next time, as load does.
+    """
+    get_cached('secret', 'source_DB', lambda: (
+        'totesys', 'user', 'old password', 'localhost', 5432))
+    with patch('src.extract.pg8000.connect',
+               side_effect=Exception('password authentication failed')):
+        with pytest.raises(Exception, match='ERROR CONNECTING TO localhost'):
+            make_connection('config/.env.development')
+    assert ('secret', 'source_DB') not in cache
+
+
+@pytest.fixture
+def cdc_sample_table():
+    """
+    Publishes a scratch table through its own replication slot,
+    dropping all three afterwards.
+    """
+    conn = make_connection('config/.env.test')
+    dbcur = conn.cursor()
+    dbcur.execute("""CREATE TABLE cdc_sample (
+        cdc_sample_id INT PRIMARY KEY, name VARCHAR, paid BOOLEAN,
+        created_at TIMESTAMP, last_updated TIMESTAMP);""")
+    dbcur.execute("""INSERT INTO cdc_sample VALUES
+        (1, 'first', false, '2023-01-01 10:00:00', '2023-01-01 10:00:00');""")
+    conn.commit()
+    setup_replication(
+        conn, [['cdc_sample']], 'test_extract_slot', 'test_extract_pub')
+
+    yield conn
+
+    conn.rollback()
+    drop_replication(conn, 'test_extract_slot', 'test_extract_pub')
+    dbcur = conn.cursor()
+    dbcur.execute('DROP TABLE cdc_sample')
+    conn.commit()
+    conn.close()
+
+
+def test_cdc_pushes_changes_and_only_then_advances_the_slot(
+        cdc_sample_table, mock_bucket):
+    """
+    An insert, an update and a delete are read from the slot into
+    typed parts, one part per transaction when max_changes is 1.
+    A failed push leaves the changes in the slot for the next run.
+    """
+    conn = cdc_sample_table
+    dbcur = conn.cursor()
+    dbcur.execute("""INSERT INTO cdc_sample VALUES
+        (2, 'second', false, '2023-01-02 10:00:00', '2023-01-02 10:00:00');""")
+    conn.commit()
+    dbcur.execute("""UPDATE cdc_sample
+        SET paid = true, last_updated = '2023-01-03 10:00:00'
+        WHERE cdc_sample_id = 1;""")
+    conn.commit()
+    dbcur.execute('DELETE FROM cdc_sample WHERE cdc_sample_id = 2')
+    conn.commit()
+
+    bucketname = 'scrumptious-squad-in-data-testmock'
+    options = dict(DEFAULT_OPTIONS, max_changes=1)
+    with patch('src.extract.upload_parquet',
+               side_effect=Exception('connection dropped')):
+        with pytest.raises(Exception, match='connection dropped'):
+            cdc_to_cloud(conn, bucketname, options, slot='test_extract_slot',
+                         publication='test_extract_pub')
+
+    summaries = cdc_to_cloud(conn, bucketname, options,
+                             slot='test_extract_slot',
+                             publication='test_extract_pub')
+
+    assert summaries['cdc_sample']['row_count'] == 3
+    assert str(summaries['cdc_sample']['last_updated']) == \
+        '2023-01-03 10:00:00'
+    response = get_file_info_in_bucket(bucketname)
+    assert len(get_table_keys('cdc_sample', response)) == 3
+    changes = get_parquet('cdc_sample', bucketname, response)
+    assert list(changes.change_type) == ['insert', 'update', 'delete']
+    assert list(changes.cdc_sample_id) == [2, 1, 2]
+    assert changes.paid[1] == True  # noqa: E712
+    assert changes.created_at[1] == pd.Timestamp('2023-01-01 10:00:00')
+
+    assert not get_replication_changes(
+        conn.cursor(), 'test_extract_slot', 'test_extract_pub')
+
+
+def test_cdc_truncate_deletes_the_parts_pushed_before_it(
+        cdc_sample_table, mock_bucket):
+    """
+    Once a table is truncated the rows pushed before are gone, along
+    with any change read before the truncate, leaving the rows
+    inserted after it.
+    """
+    conn = cdc_sample_table
+    dbcur = conn.cursor()
+    bucketname = 'scrumptious-squad-in-data-testmock'
+    dbcur.execute("""INSERT INTO cdc_sample VALUES
+        (2, 'second', false, '2023-01-02 10:00:00', '2023-01-02 10:00:00');""")
+    conn.commit()
+    cdc_to_cloud(conn, bucketname, slot='test_extract_slot',
+                 publication='test_extract_pub', run_id='20230102T100000Z')
+
+    dbcur.execute("""INSERT INTO cdc_sample VALUES
+        (3, 'third', false, '2023-01-03 10:00:00', '2023-01-03 10:00:00');""")
+    dbcur.execute('TRUNCATE cdc_sample')
+    dbcur.execute("""INSERT INTO cdc_sample VALUES
+        (4, 'fourth', true, '2023-01-04 10:00:00', '2023-01-04 10:00:00');""")
+    conn.commit()
+    summaries = cdc_to_cloud(conn, bucketname, slot='test_extract_slot',
+                             publication='test_extract_pub')
+
+    assert summaries['cdc_sample']['row_count'] == 1
+    response = get_file_info_in_bucket(bucketname)
+    assert len(get_table_keys('cdc_sample', response)) == 1
+    changes = get_parquet('cdc_sample', bucketname, response)
+    assert list(changes.cdc_sample_id) == [4]
+    assert list(changes.change_type) == ['insert']
+
+
+def test_unchanged_tables_are_not_queried(mock_bucket):
+    """
+    Once every table has been extracted, only the tables written to
+    since, by their pg_stat_user_tables counts, are queried again.
+    """
+
+    extract_lambda_handler({'dotenv_path_string': 'config/.env.test'})
+
+    with patch('src.extract.get_recents_table',
+               side_effect=get_recents_table) as mock_recents:
+        extract_lambda_handler({'dotenv_path_string': 'config/.env.test'})
+        assert mock_recents.call_count == 0
+
+        conn = make_connection('config/.env.test')
+        dbcur = conn.cursor()
+        dbcur.execute("""INSERT INTO currency VALUES
+            (4, 'JPY', '2023-05-05 10:00:00', '2023-05-05 10:00:00');""")
+        conn.commit()
+        # Publish the counts now rather than within the next second
+        dbcur.execute('SELECT pg_stat_force_next_flush();')
+        conn.commit()
+        try:
+            extract_lambda_handler(
+                {'dotenv_path_string': 'config/.env.test'})
+        finally:
+            dbcur.execute('DELETE FROM currency WHERE currency_id = 4')
+            conn.commit()
+            conn.close()
+
+    assert [call.args[1] for call in mock_recents.call_args_list] == [
+        ['currency']]
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+    watermarks = get_watermarks(bucketname)
+    assert watermarks['currency']['created_at'] == '2023-05-05 10:00:00'
+    assert len(watermarks['design']['table_stats']) == 3
+
+
+def test_bucket_is_listed_once_and_only_for_new_tables(mock_bucket):
+    """
+    The first run lists the bucket once for every table and mode step,
+    later runs read every table from its watermark without listing it.
+    """
+
+    with patch('src.extract.get_file_info_in_bucket',
+               side_effect=get_file_info_in_bucket) as mock_listing:
+        extract_lambda_handler({
+            'dotenv_path_string': 'config/.env.test',
+            'mode': 'stream'
+        })
+        assert mock_listing.call_count == 1
+
+        for mode in ['batch', 'stream', 'pipeline', 'parallel']:
+            extract_lambda_handler({
+                'dotenv_path_string': 'config/.env.test',
+                'mode': mode,
+                'skip_unchanged': False
+            })
+        assert mock_listing.call_count == 1
+
+
+def test_workers_read_as_of_the_exported_snapshot():
+    """
+    A row committed after the coordinator exported its snapshot is not
+    seen by a worker reading from that snapshot.
+    """
+    coordinator = make_connection('config/.env.test')
+    writer = make_connection('config/.env.test')
+    worker = make_connection('config/.env.test')
+    snapshot_id = export_snapshot(coordinator)
+
+    writer_cur = writer.cursor()
+    writer_cur.execute("""INSERT INTO currency VALUES
+        (4, 'JPY', '2023-05-05 10:00:00', '2023-05-05 10:00:00');""")
+    writer.commit()
+    try:
+        worker_cur = worker.cursor()
+        import_snapshot(worker_cur, snapshot_id)
+        worker_cur.execute('SELECT COUNT(*) FROM currency')
+        assert worker_cur.fetchall()[0][0] == 3
+        worker.rollback()
+
+        worker_cur.execute('SELECT COUNT(*) FROM currency')
+        assert worker_cur.fetchall()[0][0] == 4
+    finally:
+        writer_cur.execute('DELETE FROM currency WHERE currency_id = 4')
+        writer.commit()
+        for conn in (coordinator, writer, worker):
+            conn.close()
+
+
+def test_parallel_extraction_splits_big_tables_into_key_ranges(
+        mock_bucket, indexed_sales_order, caplog):
+    """
+    With 2 rows per split, the analysed and indexed sales_order is read
+    as three key ranges at once, each pushed as its own part. A table
+    with no index on its key is read whole.
+    """
+    conn = make_connection('config/.env.test')
+    dbcur = conn.cursor()
+    dbcur.execute('ANALYZE sales_order')
+    ranges = plan_key_ranges(dbcur, ['sales_order'], 3)
+    assert ranges == [
+        ('sales_order_id', None, 3),
+        ('sales_order_id', 3, 4),
+        ('sales_order_id', 4, None)]
+    assert plan_key_ranges(dbcur, ['currency'], 1) == [None]
+    assert plan_key_ranges(dbcur, ['counterparty'], 3) == [None]
+    assert 'no index on counterparty_id' in caplog.text
+    conn.rollback()
+    conn.close()
+
+    extract_lambda_handler({
+        'dotenv_path_string': 'config/.env.test',
+        'mode': 'parallel',
+        'max_workers': 3,
+        'rows_per_split': 2
+    })
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+    # Get the response JSON from listing an S3 bucket's contents
+    response = get_file_info_in_bucket(bucketname)
+
+    assert len(get_table_keys('sales_order', response)) == 3
+    sales_order_df = get_parquet('sales_order', bucketname, response)
+    assert sorted(sales_order_df.sales_order_id) == [1, 2, 3, 4, 5, 6]
+    assert get_watermarks(bucketname)['sales_order']['row_count'] == 6
+
+
+def test_extract_plan_is_written_and_can_be_overridden(
+        mock_bucket, premock_s3, indexed_sales_order):
+    """
+    The plan picks a snapshot for tables never extracted and an
+    incremental read after that, splitting the analysed sales_order,
+    without needing the bucket listed once a table has a watermark.
+    The event can override a table's plan, and each run's plan is
+    written to the bucket.
+    """
+    conn = make_connection('config/.env.test')
+    dbcur = conn.cursor()
+    dbcur.execute('ANALYZE sales_order')
+    options = dict(DEFAULT_OPTIONS, rows_per_split=2, max_workers=3)
+    response = {'KeyCount': 0, 'Contents': []}
+    plans = plan_extract([['sales_order']], dbcur, {}, response, options)
+    assert plans['sales_order']['strategy'] == 'snapshot'
+    assert plans['sales_order']['splits'] == 3
+    plans = plan_extract(
+        [['sales_order']], dbcur,
+        {'sales_order': {'created_at': '2023-01-01 10:00:00'}}, None,
+        dict(options, plan={'sales_order': {'splits': 1}}))
+    assert plans['sales_order']['strategy'] == 'incremental'
+    assert plans['sales_order']['splits'] == 1
+    assert plans['sales_order']['overridden'] == ['splits']
+    with pytest.raises(ValueError):
+        plan_extract([['sales_order']], dbcur, {}, response,
+                     dict(options, plan={'sales_order': {'mode': 'x'}}))
+    conn.rollback()
+    conn.close()
+
+    extract_lambda_handler({
+        'dotenv_path_string': 'config/.env.test',
+        'mode': 'parallel',
+        'plan': {'sales_order': {'splits': 2}}
+    })
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+    response = get_file_info_in_bucket(bucketname)
+
+    plan_keys = [
+        file['Key'] for file in response['Contents']
+        if file['Key'].startswith('plans/')]
+    assert len(plan_keys) == 1
+    plan = json.loads(premock_s3.get_object(
+        Bucket=bucketname, Key=plan_keys[0])['Body'].read())
+    assert plan['mode'] == 'parallel'
+    assert len(plan['tables']) == 11
+    assert len(plan['tables']['sales_order']['ranges']) == 2
+    assert len(get_table_keys('sales_order', response)) == 2
+    assert get_watermarks(bucketname)['sales_order']['seconds'] > 0
+
+
+def test_plan_overrides_a_mode_cannot_apply_are_warned_about(
+        mock_bucket, premock_s3, caplog):
+    """
+    Batch mode reads tables whole, so the keyset pages and key ranges
+    planned for sales_order are ignored, said so, and noted in the plan.
+    """
+
+    extract_lambda_handler({
+        'dotenv_path_string': 'config/.env.test',
+        'plan': {'sales_order': {'snapshot_method': 'keyset', 'splits': 2}}
+    })
+    assert 'batch mode ignores the snapshot_method, splits planned ' \
+        'for sales_order' in caplog.text
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+    response = get_file_info_in_bucket(bucketname)
+    assert len(get_table_keys('sales_order', response)) == 1
+    plan_key = [
+        file['Key'] for file in response['Contents']
+        if file['Key'].startswith('plans/')][0]
+    plan = json.loads(premock_s3.get_object(
+        Bucket=bucketname, Key=plan_key)['Body'].read())
+    assert plan['tables']['sales_order']['ignored'] == [
+        'snapshot_method', 'splits']
+    assert 'ignored' not in plan['tables']['currency']
+
+
+def test_pipelined_extraction_pushes_every_table(mock_bucket):
+    """
+    Pushing each table while the next is queried gives the same
+    bucket as a batch extraction.
+    """
+
+    extract_lambda_handler({
+        'dotenv_path_string': 'config/.env.test',
+        'mode': 'pipeline'
+    })
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+    # Get the response JSON from listing an S3 bucket's contents
+    response = get_file_info_in_bucket(bucketname)
+
+    sales_order_df = get_parquet('sales_order', bucketname, response)
+    assert sales_order_df.shape == (6, 12)
+    assert all(check_table_in_bucket([table], response) for table in
+               get_watermarks(bucketname))
+    assert len(get_watermarks(bucketname)) == 11
+
+
+def test_pipelined_extraction_fails_if_an_upload_fails(mock_bucket):
+    """
+    A failed upload fails the run, after every other table is pushed
+    and has its marks moved on. The failed table keeps its marks.
+    """
+
+    def fail_on_staff(local_object, *args):
+        if 'staff' in local_object:
+            raise Exception('connection dropped')
+        return push_to_cloud(local_object, *args)
+
+    with patch('src.extract.push_to_cloud', side_effect=fail_on_staff):
+        with pytest.raises(Exception, match='staff'):
+            extract_lambda_handler({
+                'dotenv_path_string': 'config/.env.test',
+                'mode': 'pipeline'
+            })
+
+    # Get full bucket name from a prefix
+    bucketname = get_bucket_name('scrumptious-squad-in-data-')
+    watermarks = get_watermarks(bucketname)
+    assert 'created_at' not in watermarks.get('staff', {})
+    assert len([
+        key for key, marks in watermarks.items()
+        if 'created_at' in marks]) == 10
+    response = get_file_info_in_bucket(bucketname)
+    assert not get_table_keys('staff', response)
+    assert get_table_keys('sales_order', response)
@@ -106,6 +106,23 @@ def test_get_data_dim_currrency(s3_client):
     pd.testing.assert_frame_equal(expectedfile, dfs["df_dim_currency"])
 
 
+@mock_s3
+def test_get_data_reads_past_the_first_page_of_keys(s3_client):
+    readtable = pq.read_table('./load_test_db/dim_currency.parquet')
+    expectedfile = readtable.to_pandas()
+    bucket_name = "test_bucket_29"
+    s3_client.create_bucket(Bucket=bucket_name)
+    # A listing call returns the first 1000 keys, these sort before it
+    for number in range(1000):
+        s3_client.put_object(
+            Bucket=bucket_name, Key=f"data/state/{number:04}.json", Body=b'')
+    with open('./load_test_db/dim_currency.parquet', 'rb') as file:
+        s3_client.upload_fileobj(
+            file, bucket_name, "data/types/dim_currency.parquet")
+    dfs = get_data('test_bucket')
+    pd.testing.assert_frame_equal(expectedfile, dfs["df_dim_currency"])
+
+
 def test_load_data_to_warehouse(s3_client):
     secret_id = 'test_secret_id'
     bucket_prefix = 'test'
@@ -2,14 +2,21 @@
 the exreact function will get data updates from the data lake
 and push it to the ingested data s3 bucket in parquet format
 """
+import json
 import pandas as pd
-from src.extract import (index)
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datetime import date, time
+from src.extract import (index, add_updates)
 import pytest
 import os
 from moto import (mock_s3)
 import boto3
+from io import BytesIO
+from unittest.mock import patch
 from src.transform import (
     get_parquet,
+    get_table_keys,
     create_dim_date,
     create_dim_location,
     create_dim_design,
@@ -21,6 +28,24 @@ from src.transform import (
     create_fact_sales_order,
     create_fact_purchase_order,
     create_fact_payment,
+    push_to_cloud,
+    get_parquets,
+    transform,
+    transform_incrementally,
+    extend_dim_date,
+    build_dim,
+    get_tables,
+    concat_parts,
+    ARROW_BUILDERS,
+    OUTPUT_BUILDERS,
+    DEFAULT_OPTIONS,
+    run_dag,
+    encode_categories,
+    stream_fact,
+    download_object,
+    transform_lambda_handler,
+    cache_stats,
+    invalidate_cache
 )
 
 
@@ -135,15 +160,15 @@ def test_fact_sales_order(mock_bucket_and_parquet_files):
     assert fact_sales_order.shape[1] == 14
     assert fact_sales_order['sales_order_id'][0] == 1
     assert fact_sales_order['sales_order_id'][1] == 2
-    assert fact_sales_order['created_date'][0] == '2023-01-01'
-    assert fact_sales_order['created_time'][0] == '10:00:00'
-    assert fact_sales_order['last_updated_date'][0] == '2023-01-01'
-    assert fact_sales_order['last_updated_time'][0] == '10:00:00'
+    assert fact_sales_order['created_date'][0] == date(2023, 1, 1)
+    assert fact_sales_order['created_time'][0] == time(10, 0)
+    assert fact_sales_order['last_updated_date'][0] == date(2023, 1, 1)
+    assert fact_sales_order['last_updated_time'][0] == time(10, 0)
     assert fact_sales_order['sales_staff_id'][1] == 2
     assert fact_sales_order['counterparty_id'][1] == 2
     assert fact_sales_order['units_sold'][0] == 10
     assert fact_sales_order['unit price'][1] == 2.00
-    assert fact_sales_order['agreed_delivery_date'][0] == '2023-01-01'
+    assert fact_sales_order['agreed_delivery_date'][0] == date(2023, 1, 1)
     assert fact_sales_order['agreed_delivery_location_id'][4] == 5
 
 
@@ -153,16 +178,17 @@ def test_fact_purchase_order(mock_bucket_and_parquet_files):
     assert fact_purchase_order.shape[1] == 14
     assert fact_purchase_order['purchase_order_id'][0] == 1
     assert fact_purchase_order['purchase_order_id'][1] == 2
-    assert fact_purchase_order['created_date'][0] == '2023-01-01'
-    assert fact_purchase_order['created_time'][0] == '10:00:00'
-    assert fact_purchase_order['last_updated_date'][0] == '2023-01-01'
-    assert fact_purchase_order['last_updated_time'][0] == '10:00:00'
+    assert fact_purchase_order['created_date'][0] == date(2023, 1, 1)
+    assert fact_purchase_order['created_time'][0] == time(10, 0)
+    assert fact_purchase_order['last_updated_date'][0] == date(2023, 1, 1)
+    assert fact_purchase_order['last_updated_time'][0] == time(10, 0)
     assert fact_purchase_order['staff_id'][1] == 2
     assert fact_purchase_order['counterparty_id'][1] == 2
     assert fact_purchase_order['item_code'][0] == 'AAAAAAA'
     assert fact_purchase_order['item_quantity'][0] == 1
     assert fact_purchase_order['item_unit_price'][4] == 10.00
-    assert fact_purchase_order['agreed_delivery_date'][0] == '2023-01-01'
+    assert fact_purchase_order['agreed_delivery_date'][0] == date(
+        2023, 1, 1)
     assert fact_purchase_order['agreed_delivery_location_id'][1] == 2
 
 
@@ -172,10 +198,10 @@ def test_fact_payment(mock_bucket_and_parquet_files):
     assert fact_payment.shape[1] == 12
     assert fact_payment['payment_id'][0] == 1
     assert fact_payment['payment_id'][1] == 2
-    assert fact_payment['created_date'][0] == '2023-01-01'
-    assert fact_payment['created_time'][0] == '10:00:00'
-    assert fact_payment['last_updated_date'][0] == '2023-01-01'
-    assert fact_payment['last_updated'][0] == '10:00:00'
+    assert fact_payment['created_date'][0] == date(2023, 1, 1)
+    assert fact_payment['created_time'][0] == time(10, 0)
+    assert fact_payment['last_updated_date'][0] == date(2023, 1, 1)
+    assert fact_payment['last_updated'][0] == time(10, 0)
     assert fact_payment['transaction_id'][1] == 2
     assert fact_payment['counterparty_id'][1] == 2
     assert fact_payment['payment_amount'][0] == 10.00
@@ -183,3 +209,482 @@ def test_fact_payment(mock_bucket_and_parquet_files):
     assert fact_payment['payment_type_id'][0] == 1
     assert fact_payment['paid'][1]
     assert fact_payment['payment_date'][1] == '2023-01-01'
+
+
+def test_get_parquet_reads_latest_row_versions_or_latest_run(
+        mock_bucket_and_parquet_files):
+    df_design = get_parquet('design')
+    assert df_design.shape == (6, 6)
+
+    # A later extraction pushes one changed design as a new run
+    df_design.loc[df_design.design_id == 2, 'design_name'] = 'design-z'
+    add_updates(
+        [{'design': df_design[df_design.design_id == 2]}],
+        'scrumptious-squad-in-data-testmock')
+    # As the next transform invocation does
+    invalidate_cache('listing')
+
+    df_design_current = get_parquet('design')
+    assert df_design_current.shape == (6, 6)
+    assert list(df_design_current['design_name']).count('design-z') == 1
+    assert 'design-b' not in list(df_design_current['design_name'])
+
+    df_design_latest = get_parquet('design', latest_only=True)
+    assert df_design_latest.shape == (1, 6)
+    assert df_design_latest['design_id'][0] == 2
+
+    df_design_arrow = get_tables(['design'])['design']
+    assert df_design_arrow.num_rows == 6
+    assert df_design_arrow['design_name'].to_pylist().count('design-z') == 1
+    assert get_parquet('not_a_table') is False
+
+
+def test_legacy_parts_are_read_as_the_types_of_the_typed_parts(
+        mock_bucket_and_parquet_files, premock_s3):
+    """
+    The sales_order.parquet pandas wrote before extract typed its parts,
+    with int64 ids, dates as text and prices as floats, is read along
+    with the typed parts by both engines and the streamed facts.
+    """
+    premock_s3.create_bucket(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+    typed = get_parquet('sales_order')
+    legacy = typed.astype({
+        'sales_order_id': 'int64', 'agreed_payment_date': str,
+        'agreed_delivery_date': str, 'unit_price': 'float64'})
+    legacy['sales_order_id'] += 100
+    buffer = BytesIO()
+    legacy.to_parquet(buffer)
+    premock_s3.put_object(
+        Bucket='scrumptious-squad-in-data-testmock',
+        Key='sales_order.parquet', Body=buffer.getvalue())
+    invalidate_cache('listing')
+
+    data_frame = get_parquet('sales_order')
+    assert len(data_frame) == 12
+    assert data_frame['agreed_payment_date'][0] == \
+        typed['agreed_payment_date'][0]
+    table = get_tables(['sales_order'])['sales_order']
+    assert table.schema.field('sales_order_id').type == pa.int32()
+    assert table.num_rows == 12
+
+    for engine in ['pandas', 'arrow']:
+        assert len(transform({
+            **DEFAULT_OPTIONS, 'engine': engine,
+            'skip_unchanged': False})) == 11
+    assert stream_fact(
+        'fact_sales_order', 'scrumptious-squad-pr-data-testmock')['rows'] == 12
+
+
+def test_get_table_keys_keeps_the_legacy_file_as_the_oldest_part():
+    keys = [
+        'design.parquet',
+        'table=design/extracted_date=2023-01-02/run=2/part-0.parquet',
+        'table=design/extracted_date=2023-01-01/run=1/part-0.parquet']
+    assert get_table_keys('design', keys) == [
+        'design.parquet',
+        'table=design/extracted_date=2023-01-01/run=1/part-0.parquet',
+        'table=design/extracted_date=2023-01-02/run=2/part-0.parquet']
+    assert get_table_keys('design', keys, latest_only=True) == [
+        'table=design/extracted_date=2023-01-02/run=2/part-0.parquet']
+    assert get_table_keys('design', ['design.parquet']) == ['design.parquet']
+
+
+def test_push_to_cloud_uploads_to_processed_bucket(
+        mock_bucket_and_parquet_files, premock_s3):
+    premock_s3.create_bucket(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+    dim_design = create_dim_design(get_parquet('design'))
+
+    assert push_to_cloud({'dim_design': dim_design})
+
+    response = premock_s3.get_object(
+        Bucket='scrumptious-squad-pr-data-testmock', Key='dim_design.parquet')
+    uploaded = pd.read_parquet(BytesIO(response['Body'].read()))
+    pd.testing.assert_frame_equal(uploaded, dim_design)
+
+
+def test_transform_lists_the_ingested_bucket_once(
+        mock_bucket_and_parquet_files, premock_s3):
+    """
+    The eleven tables are loaded from one cached listing, and the bucket
+    names and S3 client are only looked up the first time.
+    """
+    premock_s3.create_bucket(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+
+    transform_lambda_handler({}, None)
+
+    assert cache_stats['listing'] == {'hits': 11, 'misses': 2}
+    assert cache_stats['bucket_name'] == {'hits': 21, 'misses': 2}
+    assert cache_stats['client']['misses'] == 1
+
+
+def test_get_parquets_downloads_every_table_at_once(
+        mock_bucket_and_parquet_files):
+    data_frames = get_parquets(['design', 'sales_order', 'not_a_table'])
+    assert data_frames['design'].shape == (6, 6)
+    assert data_frames['sales_order'].shape == (6, 12)
+    assert data_frames['not_a_table'] is False
+
+
+def test_transform_incrementally_only_processes_new_parts(
+        mock_bucket_and_parquet_files, premock_s3):
+    premock_s3.create_bucket(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+
+    written = transform_incrementally()
+    assert written['fact_sales_order'] == 6
+    assert written['dim_design'] == 6
+    assert written['dim_counterparty'] == 4
+
+    # Nothing new has been extracted since
+    invalidate_cache('listing')
+    assert transform_incrementally() == {}
+
+    # A later extraction changes one design and one sales order
+    df_design = get_parquet('design')
+    df_design.loc[df_design.design_id == 2, 'design_name'] = 'design-z'
+    df_sales_order = get_parquet('sales_order')
+    add_updates(
+        [{'design': df_design[df_design.design_id == 2]},
+         {'sales_order': df_sales_order[df_sales_order.sales_order_id == 3]}],
+        'scrumptious-squad-in-data-testmock')
+    invalidate_cache('listing')
+
+    assert transform_incrementally() == {
+        'dim_design': 1, 'fact_sales_order': 1}
+
+    response = premock_s3.get_object(
+        Bucket='scrumptious-squad-pr-data-testmock', Key='dim_design.parquet')
+    dim_design = pd.read_parquet(BytesIO(response['Body'].read()))
+    assert dim_design.shape == (6, 4)
+    assert dim_design['design_name'][1] == 'design-z'
+    fact_keys = [
+        file['Key'] for file in premock_s3.list_objects_v2(
+            Bucket='scrumptious-squad-pr-data-testmock',
+            Prefix='fact_sales_order/')['Contents']]
+    assert len(fact_keys) == 2
+
+
+def test_transform_incrementally_drops_deleted_rows_from_dims(
+        mock_bucket_and_parquet_files, premock_s3):
+    """
+    A design and an address deleted through cdc leave dim_design,
+    dim_location and the counterparties at that address.
+    """
+    premock_s3.create_bucket(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+    transform_incrementally()
+
+    df_design = get_parquet('design')
+    df_address = get_parquet('address')
+    df_counterparty = get_parquet('counterparty')
+    address_id = df_counterparty.legal_address_id[0]
+    add_updates(
+        [{'design': df_design[df_design.design_id == 2].assign(
+            change_type='delete')},
+         {'address': df_address[df_address.address_id == address_id].assign(
+             change_type='delete')}],
+        'scrumptious-squad-in-data-testmock')
+    invalidate_cache('listing')
+    transform_incrementally()
+
+    def read_dim(output):
+        response = premock_s3.get_object(
+            Bucket='scrumptious-squad-pr-data-testmock',
+            Key=f'{output}.parquet')
+        return pd.read_parquet(BytesIO(response['Body'].read()))
+
+    assert 2 not in list(read_dim('dim_design').design_id)
+    assert len(read_dim('dim_design')) == len(df_design) - 1
+    assert address_id not in list(read_dim('dim_location').location_id)
+    counterparties = df_counterparty[
+        df_counterparty.legal_address_id == address_id].counterparty_id
+    assert not set(counterparties) & set(
+        read_dim('dim_counterparty').counterparty_id)
+
+
+def test_full_transform_replaces_incremental_fact_parts(
+        mock_bucket_and_parquet_files, premock_s3):
+    premock_s3.create_bucket(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+    premock_s3.put_object(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        Key='transform_state.json',
+        Body=json.dumps({'processed': {'gone.parquet': '"etag"'}}))
+    transform_incrementally()
+    response = premock_s3.get_object(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        Key='transform_state.json')
+    state = json.loads(response['Body'].read())
+    # Only parts still in the ingested bucket are remembered
+    assert 'gone.parquet' not in state['processed']
+
+    assert len(transform()) == 11
+    keys = [file['Key'] for file in premock_s3.list_objects_v2(
+        Bucket='scrumptious-squad-pr-data-testmock')['Contents']]
+    assert 'fact_sales_order.parquet' in keys
+    assert not any(key.startswith('fact_') and '/' in key for key in keys)
+    # The full run read every part, the next incremental run has none
+    invalidate_cache('listing')
+    assert transform_incrementally() == {}
+
+
+def test_transform_skips_outputs_whose_inputs_are_unchanged(
+        mock_bucket_and_parquet_files, premock_s3):
+    premock_s3.create_bucket(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+    assert len(transform()) == 11
+    assert transform() == []
+
+    # A later extraction changes one staff member
+    df_staff = get_parquet('staff')
+    add_updates(
+        [{'staff': df_staff[df_staff.staff_id == 1]}],
+        'scrumptious-squad-in-data-testmock')
+    assert transform() == ['dim_staff']
+
+
+@pytest.mark.filterwarnings('error::DeprecationWarning')
+def test_extend_dim_date_only_adds_missing_days(premock_s3):
+    premock_s3.create_bucket(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+    bucketname = 'scrumptious-squad-pr-data-testmock'
+    payment = pd.DataFrame({
+        'created_at': pd.to_datetime(['2023-01-01 10:00', '2023-01-05 09:00']),
+        'last_updated': pd.to_datetime(['2023-01-02', '2023-01-05']),
+        'payment_date': ['2023-01-03', '2023-01-10']})
+
+    assert extend_dim_date(bucketname, {'payment': payment}, 5) == 15
+    # Covered already, as remembered from the last call
+    assert extend_dim_date(bucketname, {'payment': payment}, 2) == 0
+
+    payment.loc[1, 'payment_date'] = '2023-01-20'
+    invalidate_cache()
+    assert extend_dim_date(bucketname, {'payment': payment}, 5) == 10
+
+    keys = [file['Key'] for file in premock_s3.list_objects_v2(
+        Bucket=bucketname)['Contents']]
+    assert 'dim_date.parquet' in keys
+    new_key = [key for key in keys if key.startswith('dim_date/')][0]
+    response = premock_s3.get_object(Bucket=bucketname, Key=new_key)
+    new_days = pd.read_parquet(BytesIO(response['Body'].read()))
+    assert new_days['date_id'].min() == pd.Timestamp('2023-01-16')
+    assert new_days['date_id'].max() == pd.Timestamp('2023-01-25')
+
+
+def test_build_dim_from_a_spec(mock_bucket_and_parquet_files):
+    spec = {
+        'source': 'staff',
+        'joins': [('department', 'department_id', 'department_id')],
+        'columns': {'staff_id': 'staff_id', 'dept': 'department_name'},
+        'derived': {'dept_code': ('dept', {'dept-b': 'B'}, '-')}
+    }
+    frames = get_parquets(['staff', 'department'])
+    dim = build_dim(spec, frames)
+    assert list(dim.columns) == ['staff_id', 'dept', 'dept_code']
+    assert dim['dept'][1] == 'dept-b'
+    assert dim['dept_code'][1] == 'B'
+    assert dim['dept_code'][0] == '-'
+
+    # The same values from a categorical column, mapped per category
+    frames['department']['department_name'] = \
+        frames['department']['department_name'].astype('category')
+    categorical = build_dim(spec, frames)
+    assert list(categorical['dept_code']) == list(dim['dept_code'])
+
+
+def test_dim_staff_leaves_out_staff_without_a_department(
+        mock_bucket_and_parquet_files):
+    frames = get_parquets(['staff', 'department'])
+    department = frames['department']
+    missing = department['department_id'].iloc[0]
+    department = department[department.department_id != missing]
+    expected = frames['staff'][frames['staff'].department_id != missing]
+
+    dim_staff = create_dim_staff(frames['staff'], department)
+    assert list(dim_staff['staff_id']) == sorted(expected['staff_id'])
+
+    tables = get_tables(['staff', 'department'])
+    arrow_builder, _ = ARROW_BUILDERS['dim_staff']
+    built = arrow_builder(tables['staff'], pa.Table.from_pandas(
+        department, preserve_index=False))
+    assert built['staff_id'].to_pylist() == list(dim_staff['staff_id'])
+
+
+def test_arrow_engine_builds_the_same_outputs(
+        mock_bucket_and_parquet_files, premock_s3):
+    data_frames = get_parquets(['address', 'counterparty', 'sales_order'])
+    tables = get_tables(['address', 'counterparty', 'sales_order'])
+    for output in ['dim_counterparty', 'fact_sales_order']:
+        builder, titles = OUTPUT_BUILDERS[output]
+        arrow_builder, _ = ARROW_BUILDERS[output]
+        expected = builder(*[data_frames[title] for title in titles])
+        built = arrow_builder(*[tables[title] for title in titles])
+        assert built.column_names == list(expected.columns)
+        assert built.to_pandas().astype(str).equals(expected.astype(str))
+
+    premock_s3.create_bucket(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+    assert len(transform({**DEFAULT_OPTIONS, 'engine': 'arrow'})) == 11
+    response = premock_s3.get_object(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        Key='dim_currency.parquet')
+    dim_currency = pd.read_parquet(BytesIO(response['Body'].read()))
+    assert dim_currency['currency_name'][0] == '0'
+
+
+@pytest.mark.filterwarnings('ignore:promote has been superseded')
+def test_concat_parts_fills_missing_columns_on_any_pyarrow():
+    parts = [
+        pa.table({'x': pa.array([1], pa.int32())}),
+        pa.table({'x': pa.array([2], pa.int64()), 'y': ['a']})]
+    expected = {'x': [1, 2], 'y': [None, 'a']}
+    merged = concat_parts(parts)
+    assert merged.to_pydict() == expected
+    assert merged.schema.field('x').type == pa.int64()
+
+    # A real conflict is raised as it is
+    with pytest.raises(pa.ArrowTypeError):
+        concat_parts([parts[0], pa.table({'x': ['b']})])
+
+    # Before pyarrow 14 the parts are cast to one type beforehand
+    with patch('src.transform.PYARROW_VERSION', (13, 0)):
+        assert concat_parts(
+            [parts[0].cast(pa.schema([('x', pa.int64())])), parts[1]]
+        ).to_pydict() == expected
+
+
+def test_run_dag_runs_nodes_after_their_dependencies():
+    dropped = []
+
+    class Frame(list):
+        def __del__(self):
+            dropped.append(self[0])
+
+    nodes = {
+        'load:a': (lambda: Frame(['a']), []),
+        'load:b': (lambda: Frame(['b']), []),
+        'build:ab': (lambda a, b: a + b, ['load:a', 'load:b']),
+        'build:b': (lambda b: b * 2, ['load:b']),
+        'upload': (lambda ab, b: (ab, b), ['build:ab', 'build:b'])
+    }
+    timings = run_dag(nodes, max_workers=2)
+    assert set(timings) == set(nodes)
+    # Both loads were freed once the builds reading them were done
+    assert sorted(dropped) == ['a', 'b']
+
+    nodes['build:b'] = (lambda b: 1 / 0, ['load:b'])
+    with pytest.raises(Exception, match='ERROR RUNNING build:b'):
+        run_dag(nodes)
+
+
+def test_encode_categories_of_low_cardinality_columns():
+    data_frame = pd.DataFrame({
+        'currency_code': ['GBP', 'USD', 'GBP', 'GBP'],
+        'name': ['a', 'b', 'c', 'd'],
+        'amount': [1, 1, 1, 1]})
+    encoded = encode_categories(data_frame, 0.5)
+    assert encoded['currency_code'].dtype == 'category'
+    assert encoded['name'].dtype == object
+    assert encoded['amount'].dtype == 'int64'
+    assert encode_categories(data_frame, None) is data_frame
+
+    table = encode_categories(pa.Table.from_pandas(data_frame), 0.5)
+    assert pa.types.is_dictionary(table.schema.field('currency_code').type)
+    assert pa.types.is_string(table.schema.field('name').type)
+
+    # Written as a parquet dictionary and read back as a categorical
+    buffer = BytesIO()
+    encoded.to_parquet(buffer)
+    assert pd.read_parquet(buffer)['currency_code'].dtype == 'category'
+
+
+def test_stream_fact_writes_a_row_group_per_batch(
+        mock_bucket_and_parquet_files, premock_s3):
+    premock_s3.create_bucket(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+    summary = stream_fact(
+        'fact_sales_order', 'scrumptious-squad-pr-data-testmock', 4)
+    assert summary['rows'] == 6
+    assert summary['row_groups'] == 2
+
+    response = premock_s3.get_object(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        Key='fact_sales_order.parquet')
+    buffer = BytesIO(response['Body'].read())
+    assert pq.ParquetFile(buffer).num_row_groups == 2
+    expected = create_fact_sales_order(get_parquet('sales_order'))
+    streamed = pd.read_parquet(buffer)
+    assert streamed.astype(str).equals(expected.astype(str))
+
+    # A later run changes one order: every part is streamed,
+    # each order in its newest version
+    df_sales_order = get_parquet('sales_order')
+    df_sales_order.loc[df_sales_order.sales_order_id == 2, 'units_sold'] = 7
+    add_updates(
+        [{'sales_order': df_sales_order[df_sales_order.sales_order_id == 2]}],
+        'scrumptious-squad-in-data-testmock')
+    invalidate_cache('listing')
+    summary = stream_fact(
+        'fact_sales_order', 'scrumptious-squad-pr-data-testmock', 4)
+    assert summary['rows'] == 6
+    response = premock_s3.get_object(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        Key='fact_sales_order.parquet')
+    streamed = pd.read_parquet(BytesIO(response['Body'].read()))
+    assert list(streamed.sort_values('sales_order_id')['units_sold'])[1] == 7
+    assert sorted(streamed['sales_order_id']) == [1, 2, 3, 4, 5, 6]
+
+    assert len(transform({
+        **DEFAULT_OPTIONS, 'stream_facts': True, 'batch_size': 4})) == 11
+    # dim_date was extended from the dates the streamed facts reported
+    premock_s3.head_object(
+        Bucket='scrumptious-squad-pr-data-testmock', Key='dim_date.parquet')
+
+
+def test_streamed_facts_have_the_schema_of_the_loaded_facts(
+        mock_bucket_and_parquet_files, premock_s3):
+    """
+    stream_fact() casts and dictionary encodes its batches as the Arrow
+    engine casts and encodes whole tables, and fetches the parts in
+    ranges rather than downloading them.
+    """
+    premock_s3.create_bucket(
+        Bucket='scrumptious-squad-pr-data-testmock',
+        CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+
+    def read_schemas():
+        return {
+            output: pq.read_schema(BytesIO(premock_s3.get_object(
+                Bucket='scrumptious-squad-pr-data-testmock',
+                Key=f'{output}.parquet')['Body'].read())).remove_metadata()
+            for output in ['fact_sales_order', 'fact_purchase_order',
+                           'fact_payment']}
+
+    for ratio in [DEFAULT_OPTIONS['category_ratio'], 1]:
+        options = {
+            **DEFAULT_OPTIONS, 'engine': 'arrow', 'skip_unchanged': False,
+            'category_ratio': ratio}
+        transform(options)
+        loaded = read_schemas()
+        with patch('src.transform.download_object',
+                   wraps=download_object) as downloads:
+            transform({**options, 'stream_facts': True})
+        assert read_schemas() == loaded
+        assert not [
+            call for call in downloads.call_args_list
+            if call.args[1].startswith((
+                'table=sales_order/', 'table=purchase_order/',
+                'table=payment/'))]